@@ -8,7 +8,10 @@ from .invoice import *
 from .invoice_report import * 
 from .wizard_bilan import *
 from .wizard_invoices_report import *
+from .wizard_invoice_print import *
+from .wizard_statement_batch import *
 from . import wizard_qr_invoice
+from . import wizard_qr_batch
 
 
 __all__ = ['register']
@@ -25,6 +28,8 @@ def register():
         InvoicePaymentLine,
         InvoicesReportStart,
         InvoicesReportRes,
+        InvoicePrintStart,
+        InvoicePrintResult,
         Reconciliation,
         PLBalanceSheetContext,
         PLBalanceSheetCompContext,
@@ -33,8 +38,14 @@ def register():
         PLMove,
         PLMoveLine,
         PLImportStatementStart,
+        PLImportStatementResult,
+        PLImportStatementFile,
+        PLImportStatementBatchStart,
+        PLImportStatementBatchResult,
         PLImportIsaLineStart,
         PLBilanStart,
+        PLBilanDashboardContext,
+        PLBilanDashboard,
         PLPayInvoiceStart,
         PLConfiguration,
         MyStatementLine,
@@ -45,9 +56,11 @@ def register():
 
     Pool.register(
         PLImportStatement,
+        PLImportStatementBatch,
         PLImportIsaLine,
         PLBilan,
         InvoicesReport,
+        InvoicePrint,
         module='pl_cust_account', type_='wizard')
     
     Pool.register(
@@ -59,12 +72,16 @@ def register():
         module='account', type_='report')
     
     Pool.register(
+        wizard_qr_invoice.QrScanCache,
         wizard_qr_invoice.QrInvoiceStart,
         wizard_qr_invoice.QrInvoiceConfirm,
+        wizard_qr_batch.QrInvoiceBatchStart,
+        wizard_qr_batch.QrInvoiceBatchResult,
         module='pl_cust_account', type_='model'
     )
 
     Pool.register(
         wizard_qr_invoice.QrInvoiceWizard,
+        wizard_qr_batch.QrInvoiceBatch,
         module='pl_cust_account', type_='wizard'
     )
@@ -1,8 +1,10 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
-from io import StringIO
+from io import StringIO, BytesIO
+import logging
 import re
 import csv
+import time
 import xml.etree.ElementTree as ET
 
 from trytond.i18n import gettext
@@ -10,13 +12,17 @@ from trytond.pool import PoolMeta, Pool
 from decimal import Decimal
 from trytond.modules.account_statement.exceptions import ImportStatementError
 from trytond.wizard import Wizard, StateView, StateTransition, StateAction, Button
-from trytond.model import ModelSQL, ModelView, fields
+from trytond.model import ModelSQL, ModelView, Unique, fields
 from trytond.report import Report
 from trytond.transaction import Transaction
 from datetime import datetime
 from trytond.config import config
+from trytond.tools import grouped_slice
 
-__all__ = ['PLImportStatementStart', 'PLImportStatement', 'PLConfiguration',
+logger = logging.getLogger(__name__)
+
+__all__ = ['PLImportStatementStart', 'PLImportStatementResult',
+           'PLImportStatementFile', 'PLImportStatement', 'PLConfiguration',
            'MyStatementLine', 'PLImportIsaLineStart', 'PLImportIsaLine',
            'PLTaxTemplate', 'PLTax', 'PLGeneralLedger', 'PLBalanceSheetContext', 'PLBalanceSheetCompContext', 'PLParty']
 
@@ -29,6 +35,148 @@ def format_date2(date):
     y, m, d = str(date).split('-')
     return '{}.{}.{}'.format(d, m, y[-2:])
 
+# Blocs CAMT contenant le compte et les mouvements (054, 053, 052)
+CAMT_CONTAINERS = ('Ntfctn', 'Stmt', 'Rpt')
+
+# N° de facture à partir de la référence QR/BVR selon pl_cust.ref_fmt
+REF_FORMATS = {
+    'yyyy/xxxxx': lambda r: '{}/{}'.format(r[-10:-6], r[-6:-1]),
+    'yyyy/xxxx': lambda r: '{}/{}'.format(r[-9:-5], r[-5:-1]),
+    'yyyy-xxx': lambda r: '{}-{}'.format(r[-8:-4], r[-4:-1]),
+    'xxxxx-ddddd': lambda r: 'F{}-{}'.format(r[-11:-6], r[-6:-1]),
+    'x': lambda r: '{}'.format(int(r[-10:-1])),
+}
+
+STAT_FIELDS = ['nb_lines', 'nb_matched', 'nb_overpaid', 'nb_to_check',
+               'nb_unmatched']
+
+
+def get_ref_fmt():
+    ref_fmt = config.get('pl_cust', 'ref_fmt')
+    if not ref_fmt:
+        raise ImportStatementError(
+            "Il faut configurer le format des n° de facture (demander à ProLibre)")
+    if ref_fmt not in REF_FORMATS:
+        raise ImportStatementError(
+            "Format ref_fmt du fichier de conf non reconnu")
+    return ref_fmt
+
+
+def camt_invoice_number(reference, ref_fmt):
+    if not reference:
+        return None
+    try:
+        return REF_FORMATS[ref_fmt](reference)
+    except ValueError:
+        return None
+
+
+def camt_invoices(numbers):
+    "Factures par n°, cherchées par paquets de `number IN (...)`"
+    Invoices = Pool().get('account.invoice')
+    invoices = {}
+    for sub_numbers in grouped_slice(sorted(set(numbers))):
+        for invoice in Invoices.search(
+                [('number', 'in', list(sub_numbers))],
+                order=[('id', 'ASC')]):
+            invoices.setdefault(invoice.number, invoice)
+    return invoices
+
+
+def camt_entry_records(entry, ns):
+    """
+    Paiements (TxDtls) d'un mouvement (Ntry), contrôlés avec son montant.
+    Les débits (CAMT.053) sont négatifs, un mouvement sans détail donne
+    une seule ligne.
+    """
+    def text(element, path):
+        found = element.find('/'.join(ns + tag for tag in path.split('/')))
+        return found.text if found is not None else None
+
+    total = float(text(entry, 'Amt'))
+    valdt = text(entry, 'ValDt/Dt') or text(entry, 'BookgDt/Dt')
+    entry_dbcd = -1.0 if text(entry, 'CdtDbtInd') == 'DBIT' else 1.0
+    records = []
+    valtmp = 0.0
+    for detail in entry.iterfind('%sNtryDtls/%sTxDtls' % (ns, ns)):
+        amount = float(text(detail, 'Amt') or total)
+        reference = text(detail, 'RmtInf/Strd/CdtrRefInf/Ref')
+        dbcd = {'DBIT': -1.0, 'CRDT': 1.0}.get(
+            text(detail, 'CdtDbtInd'), entry_dbcd)
+        if (detail.find('%sRltdPties/%sUltmtDbtr' % (ns, ns)) is not None
+                or detail.find('%sRltdPties/%sDbtr' % (ns, ns)) is not None):
+            name = (text(detail, 'RltdPties/UltmtDbtr/Nm')
+                    or text(detail, 'RltdPties/Dbtr/Nm') or '')
+            full_line = "Nom : %s / Montant : %.2f / ref : %s" % (
+                name, amount, reference)
+        elif detail.find('%sRltdPties/%sCdtr' % (ns, ns)) is not None:
+            full_line = "Nom : %s / Montant : %.2f / ref : %s" % (
+                text(detail, 'RltdPties/Cdtr/Nm') or '', amount, reference)
+        else:
+            full_line = "Montant : %.2f / ref : %s" % (amount, reference)
+        records.append({
+                'reference': reference,
+                'amount': '{:.2f}'.format(amount * dbcd),
+                'date': valdt,
+                'cost': 0,
+                'full_line': full_line,
+                })
+        valtmp += amount
+    if not records:
+        records.append({
+                'reference': None,
+                'amount': '{:.2f}'.format(total * entry_dbcd),
+                'date': valdt,
+                'cost': 0,
+                'full_line': text(entry, 'AddtlNtryInf') or (
+                    "Montant : %.2f" % total),
+                })
+        valtmp = total
+    if abs(total - valtmp) > 0.01:
+        raise ImportStatementError("Erreur sur le montant final")
+    return records
+
+
+def parse_camt(file_):
+    """
+    Lecture en flux d'un fichier CAMT: chaque mouvement est traité puis
+    retiré de l'arbre, seul l'en-tête est gardé.
+    Retourne ({'msg_id':, 'id':, 'iban':, 'date':}, [paiements]).
+    """
+    if isinstance(file_, str):
+        file_ = file_.encode('utf-8')
+    header = {'msg_id': None, 'id': None, 'iban': None, 'date': None}
+    records = []
+    ns = None
+    stack = []
+    for event, element in ET.iterparse(
+            BytesIO(file_), events=('start', 'end')):
+        if event == 'start':
+            if ns is None:
+                ns = namespace(element)
+            stack.append(element)
+            continue
+        stack.pop()
+        tag = element.tag[len(ns):]
+        parent = stack[-1].tag[len(ns):] if stack else None
+        if tag == 'Ntry':
+            records.extend(camt_entry_records(element, ns))
+            stack[-1].remove(element)
+        elif tag == 'MsgId' and parent == 'GrpHdr':
+            header['msg_id'] = element.text
+        elif tag == 'CreDtTm' and parent == 'GrpHdr':
+            header['date'] = element.text[:10]
+        elif tag == 'Id' and parent in CAMT_CONTAINERS:
+            header['id'] = header['id'] or element.text
+        elif (tag == 'IBAN' and header['iban'] is None and len(stack) > 2
+                and stack[-2].tag == ns + 'Acct'
+                and stack[-3].tag[len(ns):] in CAMT_CONTAINERS):
+            header['iban'] = element.text
+    if ns is None or header['iban'] is None or not (
+            header['msg_id'] or header['id']):
+        raise ImportStatementError("Fichier CAMT non reconnu")
+    return header, records
+
 class MyStatementLine(ModelSQL):
     'Account Statement Line'
     __name__ = 'account.statement.line'
@@ -82,6 +230,52 @@ class PLImportStatementStart(ModelView):
         return None
 
 
+class PLImportStatementResult(ModelView):
+    "ProLibre Statement Import Result"
+    __name__ = 'pl_cust_account.statement.import.result'
+    nb_lines = fields.Integer("Nb Payments", readonly=True)
+    nb_matched = fields.Integer("Matched", readonly=True)
+    nb_overpaid = fields.Integer("Overpaid", readonly=True)
+    nb_to_check = fields.Integer("To Check", readonly=True,
+        help="Facture trouvée mais pas comptabilisée (déjà payée, ...)")
+    nb_unmatched = fields.Integer("Unmatched", readonly=True)
+    amount = fields.Numeric("Amount", digits=(16, 2), readonly=True)
+    duration = fields.Float("Duration (s)", digits=(16, 1), readonly=True)
+
+
+class PLImportStatementFile(ModelSQL, ModelView):
+    "ProLibre Imported CAMT File"
+    __name__ = 'pl_cust_account.statement.import.file'
+    name = fields.Char("File Name", readonly=True)
+    msg_id = fields.Char("Message Id", required=True, readonly=True)
+    iban = fields.Char("IBAN", readonly=True)
+    statement = fields.Many2One('account.statement', "Statement",
+        required=True, readonly=True, ondelete='CASCADE')
+    nb_lines = fields.Integer("Nb Payments", readonly=True)
+    amount = fields.Numeric("Amount", digits=(16, 2), readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints = [
+            ('msg_id_uniq', Unique(t, t.msg_id),
+                "Ce fichier CAMT est déjà importé."),
+        ]
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @staticmethod
+    def get_msg_id(header):
+        "Id du message CAMT (GrpHdr/MsgId), sinon celui de l'avis/relevé"
+        return header['msg_id'] or header['id']
+
+    @classmethod
+    def get_duplicate(cls, header):
+        files = cls.search(
+            [('msg_id', '=', cls.get_msg_id(header))], limit=1)
+        return files[0] if files else None
+
+
 class PLImportStatement(Wizard):
     "ProLibre Statement Import"
     __name__ = 'pl_cust_account.statement.import'
@@ -93,202 +287,166 @@ class PLImportStatement(Wizard):
                       ])
 
     parse_camt = StateTransition()
+    result = StateView('pl_cust_account.statement.import.result',
+                       'pl_cust_account.statement_import_result_view_form', [
+                           Button("Close", 'end', 'tryton-close'),
+                       ])
 
-    def transition_parse_camt(self, encoding='windows-1252'):
-        file_ = self.start.file_
-        if not isinstance(file_, str):
-            file_ = file_.decode(encoding)
-        # file_ = StringIO(file_)
-        camt_statement = {}
-        root = ET.fromstring(file_)
-        ns = namespace(root)
-        records = []
-        camt_statement['iban'] = root.find(
-            "%sBkToCstmrDbtCdtNtfctn/%sNtfctn/%sAcct/%sId/%sIBAN" % (ns, ns, ns, ns, ns)).text
-        camt_statement['id'] = root.find(
-            "%sBkToCstmrDbtCdtNtfctn/%sNtfctn/%sId" % (ns, ns, ns)).text
-        info = root.findall(
-            "%sBkToCstmrDbtCdtNtfctn/%sNtfctn/%sNtry" % (ns, ns, ns))
-        for val in info:
-            valtmp = 0.0
-            ValTot = float(val.find("%sAmt" % ns).text)
-            camt_statement['tot'] = '{:.2f}'.format(ValTot)
-            valdt = val.find("%sValDt/%sDt" % (ns, ns)).text
-            for val2 in val.findall("%sNtryDtls/%sTxDtls" % (ns, ns)):
-                if val2.find("%sRltdPties/%sUltmtDbtr" % (ns, ns)):
-                    try :
-                        new_line = "Nom : %s / Montant : %.2f / ref : %s" % (
-                            val2.find("%sRltdPties" % (ns)) and val2.find(
-                             "%sRltdPties/%sUltmtDbtr" % (ns, ns)) and val2.find(
-                             "%sRltdPties/%sUltmtDbtr/%sNm" % (ns, ns, ns)).text or "???",
-                            float(val2.find("%sAmt" % ns).text),
-                        val2.find("%sRmtInf/%sStrd/%sCdtrRefInf/%sRef" %
-                                      (ns, ns, ns, ns)).text,)
-                         # val2.find("%sRltdDts/%sAccptncDtTm" %
-                            #          (ns, ns)).text.split('T')[0]
-                    except :
-                        new_line = "???"
-                    
-                    dbcd = 1.0
-
-                elif val2.find("%sRltdPties/%sDbtr" % (ns, ns)):
-                    new_line = "Nom : %s / Montant : %.2f / ref : %s" % (
-                        val2.find("%sRltdPties" % (ns)) and val2.find("%sRltdPties/%sDbtr/%sNm" % (
-                            ns, ns, ns)) and val2.find("%sRltdPties/%sDbtr/%sNm" % (ns, ns, ns)).text or "",
-                        float(val2.find("%sAmt" % ns).text),
-                        val2.find("%sRmtInf/%sStrd/%sCdtrRefInf/%sRef" %
-                                  (ns, ns, ns, ns)).text,
-                        # val2.find("%sRltdDts/%sAccptncDtTm" %
-                        #          (ns, ns)).text.split('T')[0]
-                    )
-                    dbcd = 1.0
-
-                elif val2.find("%sRltdPties/%sCbtr" % (ns, ns)):
-                    new_line = "Nom : %s / Montant : %.2f / Date du paiement par le client : %s" % (
-                        val2.find("%sRltdPties" % (ns)) and val2.find(
-                            "%sRltdPties/%sCdtr/%sNm" % (ns, ns, ns)).text or "",
-                        float(val2.find("%sAmt" % ns).text),
-                        val2.find("%sRltdDts/%sAccptncDtTm" %
-                                  (ns, ns)).text.split('T')[0]
-                    )
-                    dbcd = -1.0
-                else:
-                    new_line = "Montant : %.2f / ref : %s" % (
-                        float(val2.find("%sAmt" % ns).text),
-                        val2.find("%sRmtInf/%sStrd/%sCdtrRefInf/%sRef" %
-                                  (ns, ns, ns, ns)).text,
-                        # val2.find("%sRltdDts/%sAccptncDtTm" %
-                        #          (ns, ns)).text.split('T')[0]
-                    )
-                    dbcd = 1.0
-                    #raise ImportStatementError("Erreur pas de nom à donner")
-
-                record = {'reference':  val2.find("%sRmtInf/%sStrd/%sCdtrRefInf/%sRef" % (ns, ns, ns, ns)).text,
-                          'amount': '{:.2f}'.format(float(val2.find("%sAmt" % ns).text) * dbcd),
-                          # val2.find("%sRltdDts/%sAccptncDtTm"%(ns,ns)).text.split('T')[0],
-                          'date': valdt,
-                          'cost': 0,
-                          'full_line': new_line,
-                          }
-                print('!!!!--{}'.format(record))
-                valtmp += float(val2.find("%sAmt" % ns).text)
-                records.append(record)
-            if abs(ValTot - valtmp) > 0.01:
-                raise ImportStatementError("Erreur sur le montant final")
-
-        print(camt_statement)
+    def transition_parse_camt(self):
+        pool = Pool()
+        File = pool.get('pl_cust_account.statement.import.file')
 
-        statement = self.start.statement
-        origins = list(statement.origins)
-        lines = list(statement.lines)
-        i_start = len(lines)
-        for i, move in enumerate(records):
-            orig, = self.camt_origin(statement, move, i_start + i)
-            origins.extend([orig])
-            print('+++++++--{}'.format(move))
-            lines.extend(self.camt_line(statement, orig, move, i_start + i))
-        statement.origins = origins
-        statement.lines = lines
-        statement.save()
-        return 'end'
+        ref_fmt = get_ref_fmt()
+        start = time.perf_counter()
+        header, records = parse_camt(self.start.file_)
+        duplicate = File.get_duplicate(header)
+        if duplicate:
+            raise ImportStatementError(
+                "Fichier déjà importé dans le relevé %s"
+                % duplicate.statement.rec_name)
+        stats, = self.camt_import(
+            [(self.start.statement, header, records, None)], ref_fmt)
+        stats['duration'] = time.perf_counter() - start
+        logger.info("CAMT %s: %s lines imported, %s matched, %s unmatched "
+                    "in %.1fs", header['id'], stats['nb_lines'],
+                    stats['nb_matched'], stats['nb_unmatched'],
+                    stats['duration'])
+        for name, value in stats.items():
+            setattr(self.result, name, value)
+        return 'result'
+
+    def default_result(self, fields):
+        return {name: getattr(self.result, name, None) for name in fields}
 
-    def camt_origin(self, statement, move, sequence):
+    @classmethod
+    def camt_import(cls, batches, ref_fmt):
+        """
+        Crée les origines et les lignes des relevés pour les fichiers CAMT
+        [(statement, header, records, filename)]: toutes les factures sont
+        cherchées ensemble puis tout est enregistré en une fois et le
+        fichier est noté comme importé.
+        Retourne les statistiques de rapprochement de chaque fichier.
+        """
+        pool = Pool()
+        Origin = pool.get('account.statement.origin')
+        Lines = pool.get('account.statement.line')
+        File = pool.get('pl_cust_account.statement.import.file')
+        account_conf = pool.get('account.configuration')
+        conf = account_conf(1)
+        receivable = conf.default_account_receivable
+
+        numbers = [[camt_invoice_number(r['reference'], ref_fmt)
+                    for r in records] for _, _, records, _ in batches]
+        invoices = camt_invoices(
+            n for batch in numbers for n in batch if n)
+
+        # Numéros suivants par relevé, un relevé peut recevoir plusieurs
+        # fichiers du même lot
+        sequences = {}
+        origins, lines, files, all_stats = [], [], [], []
+        for (statement, header, records, filename), batch_numbers in zip(
+                batches, numbers):
+            i_start = sequences.setdefault(statement, len(statement.lines))
+            stats = dict.fromkeys(STAT_FIELDS, 0)
+            stats['amount'] = Decimal(0)
+            for i, (move, number) in enumerate(zip(records, batch_numbers)):
+                origin, = cls.camt_origin(statement, move, i_start + i)
+                origins.append(origin)
+                new_lines, status = cls.camt_line(
+                    statement, origin, move, i_start + i,
+                    invoices.get(number), receivable)
+                lines.extend(new_lines)
+                stats['nb_' + status] += 1
+                stats['amount'] += Decimal(move['amount'])
+            stats['nb_lines'] = len(records)
+            sequences[statement] = i_start + len(records)
+            files.append(File(
+                    name=filename,
+                    msg_id=File.get_msg_id(header),
+                    iban=header['iban'],
+                    statement=statement,
+                    nb_lines=len(records),
+                    amount=stats['amount']))
+            all_stats.append(stats)
+        Origin.save(origins)
+        Lines.save(lines)
+        File.save(files)
+        return all_stats
+
+    @classmethod
+    def camt_origin(cls, statement, move, sequence):
         pool = Pool()
         Origin = pool.get('account.statement.origin')
 
         origin = Origin()
         origin.statement = statement
         origin.number = sequence
-        origin.date = datetime.strptime(move['date'], '%Y-%m-%d')
-        origin.amount = move['amount']
+        origin.date = datetime.strptime(move['date'], '%Y-%m-%d').date()
+        origin.amount = Decimal(move['amount'])
         origin.account = statement.journal.account
-        origin.save()
 
         # origin.party=self.camt_party(statement, move)
         # TODO select account using transaction codes
         origin.description = move['full_line']
-        origin.information = self.camt_information(move)
+        origin.information = cls.camt_information(move)
         return [origin]
 
-    def camt_line(self, statement, origin, move, sequence):
+    @classmethod
+    def camt_line(cls, statement, origin, move, sequence, inv, receivable):
+        """
+        Lignes du relevé pour un paiement et la facture trouvée (ou None).
+        Retourne les lignes et le statut: matched, overpaid, to_check ou
+        unmatched.
+        """
         pool = Pool()
         Lines = pool.get('account.statement.line')
-        Invoices = pool.get('account.invoice')
-
-        account_conf = pool.get('account.configuration')
-        conf = account_conf(1)
 
+        date = datetime.strptime(move['date'], '%Y-%m-%d').date()
+        amount = Decimal(move['amount'])
         line2 = None
         line = Lines()
         line.number = sequence
-
-        line.date = datetime.strptime(move['date'], '%Y-%m-%d')
-        line.amount = move['amount']
+        line.date = date
+        line.amount = amount
         line.statement = statement
         line.origin = origin
         line.description = ''
 
-        ref_fmt = config.get('pl_cust', 'ref_fmt')
-        if not ref_fmt:
-            raise ImportStatementError(
-                "Il faut configurer le format des n° de facture (demander à ProLibre)")
-        if ref_fmt == 'yyyy/xxxxx':
-            invoice = Invoices.search(
-                [('number', '=', '{}/{}'.format(move['reference'][-10:-6], move['reference'][-6:-1]))])
-        elif ref_fmt == 'yyyy/xxxx':
-            invoice = Invoices.search(
-                [('number', '=', '{}/{}'.format(move['reference'][-9:-5], move['reference'][-5:-1]))])
-        elif ref_fmt == 'yyyy-xxx':
-            invoice = Invoices.search(
-                [('number', '=', '{}-{}'.format(move['reference'][-8:-4], move['reference'][-4:-1]))])
-        elif ref_fmt == 'xxxxx-ddddd':
-            invoice = Invoices.search(
-                [('number', '=', 'F{}-{}'.format(move['reference'][-11:-6], move['reference'][-6:-1]))])
-        elif ref_fmt == 'x':
-            invoice = Invoices.search(
-                [('number', '=', '{}'.format(int(move['reference'][-10:-1])))])
-        else:
-            raise ImportStatementError(
-                "Format ref_fmt du fichier de conf non reconnu")
-
-        if invoice:
-            inv = Invoices(invoice[0])
+        if inv:
             if not inv.state == 'posted':
+                status = 'to_check'
                 line.party = inv.party
-                line.account = conf.default_account_receivable
+                line.account = receivable
                 if inv.state == 'paid':
                     line.description = 'Facture déjà payée'
                 else:
                     line.description = 'Vérifier état facture'
-                
             else:
-                if inv.amount_to_pay < Decimal(move['amount']):
+                status = 'matched'
+                if inv.amount_to_pay < amount:
+                    status = 'overpaid'
                     line.amount = inv.amount_to_pay
                     line2 = Lines()
                     line2.number = sequence
-                    line2.date = datetime.strptime(move['date'], '%Y-%m-%d')
-                    line2.amount = Decimal(move['amount']) - inv.amount_to_pay
+                    line2.date = date
+                    line2.amount = amount - inv.amount_to_pay
                     line2.statement = statement
                     line2.origin = origin
                     line2.party = inv.party
-                    line2.account = conf.default_account_receivable
+                    line2.account = receivable
                     line2.description = 'Montant payé en trop'
-                    line2.save()
                 line.invoice = inv
                 line.party = inv.party
                 line.account = inv.account
         else:
-            print('*************bhoueaaaa****************')
-            line.account = conf.default_account_receivable
-
+            status = 'unmatched'
+            line.account = receivable
             line.description = 'Erreur de référence'
 
-        line.save()
-
         if line2:
-            return [line, line2]
+            return [line, line2], status
         else:
-            return [line]
+            return [line], status
 
     def camt_party(self, camt_statement, move):
         pool = Pool()
@@ -306,7 +464,8 @@ class PLImportStatement(Wizard):
             if number.account.owners:
                 return number.account.owners[0]
 
-    def camt_information(self, move):
+    @classmethod
+    def camt_information(cls, move):
         information = {}
         for name in [
             'reference',
@@ -15,6 +15,7 @@ from trytond.i18n import gettext
 from trytond.exceptions import UserError
 from itertools import groupby
 from trytond.model.exceptions import AccessError
+from trytond.modules.pl_cust_plbase.attachment import AttachmentMixin
 
 __all__ = ['PLInvoice', 'PLMove', 'PLMoveLine', 'PLPayInvoiceStart', 'PLInvoiceLine']
 
@@ -76,11 +77,10 @@ class PLPayInvoiceStart(ModelView):
         return ''
 
 
-class PLInvoice(ModelSQL, ModelView):
+class PLInvoice(AttachmentMixin, ModelSQL, ModelView):
     __name__ = 'account.invoice'
 
     oeid = fields.Char('OEid')
-    as_attachment = fields.Function(fields.Boolean('pj'), 'get_as_attachement')
     date_due = fields.Date('Date Due')
     date_pay = fields.Function(fields.Date('Date Pay'),
                                'get_date_pay')
@@ -135,17 +135,6 @@ class PLInvoice(ModelSQL, ModelView):
                     if self.party.supplier_payment_term:
                         self.payment_term = self.party.supplier_payment_term
 
-    @classmethod
-    def get_as_attachement(cls, invoices, name):
-        pool = Pool()
-        ATTACH = pool.get('ir.attachment')
-
-        res = {i.id: False for i in invoices}
-        for inv in invoices : 
-            if ATTACH.search([('resource', '=', inv)]) :
-                res[inv.id] = True
-        return res
-
     @classmethod
     def search_rec_name(cls, name, clause):
         _, operator, value = clause
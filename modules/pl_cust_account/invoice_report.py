@@ -7,9 +7,14 @@ from trytond.report import Report
 from trytond.rpc import RPC
 from trytond.pool import Pool
 from trytond.transaction import Transaction
+from trytond.config import config
 from datetime import datetime
 from decimal import *
+from io import BytesIO
+import functools
+import os
 import re
+import threading
 
 __all__ = ['InvoiceReport']
 
@@ -94,28 +99,42 @@ def _get_ref(inv_num, memb_num):
     return mod10r(member_num + ''.rjust(26-len(member_num)-len(invoice_number), '0') + invoice_number)
 
 
-def qr_gen(iban="CHxxxxxxxxxxxxxxxxxxx",
-           is_qriban=True,
-           amount=666.66,
-           party_name='John Doe',
-           party_rue='xxx',
-           party_compl='xxx',
-           party_zip='xxx',
-           party_city='xxx',
-           party_country='CH',
-           ref='210000000003139471430009017',
-           descr='-',
-           label1='',
-           label2='',
-           label3='',
-           id=1):
-    qr = qrcode.QRCode(  # version=23,
-        error_correction=qrcode.constants.ERROR_CORRECT_M,
-        box_size=18,
-        border=0,
-    )
-
-    txt = u"""SPC
+QR_CACHE_SIZE = config.getint('pl_cust', 'qr_cache_size', default=512)
+SWISS_PNG = os.path.join(os.path.dirname(__file__), 'swiss.png')
+
+_swiss_lock = threading.Lock()
+_swiss = None
+
+
+def _swiss_cross():
+    "Croix suisse (bytes PNG et image), lue une seule fois par process"
+    global _swiss
+    with _swiss_lock:
+        if _swiss is None:
+            with open(SWISS_PNG, 'rb') as f:
+                content = f.read()
+            logo = Image.open(BytesIO(content))
+            logo.load()
+            _swiss = (content, logo)
+        return _swiss
+
+
+def qr_payload(iban="CHxxxxxxxxxxxxxxxxxxx",
+               is_qriban=True,
+               amount=666.66,
+               party_name='John Doe',
+               party_rue='xxx',
+               party_compl='xxx',
+               party_zip='xxx',
+               party_city='xxx',
+               party_country='CH',
+               ref='210000000003139471430009017',
+               descr='-',
+               label1='',
+               label2='',
+               label3=''):
+    "Contenu SPC de la QR-facture"
+    return u"""SPC
 0200
 1
 {}
@@ -162,33 +181,38 @@ EPD
            is_qriban and ref or "",
            descr)
 
-    qr.add_data(txt)
 
+@functools.lru_cache(maxsize=QR_CACHE_SIZE)
+def qr_png(payload):
+    """
+    Image PNG (bytes) du QR code avec la croix suisse au centre, générée en
+    mémoire et gardée en cache par contenu SPC: une réimpression ne
+    recalcule rien.
+    """
+    qr = qrcode.QRCode(  # version=23,
+        error_correction=qrcode.constants.ERROR_CORRECT_M,
+        box_size=18,
+        border=0,
+    )
+    qr.add_data(payload)
     qr.make(fit=False)
 
-    #factory = qrcode.image.svg.SvgPathImage
-
-    #img = qrcode.make(txt, image_factory=factory)
-    #img = qrcode.make(txt, )
-
-    img = qr.make_image(fill_color="black", back_color="white")
-    img.save('/tmp/test.png')
-
-    try : 
-        swiss_logo = Image.open(
-            "/usr/local/lib/python3.9/dist-packages/trytond/modules/pl_cust_account/swiss.png")
-    except : 
-        swiss_logo = Image.open(
-            "/usr/local/lib/python3.11/dist-packages/trytond/modules/pl_cust_account/swiss.png")
-
-    code_qr = Image.open("/tmp/test.png")
+    code_qr = qr.make_image(fill_color="black", back_color="white")
+    _, swiss_logo = _swiss_cross()
 
     img_w, img_h = swiss_logo.size
     bg_w, bg_h = code_qr.size
     offset = ((bg_w - img_w) // 2, (bg_h - img_h) // 2)
     code_qr.paste(swiss_logo, offset)
-    code_qr.save('/tmp/qr{}.png'.format(id))
-    return True
+
+    output = BytesIO()
+    code_qr.save(output, format='PNG')
+    return output.getvalue()
+
+
+def qr_gen(**kwargs):
+    "PNG (bytes) de la QR-facture, voir qr_payload pour les paramètres"
+    return qr_png(qr_payload(**kwargs))
 
 
 class InvoiceReport(Report):
@@ -222,18 +246,29 @@ class InvoiceReport(Report):
     #         return result
 
     @classmethod
-    def get_context(cls, records, headers, data):
+    def get_shared_context(cls):
+        "Valeurs communes à toutes les factures, calculées une fois par impression"
         pool = Pool()
-        Date = pool.get('ir.date')
         LANG = pool.get('ir.lang')
         ACCOUNT_CONF = pool.get('account.configuration')
-        configuration = ACCOUNT_CONF(1)
+        return {
+            'lang': LANG(LANG.search([('code', '=', 'fr')])[0]),
+            'configuration': ACCOUNT_CONF(1),
+            }
+
+    @classmethod
+    def get_context(cls, records, headers, data):
+        pool = Pool()
+        Date = pool.get('ir.date')
 
         context = super().get_context(records, headers, data)
 
+        shared = (data or {}).get('_shared') or cls.get_shared_context()
+        configuration = shared['configuration']
+
         # print(context)
         context['invoice'] = context['record']
-        context['lang'] = LANG(LANG.search([('code', '=', 'fr')])[0])
+        context['lang'] = shared['lang']
 
         context['lines'] = []
         for l in context['invoice'].lines:
@@ -311,7 +346,7 @@ class InvoiceReport(Report):
         context['QRinfo'] = context['invoice'].description
 
         if context['invoice'].number:
-            qr_gen(iban=context['QRiban'].replace(' ', ''),
+            png = qr_gen(iban=context['QRiban'].replace(' ', ''),
                    is_qriban=configuration.is_qriban,
                    amount=context['invoice'].amount_to_pay or '',
                    party_name=context['QRparty'],
@@ -324,17 +359,10 @@ class InvoiceReport(Report):
                    descr=context['QRinfo'],
                    label1=context['QRlabel1'],
                    label2=context['QRlabel2'],
-                   label3=context['QRlabel3'],
-                   id=context['invoice'].id)
-            context['myimg'] = (
-                open('/tmp/qr{}.png'.format(context['invoice'].id), 'rb'), 'image/png')
+                   label3=context['QRlabel3'])
         else:
-            try : 
-                context['myimg'] = (open(
-                    '/usr/local/lib/python3.9/dist-packages/trytond/modules/pl_cust_account/swiss.png', 'rb'), 'image/png')
-            except :
-                context['myimg'] = (open(
-                    '/usr/local/lib/python3.11/dist-packages/trytond/modules/pl_cust_account/swiss.png', 'rb'), 'image/png')
+            png, _ = _swiss_cross()
+        context['myimg'] = (BytesIO(png), 'image/png')
 
         context['mytoday'] = my_format_date(context['invoice'].invoice_date)
         context['mytoday_now'] = my_format_date(Date.today())
@@ -17,6 +17,8 @@ from sql import Column, Literal, Null, Window
 from sql.aggregate import Count, Max, Min, Sum
 from sql.conditionals import Case, Coalesce
 
+from .wizard_bilan import clear_bilan
+
 class MoveReconcile(ValidationError):
     pass
 
@@ -159,6 +161,24 @@ class Line(metaclass=PoolMeta):
             #             account=line.account.rec_name,
             #             line=line.rec_name))
 
+    # Le résumé des résultats somme aussi les lignes des pièces brouillon,
+    # modifiables sans passer par account.move
+    @classmethod
+    def create(cls, vlist):
+        lines = super().create(vlist)
+        clear_bilan()
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        clear_bilan()
+
+    @classmethod
+    def delete(cls, lines):
+        super().delete(lines)
+        clear_bilan()
+
 class Move(metaclass=PoolMeta):
     __name__ = 'account.move'
 
@@ -188,6 +208,24 @@ class Move(metaclass=PoolMeta):
             'state': 'draft',
         })
 
+    # Le résumé des résultats (wizard_bilan) est en cache jusqu'à la
+    # prochaine pièce créée, comptabilisée ou supprimée
+    @classmethod
+    def create(cls, vlist):
+        moves = super().create(vlist)
+        clear_bilan()
+        return moves
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        clear_bilan()
+
+    @classmethod
+    def delete(cls, moves):
+        super().delete(moves)
+        clear_bilan()
+
 class Reconciliation(metaclass=PoolMeta):
     'Account Move Reconciliation Lines'
     __name__ = 'account.move.reconciliation'
@@ -1,11 +1,17 @@
 from trytond.wizard import Wizard, StateView, StateTransition, StateAction, Button
-from trytond.model import ModelView, fields
+from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import Pool
 from trytond.transaction import Transaction
+from trytond.cache import Cache
+from trytond.config import config
 import datetime
 from trytond.pyson import Eval, PYSONEncoder
 from decimal import Decimal
 
+from sql import Cast, Literal, Null
+from sql.aggregate import Sum
+from sql.conditionals import Case, Coalesce
+
 from trytond.model.exceptions import ValidationError
 
 class BilanError(ValidationError):
@@ -14,7 +20,176 @@ class BilanError(ValidationError):
 
 
 
-__all__ = ["PLBilan", "PLBilanStart"]
+__all__ = ["PLBilan", "PLBilanStart", "PLBilanDashboardContext",
+           "PLBilanDashboard"]
+
+# Indicateurs par (société, période): vidé quand des pièces sont créées,
+# modifiées (comptabilisation) ou supprimées. Les devis ne vident pas le
+# cache, ils sont à jour après bilan_ttl secondes.
+_bilan_cache = Cache(
+    "pl_cust_account.bilan",
+    duration=config.getint("pl_cust", "bilan_ttl", default=3600),
+    context=False,
+)
+
+def clear_bilan():
+    _bilan_cache.clear()
+
+
+def _bilan_move_lines(company_id, date_start, date_end):
+    "Produits et charges: soldes crédit - débit groupés par type de compte"
+    pool = Pool()
+    Account = pool.get('account.account')
+    Acc_Type = pool.get('account.account.type')
+    Move = pool.get('account.move')
+    Move_Line = pool.get('account.move.line')
+    account = Account.__table__()
+    move = Move.__table__()
+    line = Move_Line.__table__()
+    cursor = Transaction().connection.cursor()
+
+    type_charge = [t.id for t in Acc_Type.search([('name', '=', 'Charges')])]
+    type_produit = [t.id for t in Acc_Type.search([('name', '=', 'Produits')])]
+    if not type_charge or not type_produit:
+        raise BilanError("Impossible de récupérer correctement les types de comptes ... contacter ProLibre")
+
+    where = (account.type.in_(type_charge + type_produit)
+        & (move.date >= date_start) & (move.date <= date_end))
+    if company_id:
+        where &= account.company == company_id
+    cursor.execute(*line
+        .join(move, condition=line.move == move.id)
+        .join(account, condition=line.account == account.id)
+        .select(account.type,
+            Sum(Coalesce(line.credit, 0) - Coalesce(line.debit, 0)),
+            where=where, group_by=[account.type]))
+
+    charges = produits = Decimal(0)
+    for type_id, amount in cursor:
+        if type_id in type_charge:
+            charges += Decimal(amount or 0)
+        else:
+            produits += Decimal(amount or 0)
+    return produits, charges
+
+
+def _bilan_invoices(company_id, date_end):
+    """
+    Facturation HT de l'année et du mois de date_end et factures clients
+    ouvertes, sommées sur le montant HT enregistré à la comptabilisation.
+    """
+    pool = Pool()
+    Invoice = pool.get('account.invoice')
+    invoice = Invoice.__table__()
+    cursor = Transaction().connection.cursor()
+
+    year_start = date_end.replace(day=1, month=1)
+    year_end = date_end.replace(day=31, month=12)
+    month_start = date_end.replace(day=1)
+    month_end = (date_end.replace(month=date_end.month % 12 + 1, day=1)
+        - datetime.timedelta(days=1))
+
+    def in_year(date):
+        return year_start <= date <= year_end
+
+    def in_month(date):
+        return month_start <= date <= month_end
+
+    where = (invoice.type == 'out') & invoice.state.in_(['posted', 'paid'])
+    if company_id:
+        where &= invoice.company == company_id
+    untaxed = invoice.untaxed_amount_cache
+    cursor.execute(*invoice.select(
+            Sum(Case(((invoice.invoice_date >= year_start)
+                        & (invoice.invoice_date <= year_end), untaxed),
+                    else_=0)),
+            Sum(Case(((invoice.invoice_date >= month_start)
+                        & (invoice.invoice_date <= month_end), untaxed),
+                    else_=0)),
+            Sum(Case((invoice.state == 'posted', untaxed), else_=0)),
+            where=where & (untaxed != Null)))
+    fact_year, fact_month, open_invoices = (
+        Decimal(v or 0) for v in cursor.fetchone())
+
+    # Factures sans montant enregistré (anciennes données): calcul ORM
+    domain = [
+        ('type', '=', 'out'),
+        ('state', 'in', ['posted', 'paid']),
+        ('untaxed_amount_cache', '=', None),
+        ]
+    if company_id:
+        domain.append(('company', '=', company_id))
+    for inv in Invoice.search(domain):
+        if inv.invoice_date and in_year(inv.invoice_date):
+            fact_year += inv.untaxed_amount
+        if inv.invoice_date and in_month(inv.invoice_date):
+            fact_month += inv.untaxed_amount
+        if inv.state == 'posted':
+            open_invoices += inv.untaxed_amount
+    return fact_year, fact_month, open_invoices
+
+
+def _bilan_devis():
+    """
+    Lignes de devis non facturées des dossiers en devis et ouverts, ou None
+    si les modules dossiers et devis ne sont pas installés.
+    """
+    pool = Pool()
+    try:
+        Devis_Line = pool.get('pl_cust_devis.devisline')
+        Folders = pool.get('pl_cust_plfolders.folders')
+    except KeyError:
+        return None
+    line = Devis_Line.__table__()
+    folder = Folders.__table__()
+    cursor = Transaction().connection.cursor()
+
+    # Même calcul que Devis.on_change_with_price
+    price = (Coalesce(line.product_price, 0)
+        * Coalesce(line.quantity, 0)
+        * Cast(Coalesce(line.pct, '0'), 'INTEGER') / 100)
+    cursor.execute(*line
+        .join(folder, condition=line.folder_id == folder.id)
+        .select(folder.state, Sum(price),
+            where=folder.state.in_(['devis', 'open'])
+            & (line.invoice_id == Null)
+            & (Coalesce(line.force_invoice, Literal(False)) == Literal(False)),
+            group_by=[folder.state]))
+    totals = {'devis': Decimal(0), 'open': Decimal(0)}
+    for state, amount in cursor:
+        totals[state] = Decimal(str(round(amount or 0, 2)))
+    return totals
+
+
+def get_bilan(company_id, date_start, date_end):
+    """
+    Indicateurs du résumé des résultats entre date_start et date_end (la
+    facturation porte sur l'année et le mois de date_end), en quelques
+    requêtes groupées et mis en cache.
+    Retourne {champ de PLBilanDashboard: montant, 'has_devis': bool}.
+    """
+    key = (company_id, date_start.isoformat(), date_end.isoformat())
+    bilan = _bilan_cache.get(key)
+    if bilan is not None:
+        return bilan
+
+    produits, charges = _bilan_move_lines(company_id, date_start, date_end)
+    fact_year, fact_month, open_invoices = _bilan_invoices(
+        company_id, date_end)
+    devis = _bilan_devis()
+    bilan = {
+        'produits': produits,
+        'charges': charges,
+        'resultat': produits + charges,
+        'fact_year': fact_year,
+        'fact_month': fact_month,
+        'open_invoices': open_invoices,
+        'work_in_progress': devis['open'] if devis else Decimal(0),
+        'devis_pending': devis['devis'] if devis else Decimal(0),
+        'has_devis': devis is not None,
+        }
+    _bilan_cache.set(key, bilan)
+    return bilan
 
 
 class PLBilanStart(ModelView):
@@ -44,108 +219,10 @@ class PLBilanStart(ModelView):
     def on_change_with_res_bilan(self, name=None):
         if not self.date_start or not self.date_end :
             return 'Donner une date de déput et de fin'
-        pool = Pool()
-        Account = pool.get('account.account')
-        Acc_Type = pool.get('account.account.type')
-        Move_Line = pool.get('account.move.line')
-        INVOICES = pool.get('account.invoice')
-
-        acc_type_id_charge = Acc_Type.search([('name', '=', 'Charges')])
-        acc_type_id_produit = Acc_Type.search([('name', '=', 'Produits')])
-        if not acc_type_id_charge or not acc_type_id_produit: 
-            raise BilanError("Impossible de récupérer correctement les types de comptes ... contacter ProLibre")
-        
-        # Vérifie si le module devis est installé
-        try:
-            Devis_Line = Pool().get('pl_cust_devis.devisline')
-            # Si on arrive ici, le module est installé
-        except KeyError:
-            Devis_Line = None
-
-        # Vérifie si le module folders est installé
-        try:
-            Folders = Pool().get('pl_cust_plfolders.folders')
-            # Si on arrive ici, le module est installé
-        except KeyError:
-            Folders = None
-            
-        all_account_charges = Account.search(['type', '=', acc_type_id_charge[0].id])
-        all_account_produits = Account.search(['type', '=', acc_type_id_produit[0].id])
-
-        all_move_line_charges = Move_Line.search([('account', 'in', (acc.id for acc in all_account_charges)),('date', '>=', self.date_start),('date', '<=', self.date_end)])
-        all_move_line_produits = Move_Line.search([('account', 'in', (acc.id for acc in all_account_produits)),('date', '>=', self.date_start),('date', '<=', self.date_end)])
-
-        tot_charges = 0
-        tot_produits = 0
-        tot_dl = 0
-        tot_dl_open = 0
-
-
-        day_now = self.date_end
-
-        year_now = day_now.year
-
-        premier_jour_annee = day_now.replace(day=1,month=1)
-        dernier_jour_annee = day_now.replace(day=31,month=12)
-
-        # Premier jour du mois courant
-        premier_jour_mois = day_now.replace(day=1)
-
-        # Calcul du dernier jour du mois suivant puis soustraction d'un jour pour obtenir le dernier jour du mois courant
-        dernier_jour_mois = (day_now.replace(month=day_now.month % 12 + 1, day=1) - datetime.timedelta(days=1))
-
-        # # Détermination du trimestre courant
-        # trimestre = (day_now.month - 1) // 3 + 1
-        # print(trimestre)
-        # # Calcul du premier jour du trimestre
-        # premier_jour_trimestre = datetime.date(day_now.year, 3 * trimestre - 2, 1)
-
-        # # Calcul du dernier jour du trimestre
-        # if trimestre < 4: 
-        #     dernier_jour_trimestre = datetime.date(day_now.year, 3 * trimestre + 1, 1) - datetime.timedelta(days=1)
-        # else:
-        #     # Si c'est le dernier trimestre, calculer le dernier jour de l'année
-        #     dernier_jour_trimestre = datetime.date(day_now.year, 12, 31)
-
-
-        for c in all_move_line_charges :
-            tot_charges += c.credit - c.debit
-
-        for p in all_move_line_produits :
-            tot_produits += p.credit - p.debit
-
-        if Folders and Devis_Line : 
-            all_fold_devis = Folders.search([('state','=','devis')])
-            all_fold_open = Folders.search([('state','=','open')])
-
-            for fold in all_fold_devis:
-                for dl in fold.devis_lines :
-                    if not dl.invoiced :
-                        tot_dl += dl.price
-
-            for fold in all_fold_open:
-                for dl in fold.devis_lines :
-                    if not dl.invoiced :
-                        tot_dl_open += dl.price
-
-        all_invoice_year = INVOICES.search([('type','=','out'),('state','in',('posted','paid')), ('invoice_date', '>=', '{}-01-01'.format(year_now)), ('invoice_date', '<=', '{}-12-31'.format(year_now))])
-        all_invoice_month = INVOICES.search([('type','=','out'),('state','in',('posted','paid')), ('invoice_date', '>=', premier_jour_mois.strftime('%Y-%m-%d')), ('invoice_date', '<=', dernier_jour_mois.strftime('%Y-%m-%d'))]) 
-        all_fc = INVOICES.search([('type','=','out'),('state','=','posted')]) 
-
-        tot_fact_year = 0
-        tot_fact_month = 0
-        tot_fc = 0
-
-        for inv in all_invoice_year :
-            tot_fact_year += inv.untaxed_amount 
-          
-        for inv in all_invoice_month :
-            tot_fact_month += inv.untaxed_amount 
-
-        for inv in all_fc :
-            tot_fc += inv.untaxed_amount 
-
-        if Folders and Devis_Line :  
+        bilan = get_bilan(Transaction().context.get('company'),
+            self.date_start, self.date_end)
+
+        if bilan['has_devis'] :
             return """
             Résultat : {:,.2f} (Produits : {:,.2f}  / Charges : {:,.2f})
 
@@ -155,15 +232,86 @@ class PLBilanStart(ModelView):
 
             Travaux en cours à facturer : {:,.2f} 
 
-            Devis en attente de validation : {:,.2f}""".format(tot_produits+tot_charges,tot_produits,tot_charges, tot_fact_year, tot_fact_month, tot_fc, tot_dl_open,tot_dl).replace(',',"'")
+            Devis en attente de validation : {:,.2f}""".format(bilan['resultat'], bilan['produits'], bilan['charges'], bilan['fact_year'], bilan['fact_month'], bilan['open_invoices'], bilan['work_in_progress'], bilan['devis_pending']).replace(',',"'")
         else : 
             return """
             Résultat : {:,.2f} (Produits : {:,.2f}  / Charges : {:,.2f}
 
             Facturation HT année en cours : {:,.2f} (mois en cours : {:,.2f})
 
-            Factures clients ouvertes : {:,.2f}""".format(tot_produits+tot_charges,tot_produits,tot_charges, tot_fact_year, tot_fact_month, tot_fc).replace(',',"'")
-    
+            Factures clients ouvertes : {:,.2f}""".format(bilan['resultat'], bilan['produits'], bilan['charges'], bilan['fact_year'], bilan['fact_month'], bilan['open_invoices']).replace(',',"'")
+
+
+class PLBilanDashboardContext(ModelView):
+    "ProLibre Bilan Dashboard Context"
+    __name__ = "pl_cust_account.bilan_dashboard.context"
+
+    date_start = fields.Date('Début', required=True)
+    date_end = fields.Date('Fin', required=True)
+
+    @staticmethod
+    def default_date_start():
+        return PLBilanStart.default_date_start()
+
+    @staticmethod
+    def default_date_end():
+        return PLBilanStart.default_date_end()
+
+
+class PLBilanDashboard(ModelSQL, ModelView):
+    "ProLibre Bilan Dashboard"
+    __name__ = "pl_cust_account.bilan_dashboard"
+
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    produits = fields.Function(fields.Numeric('Produits', digits=(16, 2)),
+        'get_bilan_values')
+    charges = fields.Function(fields.Numeric('Charges', digits=(16, 2)),
+        'get_bilan_values')
+    resultat = fields.Function(fields.Numeric('Résultat', digits=(16, 2)),
+        'get_bilan_values')
+    fact_year = fields.Function(fields.Numeric('Facturation HT année',
+            digits=(16, 2)), 'get_bilan_values')
+    fact_month = fields.Function(fields.Numeric('Facturation HT mois',
+            digits=(16, 2)), 'get_bilan_values')
+    open_invoices = fields.Function(fields.Numeric('Factures ouvertes',
+            digits=(16, 2)), 'get_bilan_values')
+    work_in_progress = fields.Function(fields.Numeric('Travaux à facturer',
+            digits=(16, 2)), 'get_bilan_values')
+    devis_pending = fields.Function(fields.Numeric('Devis en attente',
+            digits=(16, 2)), 'get_bilan_values')
+
+    @classmethod
+    def table_query(cls):
+        "Une ligne par société, les indicateurs dépendent du contexte"
+        pool = Pool()
+        Company = pool.get('company.company')
+        company = Company.__table__()
+        where = Literal(True)
+        if Transaction().context.get('company'):
+            where = company.id == Transaction().context['company']
+        return company.select(
+            company.id.as_('id'),
+            company.id.as_('company'),
+            company.create_uid.as_('create_uid'),
+            company.create_date.as_('create_date'),
+            company.write_uid.as_('write_uid'),
+            company.write_date.as_('write_date'),
+            where=where)
+
+    @classmethod
+    def get_bilan_values(cls, records, names):
+        context = Transaction().context
+        date_start = (context.get('date_start')
+            or PLBilanStart.default_date_start())
+        date_end = context.get('date_end') or PLBilanStart.default_date_end()
+        result = {name: {} for name in names}
+        for record in records:
+            bilan = get_bilan(record.id, date_start, date_end)
+            for name in names:
+                result[name][record.id] = bilan[name]
+        return result
+
+
 class PLBilan(Wizard):
     "ProLibre Bilan"
     __name__ = "pl_cust_account.plbilan"
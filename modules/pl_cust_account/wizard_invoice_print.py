@@ -0,0 +1,266 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import io
+import logging
+import os
+import pathlib
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from trytond.config import config
+from trytond.model import ModelView, fields
+from trytond.model.exceptions import ValidationError
+from trytond.pool import Pool
+from trytond.tools import slugify
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+
+try:
+    from pypdf import PdfWriter
+except ImportError:
+    PdfWriter = None
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['InvoicePrintStart', 'InvoicePrintResult', 'InvoicePrint']
+
+# Conversions LibreOffice simultanées
+_PRINT_WORKERS = config.getint(
+    'pl_cust', 'invoice_print_workers', default=min(4, os.cpu_count() or 1))
+
+
+class InvoicePrintError(ValidationError):
+    pass
+
+
+# Délai d'un appel à soffice (un lot de factures)
+_CONVERT_TIMEOUT = config.getint(
+    'pl_cust', 'invoice_print_timeout', default=5 * 60)
+# Factures converties par un même appel à soffice
+_CONVERT_CHUNK = config.getint(
+    'pl_cust', 'invoice_print_chunk', default=50)
+
+
+def _convert(report_name, contents, input_format, output_format, profile):
+    """
+    Conversion soffice comme Report.convert, mais de plusieurs documents en
+    un seul appel (un démarrage de LibreOffice par lot et non par facture)
+    et avec le profil LibreOffice `profile` du worker: des soffice
+    simultanés ne peuvent pas partager le profil par défaut.
+    Retourne [(extension, contenu)], contenu None si soffice n'a pas produit
+    le document.
+    """
+    if output_format == input_format:
+        return [(input_format, content) for content in contents]
+    directory = tempfile.mkdtemp(prefix='trytond_')
+    try:
+        names = []
+        for i, content in enumerate(contents):
+            name = '%s-%04d' % (report_name, i)
+            mode = 'w' if isinstance(content, str) else 'wb'
+            with open(os.path.join(directory, name + os.extsep + input_format),
+                    mode) as fp:
+                fp.write(content)
+            names.append(name)
+        subprocess.run([
+                'soffice',
+                '-env:UserInstallation=%s' % pathlib.Path(profile).as_uri(),
+                '--headless', '--nolockcheck', '--nodefault', '--norestore',
+                '--convert-to', output_format, '--outdir', directory,
+                ] + [os.path.join(directory, name + os.extsep + input_format)
+                for name in names],
+            check=True, timeout=_CONVERT_TIMEOUT,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        converted = []
+        for name in names:
+            path = os.path.join(directory, name + os.extsep + output_format)
+            if os.path.exists(path):
+                with open(path, 'rb') as fp:
+                    converted.append((output_format, fp.read()))
+            else:
+                converted.append((output_format, None))
+        return converted
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def render_invoices(action, invoices, workers=_PRINT_WORKERS):
+    """
+    Rend les factures avec le modèle `action` (ir.action.report de
+    pl_cust_account.invoice_report): contexte commun calculé une fois,
+    factures lues ensemble, puis conversion (soffice) en parallèle par lots
+    d'au plus invoice_print_chunk factures, un profil LibreOffice par worker.
+    Retourne [(invoice, extension, contenu)].
+    """
+    InvoiceReport = Pool().get(action.report_name, type='report')
+
+    data = {
+        'model': 'account.invoice',
+        'action_id': action.id,
+        '_shared': InvoiceReport.get_shared_context(),
+        }
+    # Rendu relatorio: il lit la base, donc dans la transaction
+    rendered = []
+    for invoice in invoices:
+        report_context = InvoiceReport.get_context([invoice], {}, data)
+        rendered.append(InvoiceReport.render(action, report_context))
+
+    # La conversion ne lit plus la base
+    input_format = action.template_extension
+    output_format = action.extension or action.template_extension
+    size = max(min(_CONVERT_CHUNK, -(-len(rendered) // workers)), 1)
+    chunks = [rendered[i:i + size] for i in range(0, len(rendered), size)]
+    local = threading.local()
+    profiles = []
+    profiles_lock = threading.Lock()
+
+    def convert(contents):
+        if not hasattr(local, 'profile'):
+            local.profile = tempfile.mkdtemp(prefix='trytond_soffice_')
+            with profiles_lock:
+                profiles.append(local.profile)
+        return _convert(action.report_name, contents, input_format,
+            output_format, local.profile)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            converted = [c for chunk in executor.map(convert, chunks)
+                for c in chunk]
+    finally:
+        for profile in profiles:
+            shutil.rmtree(profile, ignore_errors=True)
+    results = []
+    for invoice, (oext, content) in zip(invoices, converted):
+        if content is None:
+            raise InvoicePrintError(
+                "Conversion impossible de la facture %s" % invoice.rec_name)
+        results.append((invoice, oext, content))
+    return results
+
+
+class InvoicePrintStart(ModelView):
+    "Invoice Mass Print"
+    __name__ = 'pl_cust_account.invoice_print_start'
+
+    report = fields.Many2One('ir.action.report', 'Report', required=True,
+        domain=[('report_name', '=', 'pl_cust_account.invoice_report')])
+    date_from = fields.Date('From Date', required=True)
+    date_to = fields.Date('To Date', required=True)
+    party = fields.Many2One('party.party', 'Party')
+    merge = fields.Boolean('Merge PDF',
+        help="Un seul PDF au lieu d'un zip (nécessite pypdf)")
+
+    @staticmethod
+    def default_report():
+        ActionReport = Pool().get('ir.action.report')
+        reports = ActionReport.search([
+                ('report_name', '=', 'pl_cust_account.invoice_report'),
+                ], limit=1)
+        return reports[0].id if reports else None
+
+    @staticmethod
+    def default_date_from():
+        Date_ = Pool().get('ir.date')
+        return Date_.today().replace(day=1)
+
+    @staticmethod
+    def default_date_to():
+        Date_ = Pool().get('ir.date')
+        return Date_.today()
+
+
+class InvoicePrintResult(ModelView):
+    "Invoice Mass Print Result"
+    __name__ = 'pl_cust_account.invoice_print_result'
+
+    name = fields.Char('File Name', readonly=True)
+    file = fields.Binary('File', filename='name', readonly=True)
+    nb_invoices = fields.Integer('Nb Invoices', readonly=True)
+    message = fields.Text('Message', readonly=True)
+    duration = fields.Float('Duration (s)', digits=(16, 1), readonly=True)
+
+
+class InvoicePrint(Wizard):
+    "Invoice Mass Print"
+    __name__ = 'pl_cust_account.invoice_print'
+
+    start = StateView('pl_cust_account.invoice_print_start',
+        'pl_cust_account.invoice_print_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Print', 'print_', 'tryton-print', default=True),
+            ])
+    print_ = StateTransition()
+    result = StateView('pl_cust_account.invoice_print_result',
+        'pl_cust_account.invoice_print_result_view_form', [
+            Button('Close', 'end', 'tryton-close'),
+            ])
+
+    def get_domain(self):
+        domain = [
+            ('type', '=', 'out'),
+            ('state', 'in', ['posted', 'paid']),
+            ('invoice_date', '>=', self.start.date_from),
+            ('invoice_date', '<=', self.start.date_to),
+            ]
+        if self.start.party:
+            domain.append(('party', '=', self.start.party.id))
+        return domain
+
+    def transition_print_(self):
+        Invoice = Pool().get('account.invoice')
+
+        start = time.perf_counter()
+        invoices = Invoice.search(self.get_domain(),
+            order=[('number', 'ASC'), ('id', 'ASC')])
+        if not invoices:
+            raise InvoicePrintError("Aucune facture à imprimer")
+
+        results = render_invoices(self.start.report, invoices)
+
+        period = '{}_{}'.format(self.start.date_from.strftime('%d%m%y'),
+            self.start.date_to.strftime('%d%m%y'))
+        merge = self.start.merge
+        self.result.message = None
+        if merge and not PdfWriter:
+            merge = False
+            self.result.message = ("Fusion impossible: pypdf n'est pas "
+                "installé sur le serveur, les factures sont dans un zip.")
+        elif merge and not all(oext == 'pdf' for _, oext, _ in results):
+            merge = False
+            self.result.message = ("Fusion impossible: le modèle « %s » ne "
+                "produit pas de PDF (extension %s), les factures sont dans "
+                "un zip." % (self.start.report.rec_name, results[0][1]))
+        if merge:
+            writer = PdfWriter()
+            for _, _, content in results:
+                writer.append(io.BytesIO(content))
+            output = io.BytesIO()
+            writer.write(output)
+            self.result.name = 'factures_{}.pdf'.format(period)
+        else:
+            output = io.BytesIO()
+            with zipfile.ZipFile(output, 'w') as content_zip:
+                for invoice, oext, content in results:
+                    filename = '{}.{}'.format(
+                        slugify(invoice.number or str(invoice.id)), oext)
+                    content_zip.writestr(filename, content)
+            self.result.name = 'factures_{}.zip'.format(period)
+        self.result.file = output.getvalue()
+        self.result.nb_invoices = len(invoices)
+        self.result.duration = time.perf_counter() - start
+        logger.info("%s invoices printed in %.1fs",
+            len(invoices), self.result.duration)
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'name': self.result.name,
+            'file': self.result.file,
+            'nb_invoices': self.result.nb_invoices,
+            'message': self.result.message,
+            'duration': self.result.duration,
+            }
@@ -0,0 +1,467 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+
+from trytond.wizard import Wizard, StateView, StateTransition, StateAction, Button
+from trytond.model import ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import PYSONEncoder
+from trytond.transaction import Transaction
+from trytond.config import config
+
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from datetime import date
+import io
+import os
+import shutil
+import time
+import zipfile
+
+from .wizard_qr_invoice import (
+    QrInvoiceError, logger, scan_qr_pdf, _decode_binary_input,
+    _ensure_period, _find_account_by_kind, _find_unit, _normalize_iban,
+    _ensure_supplier_party, _ensure_supplier_address, _parse_spc_dynamic,
+    _pdf_sha256, _acquire_scan_slot, _scan_slots, _SCAN_WORKERS)
+
+
+__all__ = [
+    'QrInvoiceBatchStart', 'QrInvoiceBatchResult', 'QrInvoiceBatch'
+]
+
+
+# ---------------------------------------------------------------------------
+# Lookups memoised for one batch run
+# ---------------------------------------------------------------------------
+
+class _BatchLookups(object):
+    """
+    Exercice/période, comptes, tiers et adresses ne sont cherchés qu'une
+    fois par run, quel que soit le nombre de factures.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._periods = {}
+        self._accounts = {}
+        self._parties = {}
+        self._addresses = {}
+        self._currencies = {}
+        self._unit = False
+
+    def period(self, dt):
+        key = (dt.year, dt.month)
+        if key not in self._periods:
+            self._periods[key] = _ensure_period(self.pool, dt)
+        return self._periods[key]
+
+    def account(self, kind):
+        if kind not in self._accounts:
+            self._accounts[kind] = _find_account_by_kind(self.pool, kind)
+        return self._accounts[kind]
+
+    def party(self, creditor_name, iban):
+        key = _normalize_iban(iban) or (creditor_name or '').strip().lower()
+        if key not in self._parties:
+            self._parties[key] = _ensure_supplier_party(
+                self.pool, creditor_name, iban)
+        return self._parties[key]
+
+    def address(self, party, parsed):
+        if party.id not in self._addresses:
+            self._addresses[party.id] = _ensure_supplier_address(
+                self.pool, party, parsed)
+        return self._addresses[party.id]
+
+    def currency(self, code):
+        if code not in self._currencies:
+            Currency = self.pool.get('currency.currency')
+            res = Currency.search([('code', '=', code)], limit=1)
+            self._currencies[code] = res[0] if res else None
+        return self._currencies[code]
+
+    def unit(self):
+        if self._unit is False:
+            self._unit = _find_unit(self.pool)
+        return self._unit
+
+
+# ---------------------------------------------------------------------------
+# Sources: ZIP upload or server-side spool directory
+# ---------------------------------------------------------------------------
+
+# Racine des répertoires serveur autorisés: sans elle, pas d'import depuis
+# un répertoire du serveur
+_SPOOL_ROOT = config.get('pl_cust', 'spool_root')
+
+
+def _read_zip(data):
+    "Fichiers PDF de l'archive, nommés par leur chemin complet dans le ZIP"
+    files = []
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        for info in zf.infolist():
+            if info.is_dir() or not info.filename.lower().endswith('.pdf'):
+                continue
+            files.append((info.filename, zf.read(info)))
+    return files
+
+
+def _spool_path(spool_dir, error=QrInvoiceError):
+    """
+    Chemin réel de `spool_dir`, relatif à pl_cust.spool_root. Refusé s'il
+    sort de cette racine (.., liens symboliques, chemin absolu).
+    """
+    if not _SPOOL_ROOT:
+        raise error("Import depuis un répertoire serveur non configuré "
+            "(pl_cust.spool_root).")
+    root = os.path.realpath(_SPOOL_ROOT)
+    path = os.path.realpath(os.path.join(root, spool_dir))
+    if os.path.commonpath([root, path]) != root:
+        raise error("Répertoire hors de %s: %s" % (root, spool_dir))
+    return path
+
+
+def _read_spool(directory):
+    if not os.path.isdir(directory):
+        raise QrInvoiceError(
+            "Répertoire introuvable sur le serveur: %s" % directory)
+    files = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and name.lower().endswith('.pdf'):
+            with open(path, 'rb') as f:
+                files.append((name, f.read()))
+    return files
+
+
+def _archive_spool(directory, name, ok):
+    """Déplace le fichier traité dans done/ ou error/ du répertoire."""
+    target = os.path.join(directory, 'done' if ok else 'error')
+    os.makedirs(target, exist_ok=True)
+    try:
+        shutil.move(os.path.join(directory, name), os.path.join(target, name))
+    except OSError as e:
+        logger.error("Impossible d'archiver %s: %s", name, e)
+
+
+class _SpoolArchiver(object):
+    """
+    Data manager de la transaction: les fichiers ne sont déplacés qu'après
+    le commit. Une transaction annulée ou rejouée les laisse en place.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = []
+
+    def add(self, name, ok):
+        self.files.append((name, ok))
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        files, self.files = self.files, []
+        for name, ok in files:
+            _archive_spool(self.directory, name, ok)
+
+    def tpc_abort(self, trans):
+        self.files = []
+
+
+def _scan_file(item):
+    name, data = item
+    if not data.startswith(b"%PDF-"):
+        raise QrInvoiceError("PDF invalide.")
+    scan = scan_qr_pdf(data, slot=False, max_workers=1)
+    if not scan.spc:
+        raise QrInvoiceError("Aucun QR-facture suisse valide trouvé dans le PDF.")
+    return _parse_spc_dynamic(scan.spc), scan.page, scan.dpi
+
+
+def _amount(raw):
+    raw = (raw or '').strip()
+    try:
+        return Decimal(
+            raw.replace("'", "").replace(" ", "").replace(",", ".")
+        ) if raw else Decimal('0')
+    except Exception:
+        return Decimal('0')
+
+
+# ---------------------------------------------------------------------------
+# Wizard models
+# ---------------------------------------------------------------------------
+
+class QrInvoiceBatchStart(ModelView):
+    __name__ = 'pl_cust_account.qr_invoice_batch_start'
+
+    zip_file = fields.Binary("Archive ZIP (PDF)", filename='zip_filename')
+    zip_filename = fields.Char("Nom de l'archive")
+    spool_dir = fields.Char("Répertoire serveur",
+        help="Relatif à la racine configurée (pl_cust.spool_root). Les PDF "
+        "traités sont déplacés dans les sous-répertoires done/ et error/ "
+        "après l'enregistrement des factures.")
+    invoice_date = fields.Date("Date facture", required=True)
+    journal = fields.Many2One(
+        'account.journal', "Journal", required=True,
+        domain=[('type', '=', 'expense')],
+    )
+    account_expense = fields.Many2One(
+        'account.account', "Compte de charge", required=True,
+        help="Utilisé si le fournisseur n'a pas de compte de charge par défaut.")
+
+    @staticmethod
+    def default_invoice_date():
+        return date.today()
+
+    @staticmethod
+    def default_journal():
+        Journal = Pool().get('account.journal')
+        js = Journal.search([('type', '=', 'expense')], limit=1)
+        return js[0].id if js else None
+
+
+class QrInvoiceBatchResult(ModelView):
+    __name__ = 'pl_cust_account.qr_invoice_batch_result'
+
+    nb_ok = fields.Integer("Factures créées", readonly=True)
+    nb_error = fields.Integer("Fichiers en erreur", readonly=True)
+    report = fields.Text("Rapport", readonly=True)
+    invoices = fields.Many2Many(
+        'account.invoice', None, None, "Factures", readonly=True)
+
+
+class QrInvoiceBatch(Wizard):
+    __name__ = 'pl_cust_account.qr_invoice_batch'
+
+    start = StateView(
+        'pl_cust_account.qr_invoice_batch_start',
+        'pl_cust_account.qr_invoice_batch_start_view_form',
+        [
+            Button('Quitter', 'end', 'tryton-cancel'),
+            Button('Importer', 'import_', 'tryton-ok', default=True),
+        ]
+    )
+
+    import_ = StateTransition()
+
+    result = StateView(
+        'pl_cust_account.qr_invoice_batch_result',
+        'pl_cust_account.qr_invoice_batch_result_view_form',
+        [
+            Button('Fermer', 'end', 'tryton-close'),
+            Button('Ouvrir les factures', 'open_invoices', 'tryton-ok',
+                default=True),
+        ]
+    )
+
+    open_invoices = StateAction('account_invoice.act_invoice_in_form')
+
+    def transition_import_(self):
+        logger.info("==> transition_import_ (batch)")
+        start_time = time.perf_counter()
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Line = pool.get('account.invoice.line')
+        Attachment = pool.get('ir.attachment')
+        Company = pool.get('company.company')
+        ScanCache = pool.get('pl_cust_account.qr_scan_cache')
+
+        s = self.start
+        spool_dir = (s.spool_dir or '').strip()
+        if s.zip_file:
+            _, data = _decode_binary_input(s.zip_file)
+            try:
+                files = _read_zip(data)
+            except zipfile.BadZipFile:
+                raise QrInvoiceError("Archive ZIP invalide.")
+            spool_dir = None
+        elif spool_dir:
+            spool_dir = _spool_path(spool_dir)
+            files = _read_spool(spool_dir)
+        else:
+            raise QrInvoiceError("Aucune archive ZIP ni répertoire indiqué.")
+        if not files:
+            raise QrInvoiceError("Aucun fichier PDF à importer.")
+
+        # 1) already decoded PDFs come from the cache, the others are
+        # decoded in parallel (no database access in the threads)
+        t0 = time.perf_counter()
+        results = {}
+        errors = {}
+        to_scan = []
+        seen = {}
+        for name, data in files:
+            digest = _pdf_sha256(data)
+            if digest in seen:
+                errors[name] = "Doublon de %s dans le lot." % seen[digest]
+                continue
+            seen[digest] = name
+            entry = ScanCache.lookup(data)
+            if entry and (entry.hits or entry.invoice):
+                errors[name] = "Doublon probable: " + entry.duplicate_warning
+            elif entry:
+                results[name] = entry.get_parsed()
+            else:
+                to_scan.append((name, data))
+        # le lot entier ne tient qu'un slot de scan et laisse au moins un
+        # worker libre pour les lectures interactives
+        futures = []
+        if to_scan:
+            _acquire_scan_slot()
+            try:
+                with ThreadPoolExecutor(
+                        max_workers=max(_SCAN_WORKERS - 1, 1)) as executor:
+                    futures = [executor.submit(_scan_file, f)
+                        for f in to_scan]
+            finally:
+                _scan_slots.release()
+        for (name, data), future in zip(to_scan, futures):
+            try:
+                parsed, page, dpi = future.result()
+                results[name] = parsed
+                ScanCache.store(data, os.path.basename(name), parsed, page, dpi)
+            except QrInvoiceError as e:
+                errors[name] = str(e)
+            except Exception as e:
+                logger.error("Erreur scan %s: %s", name, e, exc_info=True)
+                errors[name] = "Erreur de lecture (détail en log serveur)."
+        decode_time = time.perf_counter() - t0
+
+        # 2) build all invoices with memoised lookups
+        t0 = time.perf_counter()
+        lookups = _BatchLookups(pool)
+        cid = Transaction().context.get('company')
+        company = Company(cid) if cid else None
+        lookups.period(s.invoice_date)
+
+        to_create = []
+        for name, data in files:
+            if name not in results:
+                continue
+            p = results[name]
+            try:
+                amount = _amount(p.get('amount'))
+                if amount <= 0:
+                    raise QrInvoiceError("Montant de facture invalide (0).")
+                party = lookups.party(p.get('creditor_name'), p.get('iban'))
+                address = lookups.address(party, p)
+                payable = (getattr(party, 'account_payable_used', None)
+                    or lookups.account('payable'))
+                if not payable:
+                    raise QrInvoiceError(
+                        "Aucun compte fournisseur (kind='payable').")
+            except QrInvoiceError as e:
+                errors[name] = str(e)
+                continue
+
+            creditor_name = (p.get('creditor_name') or '').strip()
+            description = (
+                (p.get('billing_information') or '').strip()
+                or (p.get('unstructured_message') or '').strip()
+                or f"Facture QR - {creditor_name or 'Fournisseur'}")
+            inv_vals = {
+                'type': 'in',
+                'party': party.id,
+                'invoice_address': address.id,
+                'invoice_date': s.invoice_date,
+                'accounting_date': s.invoice_date,
+                'description': description,
+                'reference': p.get('reference') or '',
+                'account': payable.id,
+                'journal': s.journal.id,
+            }
+            if company and 'company' in Invoice._fields:
+                inv_vals['company'] = company.id
+            currency = lookups.currency(p.get('currency')) \
+                if p.get('currency') else None
+            if currency:
+                inv_vals['currency'] = currency.id
+            elif company:
+                inv_vals['currency'] = company.currency.id
+            if 'note' in Invoice._fields and p.get('full_text'):
+                inv_vals['note'] = p['full_text']
+
+            expense = (getattr(party, 'default_category_account_expense', None)
+                or s.account_expense)
+            line_vals = {
+                'description': description,
+                'account': expense.id,
+                'quantity': Decimal('1'),
+                'unit_price': amount,
+            }
+            unit = lookups.unit()
+            if unit and 'unit' in Line._fields:
+                line_vals['unit'] = unit.id
+            to_create.append((name, data, inv_vals, line_vals))
+
+        # 3) bulk create invoices, lines and attachments
+        invoices = Invoice.create([v for _, _, v, _ in to_create])
+        lines = []
+        attachments = []
+        for invoice, (name, data, _, line_vals) in zip(invoices, to_create):
+            lines.append(dict(line_vals, invoice=invoice.id))
+            att_vals = {
+                'name': os.path.basename(name),
+                'data': data,
+                'resource': str(invoice),
+            }
+            if 'mimetype' in Attachment._fields:
+                att_vals['mimetype'] = 'application/pdf'
+            attachments.append(att_vals)
+        if lines:
+            Line.create(lines)
+            Invoice.update_taxes(invoices)
+        if attachments:
+            Attachment.create(attachments)
+        for invoice, (_, data, _, _) in zip(invoices, to_create):
+            ScanCache.link_invoice(data, invoice)
+        create_time = time.perf_counter() - t0
+
+        if spool_dir:
+            archiver = Transaction().join(_SpoolArchiver(spool_dir))
+            for name, _ in files:
+                archiver.add(name, name not in errors)
+
+        created = {name: inv for inv, (name, _, _, _) in zip(invoices, to_create)}
+        report = []
+        for name, _ in files:
+            if name in created:
+                p = results[name]
+                report.append("OK      %s → %s (%s %s)" % (
+                    name, created[name].party.rec_name,
+                    p.get('amount'), p.get('currency')))
+            else:
+                report.append("ERREUR  %s: %s" % (name, errors.get(name)))
+        report.append('')
+        report.append(
+            "Décodage: %.1fs, création: %.1fs, total: %.1fs" % (
+                decode_time, create_time, time.perf_counter() - start_time))
+        logger.info("Import QR batch: %d ok, %d erreurs (%s)",
+            len(invoices), len(errors), report[-1])
+
+        self.result.invoices = invoices
+        self.result.nb_ok = len(invoices)
+        self.result.nb_error = len(errors)
+        self.result.report = "\n".join(report)
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'nb_ok': getattr(self.result, 'nb_ok', 0),
+            'nb_error': getattr(self.result, 'nb_error', 0),
+            'report': getattr(self.result, 'report', ''),
+            'invoices': [i.id for i in getattr(self.result, 'invoices', [])],
+            }
+
+    def do_open_invoices(self, action):
+        ids = [i.id for i in self.result.invoices]
+        action['pyson_domain'] = PYSONEncoder().encode([('id', 'in', ids)])
+        action['name'] = 'Factures fournisseur importées'
+        return action, {}
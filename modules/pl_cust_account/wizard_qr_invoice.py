@@ -2,28 +2,37 @@
 # this repository contains the full copyright notices and license terms.
 
 from trytond.wizard import Wizard, StateView, StateTransition, StateAction, Button
-from trytond.model import ModelView, fields
-from trytond.model.exceptions import ValidationError
+from trytond.model import ModelSQL, ModelView, Unique, fields
+from trytond.model.exceptions import SQLConstraintError, ValidationError
 from trytond.pool import Pool
 from trytond.transaction import Transaction
+from trytond.config import config
+from trytond.backend import DatabaseIntegrityError
 
 from decimal import Decimal
 from datetime import date, date as _date
 import base64
+import hashlib
+import json
 import logging
 import re
 import calendar as _cal
-import signal
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time
+from collections import namedtuple
 
 import numpy as np
 import cv2
-from pdf2image import convert_from_bytes
+from pdf2image import convert_from_bytes, pdfinfo_from_bytes
 from pyzbar.pyzbar import decode as zbar_decode
 from PIL import Image
 
 
 __all__ = [
-    'QrInvoiceError', 'QrInvoiceStart',
+    'QrInvoiceError', 'QrScanCache', 'QrInvoiceStart',
     'QrInvoiceConfirm', 'QrInvoiceWizard'
 ]
 
@@ -411,28 +420,22 @@ def _ensure_supplier_address(pool, party, parsed: dict):
 # QR decode + SPC parsing
 # ---------------------------------------------------------------------------
 
-class TimeoutException(Exception):
-    pass
-
-
-def _signal_handler(signum, frame):
-    raise TimeoutException("QR decoding timeout")
-
-
 def _low_level_decode(img_bgr):
+    """
+    Décodage brut (OpenCV + pyzbar). Pas de timeout ici: la limite de temps
+    est imposée par scan_qr_pdf, qui exécute cette fonction dans le pool de
+    processus et tue les workers qui dépassent leur délai.
+    """
     out = []
 
-    signal.signal(signal.SIGALRM, _signal_handler)
-    signal.alarm(3)
+    def push(s):
+        s = (s or '').strip()
+        if s and len(s) >= 20 and s not in out:
+            out.append(s)
 
     try:
         det = cv2.QRCodeDetector()
 
-        def push(s):
-            s = (s or '').strip()
-            if s and len(s) >= 20 and s not in out:
-                out.append(s)
-
         try:
             s, _, _ = det.detectAndDecode(img_bgr)
             push(s)
@@ -458,18 +461,10 @@ def _low_level_decode(img_bgr):
         except Exception as e:
             logger.debug("pyzbar decode error: %s", e, exc_info=True)
 
-        signal.alarm(0)
-        return out
-
-    except TimeoutException:
-        logger.warning("QR decode timeout → abandon du scan")
-        signal.alarm(0)
-        return []
-
     except Exception as e:
         logger.error("Erreur QR: %s", e, exc_info=True)
-        signal.alarm(0)
-        return []
+
+    return out
 
 
 def _split_spc_lines(block: str):
@@ -793,6 +788,462 @@ def _select_best_spc(candidates):
     return best
 
 
+# ---------------------------------------------------------------------------
+# QR scanning engine (page-targeted, shared worker processes)
+# ---------------------------------------------------------------------------
+
+_SCAN_DPIS = (300, 600)
+_SCAN_WORKERS = config.getint(
+    'pl_cust', 'qr_scan_workers', default=min(4, os.cpu_count() or 1))
+# Nombre de scans simultanés (tous utilisateurs confondus); ils se
+# partagent les qr_scan_workers process du pool
+_SCAN_CONCURRENCY = config.getint(
+    'pl_cust', 'qr_scan_concurrency', default=_SCAN_WORKERS)
+# Délai max pour rendre + décoder une page, et pour un PDF complet
+_PAGE_TIMEOUT = config.getfloat('pl_cust', 'qr_page_timeout', default=10)
+_SCAN_TIMEOUT = config.getfloat('pl_cust', 'qr_scan_timeout', default=60)
+_POLL_INTERVAL = 0.2
+
+QrScanResult = namedtuple(
+    'QrScanResult', ['blocks', 'spc', 'page', 'dpi', 'timings'])
+
+_scan_slots = threading.BoundedSemaphore(_SCAN_CONCURRENCY)
+
+
+class _ScanPageError(Exception):
+    pass
+
+
+def _scan_worker_main(conn):
+    """
+    Boucle d'un process de scan: signale qu'il est prêt (imports faits),
+    puis traite une page à la fois jusqu'à la fermeture du pipe.
+    """
+    conn.send(('ready', None))
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        try:
+            result = ('ok', _scan_page(*task))
+        except Exception as e:
+            result = ('error', '%s: %s' % (type(e).__name__, e))
+        conn.send(result)
+
+
+class _ScanWorker(object):
+    """
+    Un process de scan et son pipe. Le délai d'une page ne part qu'une fois
+    le process prêt, pour ne pas compter son démarrage ('spawn' évite de
+    forker un serveur multi-thread).
+    """
+
+    def __init__(self):
+        ctx = multiprocessing.get_context('spawn')
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_scan_worker_main, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        self.spawned = time.monotonic()
+        self.ready = False
+        self.busy = False
+        self.started = None
+
+    def submit(self, data, page, dpi):
+        self.busy = True
+        self.started = time.monotonic() if self.ready else None
+        self.conn.send((data, page, dpi))
+
+    def poll(self):
+        """
+        Résultat de la page en cours, ou None si elle n'est pas finie.
+        Lève _ScanPageError si la page a échoué, EOFError/OSError si le
+        process est mort.
+        """
+        while self.conn.poll():
+            status, value = self.conn.recv()
+            if status == 'ready':
+                self.ready = True
+                if self.busy:
+                    self.started = time.monotonic()
+                continue
+            self.busy = False
+            self.started = None
+            if status == 'error':
+                raise _ScanPageError(value)
+            return value
+        return None
+
+    def overdue(self, now):
+        if not self.busy:
+            return False
+        if self.started is None:
+            return now - self.spawned > _SCAN_TIMEOUT
+        return now - self.started > _PAGE_TIMEOUT
+
+    def kill(self):
+        try:
+            self.process.kill()
+            self.process.join(1)
+        except Exception:
+            pass
+        self.conn.close()
+
+
+class _ScanWorkerPool(object):
+    """
+    Pool unique de qr_scan_workers process, partagé par tous les scans et
+    démarré une fois pour toutes: une page bloquée dans du code C (zbar,
+    OpenCV) ne peut être interrompue qu'en tuant son process, et seul ce
+    process est remplacé; les autres restent chauds.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._cond = threading.Condition()
+        self._idle = None
+
+    def acquire(self, timeout):
+        """Un worker libre, ou None si aucun ne se libère avant timeout."""
+        end = time.monotonic() + timeout
+        with self._cond:
+            if self._idle is None:
+                self._idle = [_ScanWorker() for _ in range(self.size)]
+            while True:
+                for worker in list(self._idle):
+                    worker = self._reclaim(worker)
+                    if worker is not None:
+                        return worker
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(min(remaining, _POLL_INTERVAL))
+
+    def _reclaim(self, worker):
+        """
+        Un worker rendu avec une page en cours (devenue inutile) n'est
+        réutilisable qu'une fois cette page finie ou son délai dépassé.
+        """
+        if worker.busy:
+            try:
+                worker.poll()
+            except _ScanPageError:
+                pass
+            except (EOFError, OSError):
+                self._idle.remove(worker)
+                return self.renew(worker)
+            if worker.busy:
+                if not worker.overdue(time.monotonic()):
+                    return None
+                self._idle.remove(worker)
+                return self.renew(worker)
+        self._idle.remove(worker)
+        return worker
+
+    def release(self, worker):
+        with self._cond:
+            self._idle.append(worker)
+            self._cond.notify()
+
+    def renew(self, worker):
+        """Tue un worker (bloqué ou mort) et retourne son remplaçant."""
+        worker.kill()
+        return _ScanWorker()
+
+
+_scan_workers = _ScanWorkerPool(_SCAN_WORKERS)
+
+
+def _scan_page_order(nb_pages):
+    """La QR-facture est presque toujours sur la dernière page."""
+    return list(range(nb_pages, 0, -1))
+
+
+def _scan_page(data, page, dpi):
+    """
+    Exécuté dans un process du pool: rend UNE page, décode d'abord le tiers
+    inférieur (section paiement) puis la page entière si nécessaire.
+    Retourne (page, dpi, blocks, timings).
+    """
+    timings = {}
+    t0 = time.perf_counter()
+    images = convert_from_bytes(data, dpi=dpi, first_page=page, last_page=page,
+        timeout=_PAGE_TIMEOUT)
+    timings['render'] = time.perf_counter() - t0
+    if not images:
+        return page, dpi, [], timings
+
+    t0 = time.perf_counter()
+    img = np.array(images[0].convert("RGB"))[:, :, ::-1]
+    height = img.shape[0]
+    blocks = []
+    for region in (img[height * 2 // 3:], img):
+        for b in _low_level_decode(region):
+            b = _clean_qr_text(b)
+            if b and b not in blocks:
+                blocks.append(b)
+        if any(is_valid_spc_block(b) for b in blocks):
+            break
+    timings['decode'] = time.perf_counter() - t0
+    return page, dpi, blocks, timings
+
+
+def _pdf_page_count(data):
+    try:
+        info = pdfinfo_from_bytes(data, timeout=_PAGE_TIMEOUT)
+        return int(info.get('Pages') or 1)
+    except Exception as e:
+        logger.warning("pdfinfo impossible (%s) → 1 page supposée", e)
+        return 1
+
+
+def _scan_pass(data, pages, dpi, collect, deadline, max_workers):
+    """
+    Répartit les pages sur les workers du pool partagé, un worker par page
+    en cours et au plus max_workers: un scan n'attend un worker que s'il
+    n'a plus rien en cours, sinon il se contente de ceux qui sont libres. Une page qui dépasse
+    _PAGE_TIMEOUT est abandonnée et seul son worker est remplacé; une page
+    dont le worker meurt est resoumise une fois.
+    """
+    queue = list(pages)
+    retried = set()
+    running = {}
+    try:
+        while queue or running:
+            while queue and len(running) < max_workers:
+                timeout = (max(deadline - time.monotonic(), 0)
+                    if not running else 0)
+                worker = _scan_workers.acquire(timeout)
+                if worker is None:
+                    break
+                page = queue.pop(0)
+                try:
+                    worker.submit(data, page, dpi)
+                except OSError:
+                    _scan_workers.release(_scan_workers.renew(worker))
+                    queue.insert(0, page)
+                    continue
+                running[worker] = page
+            if not running:
+                logger.warning("QR scan: aucun worker libre avant le délai "
+                    "global (%ss)", _SCAN_TIMEOUT)
+                return None
+
+            multiprocessing.connection.wait(
+                [w.conn for w in running], timeout=_POLL_INTERVAL)
+            now = time.monotonic()
+            for worker, page in list(running.items()):
+                try:
+                    result = worker.poll()
+                except _ScanPageError as e:
+                    logger.error("Erreur scan page %s (%s dpi): %s",
+                        page, dpi, e)
+                    del running[worker]
+                    _scan_workers.release(worker)
+                    continue
+                except (EOFError, OSError):
+                    del running[worker]
+                    _scan_workers.release(_scan_workers.renew(worker))
+                    if page in retried:
+                        logger.error("QR scan: worker mort sur la page %s "
+                            "(%s dpi) → page abandonnée", page, dpi)
+                    else:
+                        logger.warning("QR scan: worker mort sur la page %s "
+                            "(%s dpi) → nouvelle tentative", page, dpi)
+                        retried.add(page)
+                        queue.append(page)
+                    continue
+                if result is not None:
+                    del running[worker]
+                    _scan_workers.release(worker)
+                    found = collect(result)
+                    if found:
+                        return found
+                elif worker.overdue(now):
+                    logger.warning("QR scan: page %s (%s dpi) > %ss → abandon",
+                        page, dpi, _PAGE_TIMEOUT)
+                    del running[worker]
+                    _scan_workers.release(_scan_workers.renew(worker))
+
+            if time.monotonic() > deadline:
+                logger.warning("QR scan: délai global dépassé (%ss)",
+                    _SCAN_TIMEOUT)
+                return None
+    finally:
+        # pages encore en cours (trouvé ailleurs, délai): le pool attend
+        # qu'elles finissent avant de redonner ces workers
+        for worker in running:
+            _scan_workers.release(worker)
+    return None
+
+
+def _acquire_scan_slot():
+    if not _scan_slots.acquire(timeout=_SCAN_TIMEOUT):
+        raise QrInvoiceError(
+            "Trop de lectures QR en cours, veuillez réessayer.")
+
+
+def scan_qr_pdf(data, slot=True, max_workers=_SCAN_WORKERS):
+    """
+    Cherche un bloc SPC dans le PDF: dernières pages d'abord, pages décodées
+    en parallèle, arrêt au premier bloc SPC valide. 600 dpi seulement si
+    rien de valide à 300 dpi.
+    slot=False: l'appelant (import par lot) tient déjà un slot de scan pour
+    tous ses fichiers.
+    """
+    timings = {'wait': 0.0, 'pdfinfo': 0.0, 'render': 0.0, 'decode': 0.0,
+        'total': 0.0}
+    start = time.perf_counter()
+    if slot:
+        _acquire_scan_slot()
+    timings['wait'] = time.perf_counter() - start
+    deadline = time.monotonic() + _SCAN_TIMEOUT
+    try:
+        t0 = time.perf_counter()
+        nb_pages = _pdf_page_count(data)
+        timings['pdfinfo'] = time.perf_counter() - t0
+        order = _scan_page_order(nb_pages)
+
+        blocks = []
+
+        def collect(result):
+            page, dpi, page_blocks, page_timings = result
+            timings['render'] += page_timings.get('render', 0.0)
+            timings['decode'] += page_timings.get('decode', 0.0)
+            for b in page_blocks:
+                if b not in blocks:
+                    blocks.append(b)
+            for b in page_blocks:
+                if is_valid_spc_block(b):
+                    return QrScanResult(blocks, b, page, dpi, timings)
+            return None
+
+        found = None
+        for dpi in _SCAN_DPIS:
+            logger.info("Lecture QR à %s dpi, pages %s", dpi, order)
+            found = _scan_pass(
+                data, order, dpi, collect, deadline, max_workers)
+            if found or time.monotonic() > deadline:
+                break
+    finally:
+        if slot:
+            _scan_slots.release()
+
+    timings['total'] = time.perf_counter() - start
+    logger.info(
+        "QR scan: %d page(s), trouvé=%s (page %s, %s dpi), wait=%.3fs "
+        "pdfinfo=%.3fs render=%.3fs decode=%.3fs total=%.3fs",
+        nb_pages, bool(found),
+        found.page if found else None, found.dpi if found else None,
+        timings['wait'], timings['pdfinfo'], timings['render'],
+        timings['decode'], timings['total'])
+    if found:
+        return found._replace(blocks=blocks)
+    return QrScanResult(blocks, None, None, None, timings)
+
+
+# ---------------------------------------------------------------------------
+# Cache of decoded QR payloads (keyed by SHA-256 of the PDF)
+# ---------------------------------------------------------------------------
+
+def _pdf_sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class QrScanCache(ModelSQL, ModelView):
+    __name__ = 'pl_cust_account.qr_scan_cache'
+
+    sha256 = fields.Char("SHA-256", required=True, readonly=True)
+    filename = fields.Char("Nom du fichier", readonly=True)
+    parsed = fields.Text("SPC décodé (JSON)", readonly=True)
+    page = fields.Integer("Page", readonly=True)
+    dpi = fields.Integer("DPI", readonly=True)
+    hits = fields.Integer("Imports", readonly=True,
+        help="Nombre de factures créées à partir de ce PDF.")
+    invoice = fields.Many2One(
+        'account.invoice', "Facture créée", readonly=True,
+        ondelete='SET NULL')
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints = [
+            (
+                "sha256_uniq",
+                Unique(t, t.sha256),
+                "Ce PDF est déjà présent dans le cache QR.",
+            ),
+        ]
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @staticmethod
+    def default_hits():
+        return 0
+
+    @classmethod
+    def lookup(cls, data):
+        """Retourne l'entrée du cache pour ces octets PDF (ou None)."""
+        res = cls.search([('sha256', '=', _pdf_sha256(data))], limit=1)
+        if not res:
+            return None
+        entry, = res
+        logger.info("QR cache hit: %s (page %s, %s dpi, facture=%s)",
+            entry.sha256[:12], entry.page, entry.dpi,
+            entry.invoice.id if entry.invoice else None)
+        return entry
+
+    @classmethod
+    def store(cls, data, filename, parsed, page, dpi):
+        """
+        Enregistre le décodage dans sa propre transaction: le cache reste
+        valable même si l'import est annulé. Si un autre utilisateur a déjà
+        enregistré le même PDF (contrainte unique sur sha256), on garde sa
+        ligne au lieu de faire échouer la lecture.
+        """
+        sha256 = _pdf_sha256(data)
+        with Transaction().new_transaction() as transaction:
+            if cls.search([('sha256', '=', sha256)], limit=1):
+                return
+            try:
+                cls.create([{
+                    'sha256': sha256,
+                    'filename': filename,
+                    'parsed': json.dumps(parsed),
+                    'page': page,
+                    'dpi': dpi,
+                }])
+                transaction.commit()
+            except (DatabaseIntegrityError, SQLConstraintError):
+                transaction.rollback()
+                logger.info("QR cache: %s déjà enregistré par une autre "
+                    "lecture", sha256[:12])
+
+    @classmethod
+    def link_invoice(cls, data, invoice):
+        "Une lecture ne compte que si elle aboutit à une facture"
+        entries = cls.search([('sha256', '=', _pdf_sha256(data))])
+        for entry in entries:
+            cls.write([entry], {
+                'invoice': invoice.id,
+                'hits': (entry.hits or 0) + 1,
+            })
+
+    def get_parsed(self):
+        return json.loads(self.parsed or '{}')
+
+    @property
+    def duplicate_warning(self):
+        if self.invoice:
+            return "Ce PDF a déjà été importé (facture %s)." % (
+                self.invoice.rec_name)
+        return "Ce PDF a déjà été importé (facture supprimée depuis)."
+
+
 # ---------------------------------------------------------------------------
 # Wizard models
 # ---------------------------------------------------------------------------
@@ -863,6 +1314,9 @@ class QrInvoiceConfirm(ModelView):
     qr_amount = fields.Char("Montant QR")
     qr_reference = fields.Char("Référence QR")
     supplier_name = fields.Char("Tiers détecté")
+    duplicate_warning = fields.Char("Doublon probable", readonly=True)
+    duplicate_invoice = fields.Many2One(
+        'account.invoice', "Facture existante", readonly=True)
 
 
 class QrInvoiceWizard(Wizard):
@@ -897,6 +1351,7 @@ class QrInvoiceWizard(Wizard):
         self._pdf_filename = None
         self._pdf_bytes = None
         self._parsed = {}
+        self._cache = None
 
     # ---------------------------
     # Step 1: Read and parse QR
@@ -909,9 +1364,8 @@ class QrInvoiceWizard(Wizard):
         self._parsed = {}
         self._pdf_bytes = None
         self._pdf_filename = None
-
-        blocks = []
-        tried_dpi = []
+        self._cache = None
+        ScanCache = Pool().get('pl_cust_account.qr_scan_cache')
 
         try:
             # -------------------------------------------------
@@ -934,31 +1388,19 @@ class QrInvoiceWizard(Wizard):
             self._pdf_filename = filename
 
             # -------------------------------------------------
-            # 2) Decode QR (300 dpi -> 600 dpi fallback)
+            # 2) Same PDF already decoded → cache
             # -------------------------------------------------
-            for dpi in (300, 600):
-                logger.info("Tentative lecture QR à %s dpi", dpi)
-                try:
-                    pages = convert_from_bytes(data, dpi=dpi)
-                except Exception as e:
-                    logger.error(
-                        "Erreur convert_from_bytes(%s dpi): %s",
-                        dpi, e, exc_info=True
-                    )
-                    continue
-
-                tried_dpi.append(dpi)
-                logger.info("%d pages converties en %s dpi", len(pages), dpi)
-
-                for page in pages:
-                    img = np.array(page.convert("RGB"))[:, :, ::-1]
-                    decoded = _low_level_decode(img)
-                    if decoded:
-                        blocks.extend(decoded)
+            self._cache = ScanCache.lookup(data)
+            if self._cache:
+                self._parsed = self._cache.get_parsed()
+                self._inject_amount()
+                return "confirm"
 
-                if blocks:
-                    logger.info("QR détecté avec succès à %s dpi", dpi)
-                    break
+            # -------------------------------------------------
+            # 2b) Decode QR (dernières pages d'abord, en parallèle)
+            # -------------------------------------------------
+            scan = scan_qr_pdf(data)
+            blocks = scan.blocks
 
             # -------------------------------------------------
             # 3) No QR found → manual mode
@@ -966,15 +1408,13 @@ class QrInvoiceWizard(Wizard):
             if not blocks:
                 logger.warning(
                     "Aucun QR détecté (essayé en %s dpi) → passage en mode manuel.",
-                    ", ".join(str(d) for d in (tried_dpi or (300, 600))),
+                    ", ".join(str(d) for d in _SCAN_DPIS),
                 )
                 return "confirm"
 
             # -------------------------------------------------
-            # 4) Normalize & debug QR blocks
+            # 4) Debug QR blocks
             # -------------------------------------------------
-            blocks = [_clean_qr_text(b) for b in blocks if b]
-
             logger.info("blocks=%d", len(blocks))
             for i, b in enumerate(blocks[:3]):
                 logger.info("block[%d] repr=%r", i, b[:200])
@@ -1007,22 +1447,13 @@ class QrInvoiceWizard(Wizard):
                 self._parsed.get("amount"),
             )
 
+            ScanCache.store(
+                data, filename, self._parsed, scan.page, scan.dpi)
+
             # -------------------------------------------------
             # 7) IMPORTANT: inject values directly into confirm
             # -------------------------------------------------
-            if hasattr(self, 'confirm'):
-                raw_amt = (self._parsed.get("amount") or "").strip()
-                try:
-                    amt = Decimal(
-                        raw_amt.replace("'", "").replace(" ", "").replace(",", ".")
-                    ) if raw_amt else Decimal("0")
-                except Exception:
-                    amt = Decimal("0")
-
-                self.confirm.total_amount = amt
-                self.confirm.qr_amount = raw_amt
-                self.confirm.iban = self._parsed.get("iban") or ""
-
+            self._inject_amount()
             return "confirm"
 
         except QrInvoiceError:
@@ -1039,6 +1470,20 @@ class QrInvoiceWizard(Wizard):
             )
 
 
+    def _inject_amount(self):
+        if hasattr(self, 'confirm'):
+            raw_amt = (self._parsed.get("amount") or "").strip()
+            try:
+                amt = Decimal(
+                    raw_amt.replace("'", "").replace(" ", "").replace(",", ".")
+                ) if raw_amt else Decimal("0")
+            except Exception:
+                amt = Decimal("0")
+
+            self.confirm.total_amount = amt
+            self.confirm.qr_amount = raw_amt
+            self.confirm.iban = self._parsed.get("iban") or ""
+
     # ---------------------------
     # Step 2: Create supplier invoice
     # ---------------------------
@@ -1251,6 +1696,8 @@ class QrInvoiceWizard(Wizard):
                     "Impossible d'enregistrer le PDF. "
                     "Vérifiez les droits d'accès au stockage."
                 ) from exc
+            ScanCache = pool.get('pl_cust_account.qr_scan_cache')
+            ScanCache.link_invoice(pdf_bytes, invoice)
         else:
             logger.info("Aucun PDF à attacher (aucune source disponible).")
 
@@ -1352,8 +1799,15 @@ class QrInvoiceWizard(Wizard):
             "full_text": p.get("full_text") or "",
             "pdf_data": getattr(self, "_pdf_bytes", None),
             "qr_filename": (self.start.qr_filename or getattr(self, "_pdf_filename", "") or "").strip(),
+            "duplicate_warning": None,
+            "duplicate_invoice": None,
         }
 
+        cache = getattr(self, "_cache", None)
+        if cache and (cache.hits or cache.invoice):
+            res["duplicate_warning"] = cache.duplicate_warning
+            res["duplicate_invoice"] = cache.invoice.id if cache.invoice else None
+
         # Copy accounting defaults from party if present
         for field in (
             "default_category_account_expense",
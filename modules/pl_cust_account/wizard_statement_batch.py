@@ -0,0 +1,409 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+
+from trytond.wizard import Wizard, StateView, StateTransition, StateAction, Button
+from trytond.model import ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import PYSONEncoder
+from trytond.transaction import Transaction
+from trytond.modules.account_statement.exceptions import ImportStatementError
+
+from trytond.config import config
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from decimal import Decimal
+import io
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import zipfile
+
+from .account import STAT_FIELDS, get_ref_fmt, parse_camt
+from .wizard_qr_batch import _SpoolArchiver, _spool_path
+from .wizard_qr_invoice import _decode_binary_input
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'PLImportStatementBatchStart', 'PLImportStatementBatchResult',
+    'PLImportStatementBatch',
+]
+
+
+# ---------------------------------------------------------------------------
+# Sources: XML, ZIP upload or server-side spool directory
+# ---------------------------------------------------------------------------
+
+def _is_camt(name):
+    return name.lower().endswith('.xml')
+
+
+def _read_upload(data, filename):
+    if not zipfile.is_zipfile(io.BytesIO(data)):
+        return [(filename or 'camt.xml', data)]
+    files = []
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        for info in zf.infolist():
+            if info.is_dir() or not _is_camt(info.filename):
+                continue
+            files.append((info.filename, zf.read(info)))
+    return files
+
+
+def _read_spool(directory):
+    if not os.path.isdir(directory):
+        raise ImportStatementError(
+            "Répertoire introuvable sur le serveur: %s" % directory)
+    files = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and _is_camt(name):
+            with open(path, 'rb') as f:
+                files.append((name, f.read()))
+    return files
+
+
+# ---------------------------------------------------------------------------
+# Parsing: no database access, run in a dedicated process pool
+# ---------------------------------------------------------------------------
+
+def _parse_file(data):
+    """
+    Les exceptions Tryton ne se transmettent pas entre processus: l'erreur
+    est rendue sous forme de texte.
+    """
+    try:
+        header, records = parse_camt(data)
+    except ImportStatementError as e:
+        return None, None, getattr(e, 'message', None) or str(e)
+    except Exception as e:
+        return None, None, "Fichier CAMT illisible: %s" % e
+    return header, records, None
+
+
+_PARSE_WORKERS = config.getint(
+    'pl_cust', 'statement_import_workers', default=min(4, os.cpu_count() or 1))
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def _get_parse_pool(broken=None):
+    """
+    Pool de processus des lectures CAMT, distinct de celui des scans QR.
+    'spawn' évite de forker un serveur multi-thread. Un pool cassé
+    (`broken`) est remplacé.
+    """
+    global _parse_pool
+    with _parse_pool_lock:
+        if broken is not None and _parse_pool is broken:
+            broken.shutdown(wait=False, cancel_futures=True)
+            _parse_pool = None
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(
+                max_workers=_PARSE_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'))
+        return _parse_pool
+
+
+def parse_files(files):
+    """
+    Lit les fichiers [(nom, contenu)] en parallèle.
+    Retourne {nom: (header, records, erreur)}.
+    """
+    parsed = {}
+    if len(files) > 1:
+        pool = _get_parse_pool()
+        try:
+            futures = [(name, pool.submit(_parse_file, data))
+                for name, data in files]
+            for name, future in futures:
+                parsed[name] = future.result()
+        except BrokenProcessPool:
+            logger.warning("Pool CAMT cassé, lecture dans le processus")
+            _get_parse_pool(broken=pool)
+    for name, data in files:
+        if name not in parsed:
+            parsed[name] = _parse_file(data)
+    return parsed
+
+
+# ---------------------------------------------------------------------------
+# Wizard models
+# ---------------------------------------------------------------------------
+
+class PLImportStatementBatchStart(ModelView):
+    "ProLibre Statement Batch Import Start"
+    __name__ = 'pl_cust_account.statement.import.batch.start'
+
+    company = fields.Many2One('company.company', "Company", required=True)
+    file_ = fields.Binary("Fichier CAMT ou archive ZIP", filename='filename')
+    filename = fields.Char("Nom du fichier")
+    spool_dir = fields.Char("Répertoire serveur",
+        help="Relatif à la racine configurée (pl_cust.spool_root). Les "
+        "fichiers traités sont déplacés dans les sous-répertoires done/ et "
+        "error/ après l'enregistrement des relevés.")
+
+    @classmethod
+    def default_company(cls):
+        return Transaction().context.get('company')
+
+
+class PLImportStatementBatchResult(ModelView):
+    "ProLibre Statement Batch Import Result"
+    __name__ = 'pl_cust_account.statement.import.batch.result'
+
+    nb_files = fields.Integer("Fichiers importés", readonly=True)
+    nb_duplicates = fields.Integer("Doublons", readonly=True)
+    nb_errors = fields.Integer("Fichiers en erreur", readonly=True)
+    nb_lines = fields.Integer("Nb Payments", readonly=True)
+    nb_matched = fields.Integer("Matched", readonly=True)
+    nb_overpaid = fields.Integer("Overpaid", readonly=True)
+    nb_to_check = fields.Integer("To Check", readonly=True)
+    nb_unmatched = fields.Integer("Unmatched", readonly=True)
+    report = fields.Text("Rapport", readonly=True)
+    statements = fields.Many2Many(
+        'account.statement', None, None, "Statements", readonly=True)
+
+
+class PLImportStatementBatch(Wizard):
+    "ProLibre Statement Batch Import"
+    __name__ = 'pl_cust_account.statement.import.batch'
+
+    start = StateView(
+        'pl_cust_account.statement.import.batch.start',
+        'pl_cust_account.statement_import_batch_start_view_form',
+        [
+            Button("Cancel", 'end', 'tryton-cancel'),
+            Button("Import", 'import_', 'tryton-ok', default=True),
+        ]
+    )
+
+    import_ = StateTransition()
+
+    result = StateView(
+        'pl_cust_account.statement.import.batch.result',
+        'pl_cust_account.statement_import_batch_result_view_form',
+        [
+            Button("Close", 'end', 'tryton-close'),
+            Button("Ouvrir les relevés", 'open_statements', 'tryton-ok',
+                default=True),
+        ]
+    )
+
+    open_statements = StateAction('account_statement.act_statement_form')
+
+    def get_files(self):
+        s = self.start
+        spool_dir = (s.spool_dir or '').strip()
+        if s.file_:
+            filename, data = _decode_binary_input(s.file_)
+            files = _read_upload(data, s.filename or filename)
+            spool_dir = None
+        elif spool_dir:
+            spool_dir = _spool_path(spool_dir, ImportStatementError)
+            files = _read_spool(spool_dir)
+        else:
+            raise ImportStatementError(
+                "Aucun fichier ni répertoire indiqué.")
+        if not files:
+            raise ImportStatementError("Aucun fichier CAMT à importer.")
+        return files, spool_dir
+
+    def get_statements(self, headers):
+        """
+        Relevé de destination de chaque IBAN: le dernier relevé brouillon du
+        journal de ce compte bancaire, sinon un nouveau relevé.
+        Retourne {iban: relevé ou message d'erreur}; les nouveaux relevés ne
+        sont pas encore enregistrés et portent déjà leurs totaux, ceux des
+        brouillons existants sont mis à jour par add_totals.
+        """
+        pool = Pool()
+        Journal = pool.get('account.statement.journal')
+        Statement = pool.get('account.statement')
+        Date_ = pool.get('ir.date')
+
+        company = self.start.company
+        statements = {}
+        for header, records in headers:
+            iban = header['iban']
+            if iban in statements:
+                statement = statements[iban]
+                if isinstance(statement, Statement) and not statement.id:
+                    statement.end_balance += sum(
+                        Decimal(r['amount']) for r in records)
+                    statement.total_amount = statement.end_balance \
+                        - statement.start_balance
+                    statement.number_of_lines += len(records)
+                continue
+            journal = Journal.get_by_bank_account(company, iban)
+            if not journal:
+                statements[iban] = "Aucun journal de relevé pour %s" % iban
+                continue
+            drafts = Statement.search([
+                    ('company', '=', company.id),
+                    ('journal', '=', journal.id),
+                    ('state', '=', 'draft'),
+                    ], order=[('date', 'DESC'), ('id', 'DESC')], limit=1)
+            if drafts:
+                statements[iban], = drafts
+                continue
+            last = Statement.search([
+                    ('company', '=', company.id),
+                    ('journal', '=', journal.id),
+                    ], order=[('date', 'DESC'), ('id', 'DESC')], limit=1)
+            start_balance = (last[0].end_balance or Decimal(0)
+                if last else Decimal(0))
+            total = sum(Decimal(r['amount']) for r in records)
+            date = (datetime.strptime(header['date'], '%Y-%m-%d').date()
+                if header['date'] else Date_.today())
+            statements[iban] = Statement(
+                name=header['id'] or header['msg_id'],
+                company=company,
+                journal=journal,
+                date=date,
+                start_balance=start_balance,
+                end_balance=start_balance + total,
+                total_amount=total,
+                number_of_lines=len(records),
+                )
+        return statements
+
+    @classmethod
+    def add_totals(cls, batches):
+        """
+        Ajoute en une écriture les montants et nombres de lignes importés
+        aux brouillons existants, comme pour un nouveau relevé, pour que le
+        contrôle de solde passe à la validation.
+        """
+        Statement = Pool().get('account.statement')
+        totals = {}
+        for statement, _, records, _ in batches:
+            amount, count = totals.get(statement, (Decimal(0), 0))
+            totals[statement] = (
+                amount + sum(Decimal(r['amount']) for r in records),
+                count + len(records))
+        args = []
+        for statement, (amount, count) in totals.items():
+            args.extend(([statement], {
+                        'end_balance': (statement.end_balance or Decimal(0))
+                        + amount,
+                        'total_amount': (statement.total_amount or Decimal(0))
+                        + amount,
+                        'number_of_lines': (statement.number_of_lines or 0)
+                        + count,
+                        }))
+        if args:
+            Statement.write(*args)
+
+    def transition_import_(self):
+        pool = Pool()
+        Statement = pool.get('account.statement')
+        File = pool.get('pl_cust_account.statement.import.file')
+        ImportStatement = pool.get(
+            'pl_cust_account.statement.import', type='wizard')
+
+        start_time = time.perf_counter()
+        ref_fmt = get_ref_fmt()
+        files, spool_dir = self.get_files()
+
+        # 1) lecture en parallèle, sans accès à la base
+        t0 = time.perf_counter()
+        parsed = parse_files(files)
+        parse_time = time.perf_counter() - t0
+
+        # 2) doublons (déjà importés ou deux fois dans le lot) et routage
+        errors, duplicates, to_import = {}, {}, []
+        msg_ids = {File.get_msg_id(h): name
+            for name, (h, _, error) in parsed.items() if not error}
+        known = {f.msg_id: f for f in File.search(
+                [('msg_id', 'in', list(msg_ids))])}
+        seen = {}
+        for name, _ in files:
+            header, records, error = parsed[name]
+            if error:
+                errors[name] = error
+                continue
+            msg_id = File.get_msg_id(header)
+            if msg_id in known:
+                duplicates[name] = "déjà importé dans %s" % (
+                    known[msg_id].statement.rec_name)
+            elif msg_id in seen:
+                duplicates[name] = "doublon de %s dans le lot" % seen[msg_id]
+            else:
+                seen[msg_id] = name
+                to_import.append(name)
+
+        statements = self.get_statements(
+            [parsed[name][:2] for name in to_import])
+        batches = []
+        for name in to_import:
+            header, records, _ = parsed[name]
+            statement = statements[header['iban']]
+            if isinstance(statement, str):
+                errors[name] = statement
+                continue
+            batches.append((statement, header, records, name))
+
+        # 3) écriture groupée: nouveaux relevés, puis origines, lignes et
+        # fichiers de tous les relevés
+        t0 = time.perf_counter()
+        self.add_totals([b for b in batches if b[0].id])
+        Statement.save([s for s in statements.values()
+                if isinstance(s, Statement) and not s.id])
+        all_stats = ImportStatement.camt_import(batches, ref_fmt)
+        write_time = time.perf_counter() - t0
+
+        if spool_dir:
+            archiver = Transaction().join(_SpoolArchiver(spool_dir))
+            for name, _ in files:
+                archiver.add(name, name not in errors)
+
+        totals = dict.fromkeys(STAT_FIELDS, 0)
+        imported = {}
+        for (statement, _, _, name), stats in zip(batches, all_stats):
+            imported[name] = (statement, stats)
+            for field in STAT_FIELDS:
+                totals[field] += stats[field]
+        report = []
+        for name, _ in files:
+            if name in imported:
+                statement, stats = imported[name]
+                report.append("OK      %s → %s (%s paiements, %s rapprochés, "
+                    "%s non trouvés)" % (name, statement.rec_name,
+                        stats['nb_lines'], stats['nb_matched']
+                        + stats['nb_overpaid'], stats['nb_unmatched']))
+            elif name in duplicates:
+                report.append("DOUBLON %s: %s" % (name, duplicates[name]))
+            else:
+                report.append("ERREUR  %s: %s" % (name, errors.get(name)))
+        report.append('')
+        report.append(
+            "Lecture: %.1fs, écriture: %.1fs, total: %.1fs" % (
+                parse_time, write_time, time.perf_counter() - start_time))
+        logger.info("Import CAMT batch: %d ok, %d doublons, %d erreurs (%s)",
+            len(imported), len(duplicates), len(errors), report[-1])
+
+        self.result.statements = list({s for s, _, _, _ in batches})
+        self.result.nb_files = len(imported)
+        self.result.nb_duplicates = len(duplicates)
+        self.result.nb_errors = len(errors)
+        for field in STAT_FIELDS:
+            setattr(self.result, field, totals[field])
+        self.result.report = "\n".join(report)
+        return 'result'
+
+    def default_result(self, fields):
+        values = {name: getattr(self.result, name, None) for name in fields}
+        values['statements'] = [
+            s.id for s in getattr(self.result, 'statements', [])]
+        return values
+
+    def do_open_statements(self, action):
+        ids = [s.id for s in self.result.statements]
+        action['pyson_domain'] = PYSONEncoder().encode([('id', 'in', ids)])
+        return action, {}
@@ -11,6 +11,7 @@ from trytond.pyson import Date
 from datetime import datetime, timedelta
 
 from trytond.model.exceptions import ValidationError
+from trytond.modules.pl_cust_plbase.attachment import AttachmentMixin
 
 
 class EmployeValidationError(ValidationError):
@@ -116,7 +117,7 @@ class FolldersFollowTasks(ModelSQL, ModelView):
                 ('foldersfollow',) + tuple(clause[1:]),
                 ]
 
-class FoldersFollow(DeactivableMixin, Workflow, ModelSQL, ModelView):
+class FoldersFollow(AttachmentMixin, DeactivableMixin, Workflow, ModelSQL, ModelView):
     'FoldersFollow'
     __name__ = 'pl_cust_foldersfollow.foldersfollow'
     name = fields.Char('Number', required=False, readonly=False)
@@ -232,20 +233,8 @@ class FoldersFollow(DeactivableMixin, Workflow, ModelSQL, ModelView):
     ], "Fréquence")
     frequency_string = frequency.translated('Fréquence')
 
-    as_attachment = fields.Function(fields.Boolean('pj'), 'get_as_attachement')
     resp = fields.Many2One('company.employee', 'Resp',)
     
-    @classmethod
-    def get_as_attachement(cls, folders, name):
-        pool = Pool()
-        ATTACH = pool.get('ir.attachment')
-
-        res = {i.id: False for i in folders}
-        for inv in folders : 
-            if ATTACH.search([('resource', '=', inv)]) :
-                res[inv.id] = True
-        return res
-
     @classmethod
     def __setup__(cls):
         super().__setup__()
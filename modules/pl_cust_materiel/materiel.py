@@ -16,6 +16,7 @@ from trytond.model import (
 from trytond.pyson import Bool, Eval, If, Or
 from trytond.transaction import Transaction
 from trytond.model.exceptions import ValidationError
+from trytond.modules.pl_cust_plbase.attachment import AttachmentMixin
 from datetime import datetime, time
 
 __all__ = ["Atelier", "LieuManif", "Materiel", "Location", "Manifestation", "Logs", "MatDay", "MatDayList"]
@@ -201,7 +202,7 @@ class Atelier(ModelSQL, ModelView):
             ("name", "DESC"),
         ]
 
-class Materiel(ModelSQL, ModelView):
+class Materiel(AttachmentMixin, ModelSQL, ModelView):
     "Materiel"
     __name__ = "pl_cust_materiel.materiel"
 
@@ -213,18 +214,6 @@ class Materiel(ModelSQL, ModelView):
     locations = fields.One2Many("pl_cust_materiel.location", "materiel", "Locations", readonly=True)
     logs = fields.One2Many("pl_cust_materiel.logs", "materiel", "Logs", readonly=True)
     color = fields.Function(fields.Char("Couleur"), 'get_color')
-    as_attachment = fields.Function(fields.Boolean('pj'), 'get_as_attachement')
-
-    @classmethod
-    def get_as_attachement(cls, invoices, name):
-        pool = Pool()
-        ATTACH = pool.get('ir.attachment')
-
-        res = {i.id: False for i in invoices}
-        for inv in invoices : 
-            if ATTACH.search([('resource', '=', inv)]) :
-                res[inv.id] = True
-        return res
 
     def get_color(self, name):
         if self.id:
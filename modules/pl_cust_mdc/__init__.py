@@ -8,6 +8,7 @@ from .mdc_inst import *
 from .wizard_createinv import *
 from .wiz_gen_days import *
 from . import user
+from . import mail_queue
 from . import routes
 
 __all__ = ["register", "routes"]
@@ -27,6 +28,8 @@ def register():
         MDCGiftVoucher,
         MDCBookingInst,
         user.UserApplication,
+        mail_queue.MDCMail,
+        mail_queue.Cron,
         module="pl_cust_mdc",
         type_="model",
     )
@@ -0,0 +1,105 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import hashlib
+import json
+
+from werkzeug.wrappers import Response
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import fields
+from trytond.model.exceptions import ValidationError
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from sql.conditionals import Coalesce
+
+__all__ = [
+    "AvailabilityMixin",
+    "ReservationMixin",
+    "CapacityExceeded",
+    "clear_availability",
+    "availability_response",
+]
+
+
+class CapacityExceeded(ValidationError):
+    pass
+
+
+# Réponses JSON des routes get_pub_date / get_inst_date.
+# Cache trytond: vidé à chaque modification d'un jour ou d'une réservation,
+# l'invalidation est propagée aux autres process au commit.
+_availability_cache = Cache(
+    "pl_cust_mdc.availability",
+    duration=config.getint("pl_cust", "availability_ttl", default=30),
+    context=False,
+)
+
+
+def clear_availability():
+    _availability_cache.clear()
+
+
+class AvailabilityMixin(object):
+    "Vide le cache de disponibilités à chaque create/write/delete"
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        clear_availability()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        clear_availability()
+
+    @classmethod
+    def delete(cls, records):
+        super().delete(records)
+        clear_availability()
+
+
+class ReservationMixin(object):
+    "Verrou par jour pour réserver des places sans sur-réservation"
+
+    reservation_seq = fields.Integer("Reservation Seq", readonly=True)
+
+    @classmethod
+    def _lock_day(cls, day):
+        """
+        Incrémente reservation_seq du jour. L'UPDATE pose un verrou de ligne
+        tenu jusqu'au commit: les réservations concurrentes du même jour
+        attendent, puis échouent en erreur de sérialisation et sont rejouées
+        par with_transaction avec un instantané qui voit la réservation déjà
+        créée. Les autres jours ne sont pas bloqués.
+        """
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(
+            *table.update(
+                [table.reservation_seq],
+                [Coalesce(table.reservation_seq, 0) + 1],
+                where=table.id == day.id,
+            )
+        )
+
+
+def availability_response(request, kind, build):
+    """
+    Sert la liste `kind` depuis le cache (ou la calcule avec `build()`),
+    avec ETag: un client à jour reçoit 304 sans que les jours soient relus.
+    """
+    Date = Pool().get("ir.date")
+    key = (kind, Date.today().isoformat())
+    cached = _availability_cache.get(key)
+    if cached is None:
+        body = json.dumps(build())
+        etag = '"{}"'.format(hashlib.sha1(body.encode("utf-8")).hexdigest())
+        cached = (etag, body)
+        _availability_cache.set(key, cached)
+    etag, body = cached
+
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("If-None-Match", ""):
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype="application/json", headers=headers)
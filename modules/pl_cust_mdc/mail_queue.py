@@ -0,0 +1,324 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import logging
+import mimetypes
+import smtplib
+import threading
+from datetime import datetime, timedelta
+
+from email.encoders import encode_base64
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.nonmultipart import MIMENonMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate
+
+from trytond.config import config
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval, If
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["MDCMail", "Cron"]
+
+MAIL_FROM = "noreply@mdc-reg.ch"
+MAIL_FALLBACK_TO = "nguyen@prolibre.com"
+SMTP_HOST = config.get("pl_cust", "smtp_host", default="mail.infomaniak.com")
+SMTP_PORT = config.getint("pl_cust", "smtp_port", default=587)
+SMTP_TLS = config.getboolean("pl_cust", "smtp_tls", default=True)
+SMTP_USER = config.get("pl_cust", "smtp_user", default="noreply@mdc-reg.ch")
+SMTP_PASSWORD = config.get("pl_cust", "smtp_password")
+SMTP_TIMEOUT = config.getint("pl_cust", "smtp_timeout", default=30)
+
+MAX_ATTEMPTS = 8
+BATCH_SIZE = 50
+
+State = [
+    ("pending", "Pending"),
+    ("sent", "Sent"),
+    ("error", "Error"),
+]
+
+TICKET_BODY = """Bonjour,
+
+Veuillez trouvez ci-joint votre billet pour la maison de la créativité.
+
+Au plaisir de vous voir,
+"""
+
+VOUCHER_BODY = """Bonjour,
+
+Veuillez trouvez ci-joint votre bon cadeau pour la maison de la créativité, pensez à venir le retirer.
+
+Au plaisir de vous voir,
+"""
+
+
+class SMTPConfigError(Exception):
+    pass
+
+
+class _SMTPPool(object):
+    """
+    Connexion SMTP gardée ouverte entre deux envois (et deux passages du
+    cron), vérifiée par NOOP et rouverte si le serveur l'a fermée.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _connect(self):
+        if SMTP_USER and not SMTP_PASSWORD:
+            raise SMTPConfigError(
+                "pl_cust.smtp_password n'est pas configuré (smtp_user=%s)"
+                % SMTP_USER
+            )
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        if SMTP_TLS:
+            server.starttls()
+        if SMTP_USER:
+            server.login(SMTP_USER, SMTP_PASSWORD)
+        return server
+
+    def _alive(self):
+        try:
+            return self._server.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+        except OSError:
+            return False
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        with self._lock:
+            if self._server is None or not self._alive():
+                self.close()
+                self._server = self._connect()
+            try:
+                self._server.sendmail(from_addr, to_addrs, msg)
+            except (smtplib.SMTPServerDisconnected, OSError):
+                self.close()
+                raise
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+        self._server = None
+
+
+smtp_pool = _SMTPPool()
+
+
+class MDCMail(ModelSQL, ModelView):
+    "MDC Mail Queue"
+    __name__ = "pl_cust_mdc.mail"
+
+    record = fields.Reference(
+        "Record",
+        selection=[
+            ("pl_cust_mdc.booking_pub", "Booking Pub"),
+            ("pl_cust_mdc.gift_voucher", "Gift Voucher"),
+        ],
+        required=True,
+        readonly=True,
+    )
+    report = fields.Char("Report", required=True, readonly=True)
+    to = fields.Char("To", readonly=True)
+    subject = fields.Char("Subject", readonly=True)
+    body = fields.Text("Body", readonly=True)
+    state = fields.Selection(State, "State", readonly=True)
+    attempts = fields.Integer("Attempts", readonly=True)
+    next_try = fields.DateTime("Next Try", readonly=True)
+    sent_date = fields.DateTime("Sent Date", readonly=True)
+    last_error = fields.Text("Last Error", readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order = [
+            ("create_date", "DESC"),
+        ]
+        cls._buttons.update(
+            {
+                "retry": {
+                    "invisible": Eval("state") != "error",
+                },
+            }
+        )
+
+    @classmethod
+    def view_attributes(cls):
+        return super().view_attributes() + [
+            (
+                "/tree",
+                "visual",
+                If(
+                    Eval("state") == "error",
+                    "danger",
+                    If(Eval("state") == "sent", "success", "muted"),
+                ),
+            ),
+        ]
+
+    @classmethod
+    def default_state(cls):
+        return "pending"
+
+    @classmethod
+    def default_attempts(cls):
+        return 0
+
+    @classmethod
+    def enqueue(cls, record, report, subject, body):
+        "Ajoute un mail à la file, sauf s'il y est déjà pour ce record"
+        existing = cls.search(
+            [
+                ("record", "=", str(record)),
+                ("report", "=", report),
+                ("state", "in", ["pending", "sent"]),
+            ],
+            limit=1,
+        )
+        if existing:
+            return existing[0]
+        mail, = cls.create(
+            [
+                {
+                    "record": str(record),
+                    "report": report,
+                    "to": record.email or MAIL_FALLBACK_TO,
+                    "subject": subject,
+                    "body": body,
+                    "next_try": datetime.now(),
+                }
+            ]
+        )
+        return mail
+
+    @classmethod
+    def enqueue_ticket(cls, booking):
+        if booking.email_sent:
+            return None
+        return cls.enqueue(
+            booking, "pl_cust_mdc.mdc_reportpub", "Votre billet", TICKET_BODY
+        )
+
+    @classmethod
+    def enqueue_voucher(cls, voucher):
+        return cls.enqueue(
+            voucher,
+            "pl_cust_mdc.mdc_reportgift",
+            "Votre Bon Cadeau",
+            VOUCHER_BODY,
+        )
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, mails):
+        cls.write(
+            mails,
+            {"state": "pending", "attempts": 0, "next_try": datetime.now()},
+        )
+
+    def _build_message(self):
+        msg = MIMEMultipart("mixed")
+        msg["From"] = MAIL_FROM
+        msg["To"] = self.to
+        msg["Date"] = formatdate(localtime=True)
+        msg["Subject"] = self.subject
+        msg.attach(MIMEText(self.body or "", "plain"))
+
+        Report = Pool().get(self.report, type="report")
+        ext, content, _, title = Report.execute([self.record.id], {})
+        name = f"{title}.{ext}"
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+
+        mimetype, _ = mimetypes.guess_type(name)
+        if mimetype:
+            attachment = MIMENonMultipart(*mimetype.split("/"))
+            attachment.set_payload(content)
+            encode_base64(attachment)
+        else:
+            attachment = MIMEApplication(content)
+        attachment.add_header(
+            "Content-Disposition", "attachment", filename=("utf-8", "", name)
+        )
+        msg.attach(attachment)
+        return msg
+
+    @staticmethod
+    def _backoff(attempts):
+        "1, 2, 4, 8... minutes, au plus 6 heures"
+        return timedelta(minutes=min(2 ** max(attempts - 1, 0), 6 * 60))
+
+    @classmethod
+    def send_queued(cls):
+        "Appelé par le cron: envoie les mails en attente dont l'heure est venue"
+        pool = Pool()
+        Booking = pool.get("pl_cust_mdc.booking_pub")
+        if SMTP_USER and not SMTP_PASSWORD:
+            # Sans mot de passe aucun envoi ne peut réussir: on fait échouer
+            # le cron plutôt que d'épuiser les tentatives de chaque mail.
+            logger.error(
+                "SMTP password missing: set pl_cust.smtp_password "
+                "(or leave pl_cust.smtp_user empty)"
+            )
+            raise SMTPConfigError("pl_cust.smtp_password n'est pas configuré")
+        now = datetime.now()
+        mails = cls.search(
+            [
+                ("state", "=", "pending"),
+                ["OR", ("next_try", "=", None), ("next_try", "<=", now)],
+            ],
+            order=[("next_try", "ASC"), ("id", "ASC")],
+            limit=BATCH_SIZE,
+        )
+        sent, failed = [], []
+        for mail in mails:
+            try:
+                msg = mail._build_message()
+                smtp_pool.sendmail(MAIL_FROM, [mail.to], msg.as_string())
+            except Exception as e:
+                attempts = (mail.attempts or 0) + 1
+                logger.warning(
+                    "Mail %s to %s failed (attempt %s): %s",
+                    mail.id, mail.to, attempts, e,
+                )
+                cls.write(
+                    [mail],
+                    {
+                        "attempts": attempts,
+                        "last_error": str(e),
+                        "next_try": now + cls._backoff(attempts),
+                        "state": "error" if attempts >= MAX_ATTEMPTS else "pending",
+                    },
+                )
+                failed.append(mail)
+                continue
+            sent.append(mail)
+
+        if sent:
+            cls.write(sent, {"state": "sent", "sent_date": now, "last_error": None})
+            bookings = [
+                m.record for m in sent if m.record.__name__ == Booking.__name__
+            ]
+            if bookings:
+                Booking.write(bookings, {"email_sent": True})
+        if mails:
+            logger.info("MDC mail queue: %s sent, %s failed", len(sent), len(failed))
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = "ir.cron"
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ("pl_cust_mdc.mail|send_queued", "Send MDC Mails")
+        )
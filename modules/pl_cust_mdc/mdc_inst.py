@@ -17,6 +17,10 @@ from trytond.pyson import Bool, Eval, If, Or
 from trytond.transaction import Transaction
 from trytond.model.exceptions import ValidationError
 from trytond.tools.qrcode import generate_png
+from sql.aggregate import Count
+from trytond.tools import grouped_slice, reduce_ids
+
+from .availability import AvailabilityMixin, ReservationMixin, CapacityExceeded
 
 class UnableToDelete(ValidationError):
     pass
@@ -86,7 +90,7 @@ def my_format_date(date):
                              date.strftime("%Y"),
                              )
 
-class MDCBookingInst(ModelSQL, ModelView):
+class MDCBookingInst(AvailabilityMixin, ModelSQL, ModelView):
     "MDC BookingInst"
     __name__ = "pl_cust_mdc.booking_inst"
     
@@ -278,7 +282,7 @@ Sieste : {}
             self.sieste and 'Oui' or 'Non')
     
 
-class MDCDayInst(ModelSQL, ModelView):
+class MDCDayInst(AvailabilityMixin, ReservationMixin, ModelSQL, ModelView):
     "MDC Day Inst"
     __name__ = "pl_cust_mdc.day_inst"
     _order_name = 'date'
@@ -362,6 +366,55 @@ class MDCDayInst(ModelSQL, ModelView):
         ]
         cls._order.insert(0, ("date", "ASC"))
 
+    @classmethod
+    def reserve(cls, day, mad):
+        """
+        Réserve une place d'institution sur la période `mad` ("m", "a" ou
+        "d" pour la journée). Les préinscriptions en attente comptent comme
+        les validées. Lève CapacityExceeded si la période est complète. Le
+        verrou du jour est gardé jusqu'au commit.
+        """
+        if day.dtype != "i":
+            raise CapacityExceeded("Jour non disponible")
+        cls._lock_day(day)
+        taken = cls.get_reserved([day])[day.id]
+        halves = ["m", "a"] if mad == "d" else [mad]
+        for half in halves:
+            if taken.get(half, 0) >= (day.nb_inst_max or 0):
+                raise CapacityExceeded("Complet")
+
+    @classmethod
+    def get_reserved(cls, days):
+        """
+        Institutions inscrites par demi-journée, préinscriptions en attente
+        comprises: même définition pour la liste publique et reserve().
+        Retourne {day_id: {"m": n, "a": n}}.
+        """
+        pool = Pool()
+        Booking = pool.get("pl_cust_mdc.booking_inst")
+        booking = Booking.__table__()
+        cursor = Transaction().connection.cursor()
+
+        ids = [d.id for d in days]
+        result = {i: {"m": 0, "a": 0} for i in ids}
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(
+                *booking.select(
+                    booking.day,
+                    booking.mad,
+                    Count(booking.id),
+                    where=reduce_ids(booking.day, sub_ids)
+                    & booking.state.in_(["draft", "valid"]),
+                    group_by=[booking.day, booking.mad],
+                )
+            )
+            for day_id, mad, count in cursor:
+                # une inscription à la journée prend le matin et l'après-midi
+                for half in (["m", "a"] if mad == "d" else [mad]):
+                    if half in result[day_id]:
+                        result[day_id][half] += count
+        return result
+
     @classmethod
     def search_booktovalid(cls, name, clause):
         Book = Pool().get("pl_cust_mdc.booking_inst")
@@ -11,14 +11,22 @@ from trytond.model import (
     ModelSingleton,
     ValueMixin,
     Unique,
+    Index,
     fields,
 )
 from trytond.pyson import Bool, Eval, If
 from trytond.transaction import Transaction
+from trytond.tools import grouped_slice, reduce_ids
+from sql import Literal
+from sql.aggregate import Sum
+from sql.conditionals import Case, Coalesce
 from trytond.model.exceptions import ValidationError
 from trytond.tools.qrcode import generate_png
+from trytond.config import config
+
+from .availability import AvailabilityMixin, ReservationMixin, CapacityExceeded
 from datetime import date
-from datetime import datetime
+from datetime import datetime, timedelta
 
 
 class UnableToDelete(ValidationError):
@@ -45,6 +53,13 @@ State = [
 
 DAYPub_type = [("p", "Public"), ("h", "Holliday"), ("c", "Close")]
 
+# Durée pendant laquelle une réservation non payée bloque ses places
+RESERVATION_HOLD = timedelta(
+    minutes=config.getint("pl_cust", "reservation_hold", default=20))
+
+# Colonnes comptées dans l'occupation d'un jour
+NB_FIELDS = ["nb_adult", "nb_02", "nb_34", "nb_56", "nb_78", "nb_gift", "nb_asso"]
+
 def my_format_date(date):
     if not date:
         return '-'
@@ -123,7 +138,7 @@ class MDCGiftVoucher(ModelSQL, ModelView):
         return "draft"
 
 
-class MDCBookingPub(ModelSQL, ModelView):
+class MDCBookingPub(AvailabilityMixin, ModelSQL, ModelView):
     "MDC Booking Pub"
     __name__ = "pl_cust_mdc.booking_pub"
 
@@ -156,6 +171,9 @@ class MDCBookingPub(ModelSQL, ModelView):
     @classmethod
     def __setup__(cls):
         super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.day, Index.Range()), (t.state, Index.Equality())))
         cls._order = [
             ("state", "DESC"),
         ]
@@ -269,7 +287,7 @@ class MDCBookingPub(ModelSQL, ModelView):
     #     return False
 
 
-class MDCDayPub(ModelSQL, ModelView):
+class MDCDayPub(AvailabilityMixin, ReservationMixin, ModelSQL, ModelView):
     "MDC Day Pub"
     __name__ = "pl_cust_mdc.day_pub"
     _order_name = 'date'
@@ -285,17 +303,17 @@ class MDCDayPub(ModelSQL, ModelView):
     lim2 = fields.Function(fields.Integer("lim2"), "on_change_with_lim2")
 
     tot_morning = fields.Function(
-        fields.Integer("Tot_morning"), "on_change_with_tot_morning"
+        fields.Integer("Tot_morning"), "get_totals"
     )
     tot_afternoon = fields.Function(
-        fields.Integer("Tot_afternoon"), "on_change_with_tot_afternoon"
+        fields.Integer("Tot_afternoon"), "get_totals"
     )
 
     tot_live_morning = fields.Function(
-        fields.Integer("Tot_live_morning"), "on_change_with_tot_live_morning"
+        fields.Integer("Tot_live_morning"), "get_totals"
     )
     tot_live_afternoon = fields.Function(
-        fields.Integer("Tot_live_afternoon"), "on_change_with_tot_live_afternoon"
+        fields.Integer("Tot_live_afternoon"), "get_totals"
     )
     bookings_pub = fields.One2Many("pl_cust_mdc.booking_pub", "day", "Bookings")
 
@@ -337,6 +355,89 @@ class MDCDayPub(ModelSQL, ModelView):
         ]
         cls._order.insert(0, ("date", "ASC"))
 
+    @classmethod
+    def get_totals(cls, days, names):
+        """
+        Occupation (réservations payées) de tous les jours demandés en une
+        seule requête groupée, au lieu de parcourir bookings_pub en Python.
+        """
+        pool = Pool()
+        Booking = pool.get("pl_cust_mdc.booking_pub")
+        booking = Booking.__table__()
+        cursor = Transaction().connection.cursor()
+
+        nb = Coalesce(getattr(booking, NB_FIELDS[0]), 0)
+        for fname in NB_FIELDS[1:]:
+            nb += Coalesce(getattr(booking, fname), 0)
+        morning = booking.mad == "m"
+        afternoon = booking.mad == "a"
+        used = booking.used == Literal(True)
+        columns = {
+            "tot_morning": Sum(Case((morning, nb), else_=0)),
+            "tot_afternoon": Sum(Case((afternoon, nb), else_=0)),
+            "tot_live_morning": Sum(Case((morning & used, nb), else_=0)),
+            "tot_live_afternoon": Sum(Case((afternoon & used, nb), else_=0)),
+        }
+
+        ids = [d.id for d in days]
+        result = {name: dict.fromkeys(ids, 0) for name in names}
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*booking.select(
+                    booking.day,
+                    *[columns[name] for name in names],
+                    where=reduce_ids(booking.day, sub_ids)
+                    & (booking.state == "payed"),
+                    group_by=booking.day))
+            for row in cursor:
+                for name, value in zip(names, row[1:]):
+                    result[name][row[0]] = int(value or 0)
+        return result
+
+    @classmethod
+    def reserve(cls, day, mad, nb):
+        """
+        Réserve `nb` places sur la demi-journée `mad` ("m"/"a") du jour.
+        Lève CapacityExceeded si le jour est complet. Le verrou du jour est
+        gardé jusqu'au commit: la réservation doit être créée dans la même
+        transaction.
+        """
+        cls._lock_day(day)
+        taken = cls.get_reserved([day])[day.id].get(mad, 0)
+        if taken + nb > (day.nb_max or 0):
+            raise CapacityExceeded("NbrMax")
+        return day.nb_max - taken - nb
+
+    @classmethod
+    def get_reserved(cls, days):
+        """
+        Places prises par demi-journée: réservations payées plus les
+        réservations en attente de paiement depuis moins de RESERVATION_HOLD.
+        Retourne {day_id: {"m": n, "a": n}}.
+        """
+        pool = Pool()
+        Booking = pool.get("pl_cust_mdc.booking_pub")
+        booking = Booking.__table__()
+        cursor = Transaction().connection.cursor()
+
+        nb = Coalesce(getattr(booking, NB_FIELDS[0]), 0)
+        for fname in NB_FIELDS[1:]:
+            nb += Coalesce(getattr(booking, fname), 0)
+        held = (booking.state == "payed") | (
+            (booking.state == "draft")
+            & (booking.create_date >= datetime.now() - RESERVATION_HOLD))
+
+        ids = [d.id for d in days]
+        result = {i: {"m": 0, "a": 0} for i in ids}
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*booking.select(
+                    booking.day, booking.mad, Sum(nb),
+                    where=reduce_ids(booking.day, sub_ids) & held,
+                    group_by=[booking.day, booking.mad]))
+            for day_id, mad, total in cursor:
+                if mad in ("m", "a"):
+                    result[day_id][mad] = int(total or 0)
+        return result
+
     @fields.depends("bookings_pub",)
     def on_change_with_tot_morning(self, name=None):
         tot = 0
@@ -0,0 +1,95 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from trytond.config import config
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["get_datatrans_id", "PaymentProviderError"]
+
+CONNECT_TIMEOUT = config.getfloat("pl_cust", "datatrans_connect_timeout", default=3)
+READ_TIMEOUT = config.getfloat("pl_cust", "datatrans_read_timeout", default=10)
+POOL_SIZE = config.getint("pl_cust", "datatrans_pool_size", default=10)
+
+
+class PaymentProviderError(Exception):
+    pass
+
+
+_session_lock = threading.Lock()
+_session = None
+
+
+def _get_session():
+    """
+    Session HTTP partagée (keep-alive) vers le prestataire de paiement.
+    Un POST n'est renvoyé que si la connexion n'a pas pu être établie: après
+    une 502/503/504 de la passerelle, Datatrans a peut-être déjà créé la
+    transaction. Les GET sont aussi renvoyés sur 502/503/504.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=3,
+                connect=2,
+                read=0,
+                status=2,
+                backoff_factor=0.3,
+                status_forcelist=[502, 503, 504],
+                allowed_methods=frozenset(["GET"]),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def get_datatrans_id(
+    amo, ref, merchant_id, password, url, successUrl, cancelUrl, errorUrl
+):
+    data = {
+        "currency": "CHF",
+        "refno": ref,
+        "amount": amo,
+        "redirect": {
+            "successUrl": "{}".format(successUrl),
+            "cancelUrl": "{}".format(cancelUrl),
+            "errorUrl": "{}".format(errorUrl),
+        },
+    }
+    try:
+        response = _get_session().post(
+            url,
+            json=data,
+            auth=(merchant_id, password),
+            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+        )
+    except requests.RequestException as e:
+        logger.error("Datatrans unreachable for %s: %s", ref, e)
+        raise PaymentProviderError(str(e))
+
+    if not response.ok:
+        logger.error(
+            "Datatrans error for %s: %s %s", ref, response.status_code, response.text
+        )
+        raise PaymentProviderError(response.status_code)
+    try:
+        transaction_id = response.json()["transactionId"]
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error(
+            "Datatrans invalid response for %s: %s %s", ref, e, response.text
+        )
+        raise PaymentProviderError("invalid response")
+    return transaction_id
@@ -1,6 +1,5 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
-import requests
 from datetime import date, datetime
 import time
 import json
@@ -12,23 +11,15 @@ from trytond.pool import Pool
 from trytond.wsgi import app
 from trytond.protocols.wrappers import with_pool, with_transaction, user_application
 from trytond.config import config
+from trytond.backend import DatabaseOperationalError
+
+from .availability import availability_response, CapacityExceeded
+from .payment import get_datatrans_id, PaymentProviderError
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # -------------------------------------------------------------------
-import smtplib
-
-from email.encoders import encode_base64
-from email.header import Header
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
-from email.mime.nonmultipart import MIMENonMultipart
-from email.mime.text import MIMEText
-
-from email.utils import COMMASPACE, formatdate
-import mimetypes
-
 book_application = user_application("book")
 # config.get('pl_cust', 'token')
 
@@ -40,6 +31,30 @@ def generer_numero_reference(longueur):
     return numero_reference
 
 
+def _after_payment_init(Model, record, values=None):
+    """
+    Enregistre l'issue de l'appel au prestataire (values) ou supprime la
+    réservation (values=None) dans une transaction à part: la transaction
+    de la requête est déjà commitée, et une erreur ici ne doit pas rejouer
+    la requête (nouvelle réservation et second init de paiement).
+    Retourne False si l'écriture a échoué.
+    """
+    try:
+        with Transaction().new_transaction() as transaction:
+            records = Model.browse([record.id])
+            if values is None:
+                Model.delete(records)
+            else:
+                Model.write(records, values)
+            transaction.commit()
+    except Exception:
+        logger.error(
+            "%s %s: écriture après l'init de paiement impossible",
+            Model.__name__, record.id, exc_info=True)
+        return False
+    return True
+
+
 def my_format_day(date):
     if not date:
         return "-"
@@ -81,51 +96,51 @@ def my_format_day(date):
 @with_pool
 @with_transaction()
 @book_application
-def get_pub_date(request, pool):           
+def get_pub_date(request, pool):
     logger.info("Request arrived at /{}/book/get_pub_date".format(request.view_args['database_name']))
+    return availability_response(request, "pub", lambda: _pub_dates(pool))
+
 
+def _pub_dates(pool):
     days = pool.get("pl_cust_mdc.day_pub")
     Date = pool.get("ir.date")
     days_list = days.search(
         [("date", ">=", Date.today()), ("dtype", "=", "p")], order=[("date", "ASC")]
     )
     logger.info(f"Days list contains {len(days_list)} records")
+    # même occupation que Day.reserve(): payées + paiements en cours
+    reserved = days.get_reserved(days_list)
     # J-M-A
     res = []
 
-    for days in days_list:
-        logger.info(f"Processing date: {days.date}")
-        color = "bg-green-200"
-        if days.tot_morning:
-            color = "bg-red-200"
-        if days.tot_morning < days.nb_max:
+    for day in days_list:
+        tot_morning = reserved[day.id]["m"]
+        tot_afternoon = reserved[day.id]["a"]
+        if tot_morning < day.nb_max:
             res.append(
                 {
                     "text": "{} matin ({} places à partir de 09h00)".format(
-                        my_format_day(days.date), days.nb_max - days.tot_morning
+                        my_format_day(day.date), day.nb_max - tot_morning
                     ),
-                    "nb": days.nb_max - days.tot_morning,
-                    "value": "{}/m".format(days.id),
-                    "nb_max": days.nb_max,
+                    "nb": day.nb_max - tot_morning,
+                    "value": "{}/m".format(day.id),
+                    "nb_max": day.nb_max,
                 }
             )
-        color = "bg-green-200"
-        if days.tot_afternoon:
-            color = "bg-red-200"
-        if days.tot_afternoon < days.nb_max:
+        if tot_afternoon < day.nb_max:
             res.append(
                 {
                     "text": "{} après-midi ({} places à partir de 14h00)".format(
-                        my_format_day(days.date), days.nb_max - days.tot_afternoon
+                        my_format_day(day.date), day.nb_max - tot_afternoon
                     ),
-                    "nb": days.nb_max - days.tot_afternoon,
-                    "value": "{}/a".format(days.id),
-                    "nb_max": days.nb_max,
+                    "nb": day.nb_max - tot_afternoon,
+                    "value": "{}/a".format(day.id),
+                    "nb_max": day.nb_max,
                 }
             )
 
     logger.info(f"Resulting response contains {len(res)} records")
-    return Response(json.dumps(res), mimetype="application/json")
+    return res
 
 
 @app.route("/<database_name>/book/get_inst_date", methods=["GET"])
@@ -133,16 +148,24 @@ def get_pub_date(request, pool):
 @with_transaction()
 @book_application
 def get_inst_date(request, pool):
+    return availability_response(request, "inst", lambda: _inst_dates(pool))
+
+
+def _inst_dates(pool):
     days = pool.get("pl_cust_mdc.day_inst")
     Date = pool.get("ir.date")
     days_list = days.search(
         [("date", ">", Date.today()), ("dtype", "=", "i")], order=[("date", "ASC")]
     )
+    # même occupation que Day.reserve(): validées + préinscriptions
+    reserved = days.get_reserved(days_list)
     # J-M-A
     res = []
     for days in days_list:
+        tot_inst_m = reserved[days.id]["m"]
+        tot_inst_a = reserved[days.id]["a"]
 
-        if days.tot_inst_m < days.nb_inst_max and days.tot_inst_a < days.nb_inst_max:
+        if tot_inst_m < days.nb_inst_max and tot_inst_a < days.nb_inst_max:
             res.append(
                 {
                     "text": "{}".format(my_format_day(days.date)),
@@ -150,7 +173,7 @@ def get_inst_date(request, pool):
                     "value": "{}/m".format(days.id),
                 }
             )
-        elif days.tot_inst_m < days.nb_inst_max:
+        elif tot_inst_m < days.nb_inst_max:
             res.append(
                 {
                     "text": "{} (uniquement le matin)".format(my_format_day(days.date)),
@@ -158,7 +181,7 @@ def get_inst_date(request, pool):
                     "value": "{}/m".format(days.id),
                 }
             )
-        elif days.tot_inst_a < days.nb_inst_max:
+        elif tot_inst_a < days.nb_inst_max:
             res.append(
                 {
                     "text": "{} (uniquement l'après-midi)".format(
@@ -193,69 +216,17 @@ def get_inst_date(request, pool):
 
 
 def send_mail_info(book, name="-"):
+    """
+    Met le billet dans la file d'envoi (pl_cust_mdc.mail): le rendu du
+    billet et l'envoi SMTP sont faits par le cron, hors de la requête.
+    """
     if book.email_sent:
         print(f"Mail already send for: {book.id}")
         return {"status": "success", "message": "Email already sent no action taken"}
 
-    TO = book.email
-    if not TO:
-        print("Email not provided, using fallback")
-        TO = "nguyen@prolibre.com"
-
-    try:
-        msg = MIMEMultipart("mixed")
-        msg["From"] = "noreply@mdc-reg.ch"
-        msg["To"] = TO
-        msg["Date"] = formatdate(localtime=True)
-        msg["Subject"] = "Votre billet"
-
-        msg.attach(
-            MIMEText(
-                f"""Bonjour,
-
-Veuillez trouvez ci-joint votre billet pour la maison de la créativité. 
-
-Au plaisir de vous voir,
-                """,
-                "plain",
-            )
-        )
-
-        Ticket = Pool().get("pl_cust_mdc.mdc_reportpub", type="report")
-        ext, content, _, title = Ticket.execute([book.id], {})
-        name = f"{title}.{ext}"
-        if isinstance(content, str):
-            content = content.encode("utf-8")
-
-        mimetype, _ = mimetypes.guess_type(name)
-        if mimetype:
-            attachment = MIMENonMultipart(*mimetype.split("/"))
-            attachment.set_payload(content)
-            encode_base64(attachment)
-        else:
-            attachment = MIMEApplication(content)
-        attachment.add_header(
-            "Content-Disposition", "attachment", filename=("utf-8", "", name)
-        )
-        msg.attach(attachment)
-
-        pl_user = "noreply@mdc-reg.ch"
-        pl_passwd = "591P-dq$HCnO-"
-        server = smtplib.SMTP("mail.infomaniak.com", 587)
-        server.starttls()
-        server.login(pl_user, pl_passwd)
-        server.sendmail("noreply@mdc-reg.ch", [TO], msg.as_string())
-        server.quit()
-
-        print("Mail sent successfully.")
-
-        book.email_sent = True
-        book.save()
-
-        return {"status": "success", "message": "Email sent successfully"}
-    except Exception as e:
-        print(f"Error sending email: {e}")
-        return {"status": "error", "message": str(e)}
+    Mail = Pool().get("pl_cust_mdc.mail")
+    mail = Mail.enqueue_ticket(book)
+    return {"status": "success", "message": "Email queued ({})".format(mail.id)}
 
 
 
@@ -307,7 +278,7 @@ Au plaisir de vous voir,
 #         msg.attach(attachment)
 
 #         pl_user = "noreply@mdc-reg.ch"
-#         pl_passwd = "591P-dq$HCnO-"
+#         pl_passwd = config.get("pl_cust", "smtp_password")
 #         server = smtplib.SMTP("mail.infomaniak.com", 587)
 #         server.starttls()
 #         server.login(pl_user, pl_passwd)
@@ -326,27 +297,6 @@ Au plaisir de vous voir,
 
 
 
-def get_datatrans_id(
-    amo, ref, merchant_id, password, url, successUrl, cancelUrl, errorUrl
-):
-    data = {
-        "currency": "CHF",
-        "refno": ref,
-        "amount": amo,
-        "redirect": {
-            "successUrl": "{}".format(successUrl),
-            "cancelUrl": "{}".format(cancelUrl),
-            "errorUrl": "{}".format(errorUrl),
-        },
-    }
-    response = requests.post(url, json=data, auth=(merchant_id, password))
-
-    if response.ok:
-        return response.json().get("transactionId")
-    # else:
-    #     response.raise_for_status()
-
-
 @app.route("/<database_name>/book/savepubbook", methods=["POST"])
 @with_pool
 @with_transaction()
@@ -364,8 +314,7 @@ def savepubbook(request, pool):
             days_id = days_id[0]
 
         d = Day(days_id)
-
-        print(data["item"]["association"])
+        mad = data["item"]["dates_id"].split("/")[1]
 
         tot_nb = (
             int(data["item"]["tarifAdulte"])
@@ -376,12 +325,12 @@ def savepubbook(request, pool):
             + int(data["item"]["tarif56"])
             + int(data["item"]["tarif78"])
         )
-        if data["item"]["dates_id"].split("/")[1] == "m":
-            if d.tot_morning + tot_nb > d.nb_max:
-                return Response("NbrMax", 404)
-        else:
-            if d.tot_afternoon + tot_nb > d.nb_max:
-                return Response("NbrMax", 404)
+        # places payées + réservations en cours de paiement, jour verrouillé
+        # jusqu'au commit qui suit la création de la réservation
+        try:
+            Day.reserve(d, mad, tot_nb)
+        except CapacityExceeded:
+            return Response("NbrMax", 404)
 
         amo = 0
         if data["item"]["sp4"]:
@@ -403,22 +352,8 @@ def savepubbook(request, pool):
 
         refno = generer_numero_reference(12)
 
-        print(conf_val.datatrans_successUrl)
-        if amo:
-            TransactionID = get_datatrans_id(
-                amo,
-                refno,
-                conf_val.merchant_id,
-                conf_val.merchant_password,
-                conf_val.datatrans_url,
-                conf_val.datatrans_successUrl,
-                conf_val.datatrans_cancelUrl,
-                conf_val.datatrans_errorUrl,
-            )
-        else:
-            TransactionID = refno
-
-        reg = Book.create(
+        # 1) réserver les places (brouillon) et libérer la transaction
+        reg, = Book.create(
             [
                 {  # 'day': data['item']['availableDates'],
                     "day": days_id,
@@ -433,15 +368,46 @@ def savepubbook(request, pool):
                     "sp4": data["item"]["sp4"],
                     "sp5": data["item"]["sp5"],
                     "sp6": data["item"]["sp6"],
-                    "mad": data["item"]["dates_id"].split("/")[1],
+                    "mad": mad,
                     "name_asso": data["item"]["associationNom"],
-                    "datatrans_id": TransactionID,
+                    "datatrans_id": None if amo else refno,
                     "refno": refno,
                     "email": data["item"]["email"],
                     "state": amo and "draft" or "payed",
                 }
             ]
         )
+        if not amo:
+            return Response(
+                json.dumps({"TransactionID": refno, "refno": refno}),
+                mimetype="application/json",
+            )
+        Transaction().commit()
+
+        # 2) appel au prestataire hors transaction, puis confirmation
+        try:
+            TransactionID = get_datatrans_id(
+                amo,
+                refno,
+                conf_val.merchant_id,
+                conf_val.merchant_password,
+                conf_val.datatrans_url,
+                conf_val.datatrans_successUrl,
+                conf_val.datatrans_cancelUrl,
+                conf_val.datatrans_errorUrl,
+            )
+        except PaymentProviderError:
+            TransactionID = None
+        if (TransactionID is None
+                or not _after_payment_init(
+                    Book, reg, {"datatrans_id": TransactionID})):
+            # si la suppression échoue aussi, le brouillon reste impayé
+            _after_payment_init(Book, reg)
+            return Response(
+                json.dumps({"error": "Paiement indisponible, veuillez réessayer"}),
+                status=503,
+                mimetype="application/json",
+            )
 
         return Response(
             json.dumps({"TransactionID": TransactionID, "refno": refno}),
@@ -502,6 +468,15 @@ def saveinstbook(request, pool):
             days_id = days_id[0]
             d = Day(days_id)
 
+            try:
+                Day.reserve(d, data["item"]["periodeJournee"])
+            except CapacityExceeded:
+                return Response(
+                    json.dumps({"error": "Cette période est complète"}),
+                    status=409,
+                    mimetype="application/json",
+                )
+
             reg = Book.create(
                 [
                     {
@@ -538,6 +513,9 @@ def saveinstbook(request, pool):
                 ),
                 mimetype="application/json",
             )
+        except DatabaseOperationalError:
+            # conflit sur le verrou du jour: with_transaction rejoue la requête
+            raise
         except Exception as e:
             return Response(
                 json.dumps({"error": "Internal Server Error", "details": str(e)}),
@@ -696,26 +674,7 @@ def buyvoucher(request, pool):
 
         refno = generer_numero_reference(12)
 
-        print(conf_val.datatrans_successUrl)
-        if amo:
-            TransactionID = get_datatrans_id(
-                amo,
-                refno,
-                conf_val.merchant_id,
-                conf_val.merchant_password,
-                conf_val.datatrans_url,
-                conf_val.datatrans_giftSuccessUrl,
-                conf_val.datatrans_cancelUrl,
-                conf_val.datatrans_errorUrl,
-            )
-        else:
-            TransactionID = refno
-
-        print(data["item"]["tarif2"])
-        print(data["item"]["tarif4"])
-        print(data["item"]["tarif10"])
-
-        reg = Book.create(
+        reg, = Book.create(
             [
                 {
                     "lastname": data["item"]["nom"],
@@ -725,12 +684,42 @@ def buyvoucher(request, pool):
                     "nb_4": data["item"]["tarif4"],
                     "nb_10": data["item"]["tarif10"],
                     "email": data["item"]["email"],
-                    "datatrans_id": TransactionID,
+                    "datatrans_id": None if amo else refno,
                     "refno": refno,
                     "state": amo and "draft" or "payed",
                 }
             ]
         )
+        if not amo:
+            return Response(
+                json.dumps({"TransactionID": refno, "refno": refno}),
+                mimetype="application/json",
+            )
+        Transaction().commit()
+
+        try:
+            TransactionID = get_datatrans_id(
+                amo,
+                refno,
+                conf_val.merchant_id,
+                conf_val.merchant_password,
+                conf_val.datatrans_url,
+                conf_val.datatrans_giftSuccessUrl,
+                conf_val.datatrans_cancelUrl,
+                conf_val.datatrans_errorUrl,
+            )
+        except PaymentProviderError:
+            TransactionID = None
+        if (TransactionID is None
+                or not _after_payment_init(
+                    Book, reg, {"datatrans_id": TransactionID})):
+            # si la suppression échoue aussi, le brouillon reste impayé
+            _after_payment_init(Book, reg)
+            return Response(
+                json.dumps({"error": "Paiement indisponible, veuillez réessayer"}),
+                status=503,
+                mimetype="application/json",
+            )
 
         return Response(
             json.dumps({"TransactionID": TransactionID, "refno": refno}),
@@ -761,7 +750,8 @@ def validate_voucher(request, pool):
             b = b[0]
             b.state = "payed"
             b.save()
-            gift_send_mail_info(b)
+            Mail = pool.get("pl_cust_mdc.mail")
+            Mail.enqueue_voucher(b)
 
             return Response("ok")
         else:
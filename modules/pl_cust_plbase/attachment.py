@@ -0,0 +1,51 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+from sql import Cast
+from sql.functions import Substring
+
+from trytond.model import fields
+from trytond.pool import Pool
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+__all__ = ['AttachmentMixin']
+
+
+class AttachmentMixin(object):
+    "Indique si l'enregistrement a au moins une pièce jointe"
+
+    as_attachment = fields.Function(fields.Boolean('pj'),
+        'get_as_attachement', searcher='search_as_attachment')
+
+    @classmethod
+    def get_as_attachement(cls, records, name):
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        attachment = Attachment.__table__()
+        cursor = Transaction().connection.cursor()
+
+        res = {r.id: False for r in records}
+        for sub_records in grouped_slice(records):
+            cursor.execute(*attachment.select(
+                    attachment.resource,
+                    where=attachment.resource.in_(
+                        [str(r) for r in sub_records]),
+                    group_by=attachment.resource))
+            for resource, in cursor:
+                res[int(resource.split(',')[1])] = True
+        return res
+
+    @classmethod
+    def search_as_attachment(cls, name, clause):
+        pool = Pool()
+        Attachment = pool.get('ir.attachment')
+        attachment = Attachment.__table__()
+
+        _, operator, value = clause
+        prefix = cls.__name__ + ','
+        query = attachment.select(
+            Cast(Substring(attachment.resource, len(prefix) + 1), 'INTEGER'),
+            where=attachment.resource.like(prefix + '%'))
+        if (operator == '=') == bool(value):
+            return [('id', 'in', query)]
+        return [('id', 'not in', query)]
@@ -6,11 +6,19 @@ from trytond.transaction import Transaction
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval, If, Bool
 from trytond import backend
+from trytond.tools import grouped_slice, reduce_ids
 # from .party import EMPLOYEE_TYPE
 from trytond.pyson import Date
 from datetime import datetime, timedelta
+from collections import defaultdict
+
+from sql import Cast, Literal, Null
+from sql.aggregate import Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import Extract
 
 from trytond.model.exceptions import ValidationError
+from trytond.modules.pl_cust_plbase.attachment import AttachmentMixin
 
 
 class EmployeValidationError(ValidationError):
@@ -42,6 +50,19 @@ STATES = {
 }
 DEPENDS = ['active']
 
+# Tarif horaire du dossier selon le type d'employé
+TARIFF_FIELDS = {
+    'T1': 'folder_price1',
+    'T2': 'folder_price2',
+    'T3': 'folder_price3',
+    'T4': 'folder_price4',
+    'T5': 'folder_price5',
+}
+
+# Champs des timesheets qui entrent dans les totaux du dossier
+TOTAL_FIELDS = {'folder_id', 'task', 'duration', 'pct', 'invoice_id',
+                'archived'}
+
 
 class FoldEmployeeType(ModelSQL, ModelView):
     'Employee_type'
@@ -113,18 +134,19 @@ class FolderSheet(ModelSQL, ModelView):
     hour_price = fields.Float('Price per hour', states={
                               'readonly': Bool(Eval('invoiced')), }, depends=['invoiced'])
 
-    price = fields.Function(fields.Float('Price'), 'on_change_with_price')
+    price = fields.Function(fields.Float('Price'), 'get_sheet_infos',
+        searcher='search_price')
 
     folder_type = fields.Function(fields.Char(
-        'Folder Type'), 'on_change_with_folder_type')
+        'Folder Type'), 'get_sheet_infos')
 
     resp_id = fields.Many2One('company.employee', 'Employee', required=True, states={
                               'readonly': Bool(Eval('invoiced')), }, depends=['invoiced'])
 
     resp_type = fields.Function(fields.Selection(
-        'get_employee_type', 'Employee Type'), 'on_change_with_resp_type')
+        'get_employee_type', 'Employee Type'), 'get_sheet_infos')
     invoiced = fields.Function(fields.Boolean(
-        'Invoiced'), 'on_change_with_invoiced', searcher='search_invoiced')
+        'Invoiced'), 'get_sheet_infos', searcher='search_invoiced')
     invoice_id = fields.Many2One('account.invoice', 'Invoice')
 
     pct = fields.Selection([('0', '0%'),
@@ -143,6 +165,24 @@ class FolderSheet(ModelSQL, ModelView):
             ('id', 'DESC'),
         ]
 
+    @classmethod
+    def create(cls, vlist):
+        foldersheets = super().create(vlist)
+        cls._update_folder_totals({ts.folder_id.id for ts in foldersheets})
+        return foldersheets
+
+    @classmethod
+    def write(cls, *args):
+        folder_ids = set()
+        actions = iter(args)
+        for foldersheets, values in zip(actions, actions):
+            if TOTAL_FIELDS & values.keys():
+                folder_ids.update(ts.folder_id.id for ts in foldersheets)
+                if values.get('folder_id'):
+                    folder_ids.add(values['folder_id'])
+        super().write(*args)
+        cls._update_folder_totals(folder_ids)
+
     @classmethod
     def delete(cls, foldersheets):
         for ts in foldersheets:
@@ -150,7 +190,16 @@ class FolderSheet(ModelSQL, ModelView):
                 raise UnableToDelete(
                     "Impossible de supprimer un timesheet facturé")
 
+        folder_ids = {ts.folder_id.id for ts in foldersheets}
         super().delete(foldersheets)
+        cls._update_folder_totals(folder_ids)
+
+    @classmethod
+    def _update_folder_totals(cls, folder_ids):
+        if not folder_ids:
+            return
+        Folders = Pool().get('pl_cust_plfolders.folders')
+        Folders.update_totals(Folders.browse(list(folder_ids)))
 
     @classmethod
     def get_employee_type(cls):
@@ -246,9 +295,6 @@ class FolderSheet(ModelSQL, ModelView):
         if not self.folder_id:
             return
 
-        LANG = Pool().get('ir.lang')
-        lang_fr = LANG(LANG.search([('code', '=', 'fr')])[0])
-
         if self.duration and self.hour_price and self.folder_id.currency and self.pct:
             return ((self.duration.total_seconds()/3600.0) * self.hour_price)*(int(self.pct)/100)
         else:
@@ -264,6 +310,86 @@ class FolderSheet(ModelSQL, ModelView):
         if self.folder_id:
             return self.folder_id.folder_type
 
+    @classmethod
+    def _price_sql(cls, sheet, folder):
+        "Expression SQL du prix, comme on_change_with_price"
+        hours = Extract('EPOCH', sheet.duration) / 3600.0
+        return Case(
+            ((folder.currency != Null) & (sheet.pct != Null),
+                Coalesce(hours * sheet.hour_price
+                    * Cast(sheet.pct, 'INTEGER') / 100.0, 0)),
+            else_=Literal(0))
+
+    @classmethod
+    def get_sheet_infos(cls, foldersheets, names):
+        """
+        price, invoiced, folder_type et resp_type de tous les timesheets,
+        lus par une requête jointe sur le dossier et l'employé.
+        """
+        pool = Pool()
+        Folders = pool.get('pl_cust_plfolders.folders')
+        Employee = pool.get('company.employee')
+        sheet = cls.__table__()
+        folder = Folders.__table__()
+        employee = Employee.__table__()
+        cursor = Transaction().connection.cursor()
+
+        res = {n: {} for n in names}
+        for sub_ids in grouped_slice([s.id for s in foldersheets]):
+            query = sheet.join(folder,
+                condition=sheet.folder_id == folder.id
+                ).join(employee, 'LEFT',
+                condition=sheet.resp_id == employee.id
+                ).select(
+                    sheet.id,
+                    cls._price_sql(sheet, folder),
+                    sheet.invoice_id,
+                    sheet.archived,
+                    folder.folder_type,
+                    employee.employee_type,
+                    where=reduce_ids(sheet.id, sub_ids))
+            cursor.execute(*query)
+            for (id_, price, invoice_id, archived, folder_type,
+                    resp_type) in cursor:
+                values = {
+                    'price': float(price or 0),
+                    'invoiced': bool(invoice_id or archived),
+                    'folder_type': folder_type,
+                    'resp_type': resp_type,
+                    }
+                for name in names:
+                    res[name][id_] = values[name]
+        return res
+
+    @classmethod
+    def search_price(cls, name, clause):
+        pool = Pool()
+        Folders = pool.get('pl_cust_plfolders.folders')
+        sheet = cls.__table__()
+        folder = Folders.__table__()
+
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        query = sheet.join(folder,
+            condition=sheet.folder_id == folder.id
+            ).select(sheet.id,
+                where=Operator(cls._price_sql(sheet, folder), value))
+        return [('id', 'in', query)]
+
+    @classmethod
+    def order_price(cls, tables):
+        pool = Pool()
+        Folders = pool.get('pl_cust_plfolders.folders')
+        sheet, _ = tables[None]
+        if 'folder_id' not in tables:
+            folder = Folders.__table__()
+            tables['folder_id'] = {
+                None: (folder, sheet.folder_id == folder.id),
+                }
+        else:
+            folder, _ = tables['folder_id'][None]
+        return [cls._price_sql(sheet, folder)]
+
 
 class FoldInvoice(ModelSQL, ModelView):
     __name__ = 'account.invoice'
@@ -293,8 +419,21 @@ class FoldInvoice(ModelSQL, ModelView):
             new_lines.append(new_line)
         return new_lines
 
+    @classmethod
+    def delete(cls, invoices):
+        pool = Pool()
+        FolderSheet = pool.get('pl_cust_plfolders.foldersheet')
+        Folders = pool.get('pl_cust_plfolders.folders')
 
-class Folders(DeactivableMixin, Workflow, ModelSQL, ModelView):
+        # invoice_id des timesheets est remis à NULL par la base
+        folder_ids = {ts.folder_id.id for ts in FolderSheet.search(
+                    [('invoice_id', 'in', [i.id for i in invoices])])}
+        super().delete(invoices)
+        if folder_ids:
+            Folders.update_totals(Folders.browse(list(folder_ids)))
+
+
+class Folders(AttachmentMixin, DeactivableMixin, Workflow, ModelSQL, ModelView):
     'Folders'
     __name__ = 'pl_cust_plfolders.folders'
     name = fields.Char('Number', required=False, readonly=False)
@@ -350,21 +489,9 @@ class Folders(DeactivableMixin, Workflow, ModelSQL, ModelView):
     check_ts = fields.Function(fields.Char(
         'Check TS'), 'on_change_with_check_ts')
 
-    as_attachment = fields.Function(fields.Boolean('pj'), 'get_as_attachement')
     delai = fields.Char('Delai')
     resp = fields.Many2One('company.employee', 'Resp',)
     
-    @classmethod
-    def get_as_attachement(cls, invoices, name):
-        pool = Pool()
-        ATTACH = pool.get('ir.attachment')
-
-        res = {i.id: False for i in invoices}
-        for inv in invoices : 
-            if ATTACH.search([('resource', '=', inv)]) :
-                res[inv.id] = True
-        return res
-
     @fields.depends('newfolder_expected', 'newfolder_tot_ts')
     def on_change_with_check_ts(self, name=None):
         if not self.newfolder_expected:
@@ -524,61 +651,107 @@ class Folders(DeactivableMixin, Workflow, ModelSQL, ModelView):
     @classmethod
     @ModelView.button
     def update_infos(cls, folders):
+        cls.update_totals(folders)
+        return True
+
+    @classmethod
+    def get_ts_totals(cls, folders):
+        """
+        Totaux des timesheets en secondes par dossier: (sans pct, total,
+        facturé, non facturé), calculés par une requête groupée.
+        """
+        pool = Pool()
+        FolderSheet = pool.get('pl_cust_plfolders.foldersheet')
+        sheet = FolderSheet.__table__()
+        cursor = Transaction().connection.cursor()
+
+        invoiced = Case(
+            ((sheet.invoice_id != Null) | (sheet.archived == Literal(True)),
+                Literal(1)),
+            else_=Literal(0))
+        res = {f.id: [0, 0, 0, 0] for f in folders}
+        for sub_ids in grouped_slice([f.id for f in folders]):
+            cursor.execute(*sheet.select(
+                    sheet.folder_id, sheet.pct, invoiced,
+                    Sum(sheet.duration),
+                    where=(reduce_ids(sheet.folder_id, sub_ids)
+                        & (sheet.task != Null)
+                        & (sheet.duration != Null)),
+                    group_by=[sheet.folder_id, sheet.pct, invoiced]))
+            for folder_id, pct, is_invoiced, duration in cursor:
+                if isinstance(duration, timedelta):
+                    duration = duration.total_seconds()
+                duration = duration or 0
+                tot = res[folder_id]
+                tot[0] += duration
+                tot[1] += duration * (int(pct) / 100)
+                tot[2 if is_invoiced else 3] += duration * (int(pct) / 100)
+        return res
+
+    @classmethod
+    def update_totals(cls, folders):
+        "Enregistre les totaux des timesheets sur les dossiers"
+        totals = cls.get_ts_totals(folders)
+        to_write = []
         for f in folders:
+            nopct, tot, fact, notfact = totals[f.id]
+            to_write.extend(([f], {
+                        'newfolder_tot_ts_withoutpct': timedelta(seconds=nopct),
+                        'newfolder_tot_ts': timedelta(seconds=tot),
+                        'newfolder_tot_fact_ts': timedelta(seconds=fact),
+                        'newfolder_tot_notfact_ts': timedelta(seconds=notfact),
+                        'newfolder_expected_txt': cls._expected_txt(
+                            f.newfolder_expected),
+                        'newfolder_tot_ts_withoutpct_txt': format_seconds(nopct),
+                        'newfolder_tot_ts_txt': format_seconds(tot),
+                        'newfolder_tot_fact_ts_txt': format_seconds(fact),
+                        'newfolder_tot_notfact_ts_txt': format_seconds(notfact),
+                        }))
+        if to_write:
+            with Transaction().set_context(_check_access=False):
+                cls.write(*to_write)
 
-            # Calcul des divers totaux pour le TS
-            tmp_totts_nopct, tmp_totts, tmp_tot_fact_ts, tmp_tot_notfact_ts = 0, 0, 0, 0
-
-            for t in f.timesheet_ids:
-
-                if t.task and t.duration and t.duration.total_seconds():
-                    tmp_totts_nopct += t.duration.total_seconds()
-                if t.task and t.duration and t.duration.total_seconds():
-                    tmp_totts += t.duration.total_seconds()*(int(t.pct)/100)
-                if t.invoiced and t.task and t.duration and t.duration.total_seconds():
-                    tmp_tot_fact_ts += t.duration.total_seconds()*(int(t.pct)/100)
-                if not t.invoiced and t.task and t.duration and t.duration.total_seconds():
-                    tmp_tot_notfact_ts += t.duration.total_seconds()*(int(t.pct)/100)
-
-            # Totaux sur les heures
-            f.newfolder_tot_ts_withoutpct = timedelta(seconds=tmp_totts_nopct)
-            f.newfolder_tot_ts = timedelta(seconds=tmp_totts)
-            f.newfolder_tot_fact_ts = timedelta(seconds=tmp_tot_fact_ts)
-            f.newfolder_tot_notfact_ts = timedelta(seconds=tmp_tot_notfact_ts)
-
-            f.newfolder_expected_txt = f.newfolder_expected and format_seconds(
-                f.newfolder_expected.total_seconds()) or '-'
-            f.newfolder_tot_ts_withoutpct_txt = format_seconds(tmp_totts_nopct)
-            f.newfolder_tot_ts_txt = format_seconds(tmp_totts)
-            f.newfolder_tot_fact_ts_txt = format_seconds(tmp_tot_fact_ts)
-            f.newfolder_tot_notfact_ts_txt = format_seconds(tmp_tot_notfact_ts)
-
-            f.save()
-        return True
+    @staticmethod
+    def _expected_txt(expected):
+        return expected and format_seconds(expected.total_seconds()) or '-'
     #####################
 
     @classmethod
     @ModelView.button
     def update_prices(cls, folders):
-        corresp = {
-            'T1': folders[0].folder_price1,
-            'T2': folders[0].folder_price2,
-            'T3': folders[0].folder_price3,
-            'T4': folders[0].folder_price4,
-            'T5': folders[0].folder_price5,
-        }
-
-        for ts_line in folders[0].timesheet_ids:
-
-            # if ts_line.invoiced:
-            #    continue
-
-            if ts_line.resp_id:
-                if corresp.get(ts_line.resp_id.employee_type, None) :
-                    ts_line.hour_price = corresp[ts_line.resp_id.employee_type]
+        cls.reprice_timesheets(folders)
 
-                    print(corresp[ts_line.resp_id.employee_type])
-            ts_line.save()
+    @classmethod
+    def reprice_timesheets(cls, folders, codes=None):
+        """
+        Applique aux timesheets des dossiers le tarif (T1..T5) du type de
+        leur employé: un write par tarif et par prix, pour tous les dossiers.
+        Un tarif vide laisse les prix existants inchangés.
+        """
+        pool = Pool()
+        FolderSheet = pool.get('pl_cust_plfolders.foldersheet')
+
+        if codes is None:
+            codes = list(TARIFF_FIELDS)
+        by_price = defaultdict(list)
+        for folder in folders:
+            for code in codes:
+                price = getattr(folder, TARIFF_FIELDS[code])
+                if price:
+                    by_price[(code, price)].append(folder.id)
+
+        for (code, price), folder_ids in by_price.items():
+            for sub_ids in grouped_slice(folder_ids):
+                lines = FolderSheet.search([
+                        ('folder_id', 'in', list(sub_ids)),
+                        ('resp_id.employee_type', '=', code),
+                        ['OR',
+                            ('hour_price', '=', None),
+                            ('hour_price', '!=', price),
+                            ],
+                        ])
+                if lines:
+                    FolderSheet.write(lines, {'hour_price': price})
 
     @classmethod
     def copy(cls, folders, default=None):
@@ -612,16 +785,27 @@ class Folders(DeactivableMixin, Workflow, ModelSQL, ModelView):
         for values in vlist:
             if not values.get('name'):
                 values['name'] = cls._new_name()
+            if 'newfolder_expected' in values:
+                values['newfolder_expected_txt'] = cls._expected_txt(
+                    values['newfolder_expected'])
 
         return super().create(vlist)
 
     @classmethod
     def write(cls, *args):
+        args = list(args)
+        for i in range(1, len(args), 2):
+            if 'newfolder_expected' in args[i]:
+                args[i] = args[i].copy()
+                args[i]['newfolder_expected_txt'] = cls._expected_txt(
+                    args[i]['newfolder_expected'])
         super().write(*args)
         actions = iter(args)
         for folders, values in zip(actions, actions):
-            cls.update_prices(folders)
-            
+            codes = [c for c, f in TARIFF_FIELDS.items() if f in values]
+            if codes:
+                cls.reprice_timesheets(folders, codes)
+
 
 class FoldSequence(DeactivableMixin, ModelSQL, ModelView):
     "Sequence"
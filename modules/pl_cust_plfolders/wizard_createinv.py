@@ -137,6 +137,7 @@ class CreateInvoice(Wizard):
             
         invoice_obj = pool.get('account.invoice')
         invoice_line_obj = pool.get('account.invoice.line')
+        ts_obj = pool.get('pl_cust_plfolders.foldersheet')
     
         if self.start.folder_id.fact_to:
             party = self.start.folder_id.fact_to
@@ -174,6 +175,7 @@ class CreateInvoice(Wizard):
         ts_list_tva = ''
         ts_list_notva = ''
         ts_price_tot_notva = 0.0
+        ts_invoiced = []
 
         for ts in ts_to_do:
             if not ts.invoiced:
@@ -206,8 +208,9 @@ class CreateInvoice(Wizard):
                                                          ts.duration, ts.price)
 
                 print(new_invoice[0].id)
-                ts.invoice_id = new_invoice[0].id
-                ts.save()
+                ts_invoiced.append(ts)
+
+        ts_obj.write(ts_invoiced, {'invoice_id': new_invoice[0].id})
 
         print(compute_ts)
         pool = Pool()
@@ -12,6 +12,7 @@ from trytond.pyson import Date
 from datetime import datetime, timedelta
 
 from trytond.model.exceptions import ValidationError
+from trytond.modules.pl_cust_plbase.attachment import AttachmentMixin
 
 class BudgetError(ValidationError):
     pass
@@ -248,7 +249,7 @@ class ProjectStage(sequence_ordered(), ModelSQL, ModelView):
             ('/tree', 'visual', If(Eval('is_done'), 'warning', '')),
         ]
 
-class Projects(DeactivableMixin, Workflow, ModelSQL, ModelView):
+class Projects(AttachmentMixin, DeactivableMixin, Workflow, ModelSQL, ModelView):
     "projects"
     __name__ = "pl_cust_plprojects.projects"
 
@@ -271,7 +272,6 @@ class Projects(DeactivableMixin, Workflow, ModelSQL, ModelView):
     project_axe = fields.Selection("get_project_axe", "Axe")
     project_axe_string = project_axe.translated("project_axe")
 
-    as_attachment = fields.Function(fields.Boolean("pj"), "get_as_attachement")
 
     parties = fields.One2Many(
         "pl_cust_plprojects.partyaddr.relation", "project", "Parties")
@@ -318,17 +318,6 @@ class Projects(DeactivableMixin, Workflow, ModelSQL, ModelView):
             if project.amount_min and project.amount_max and project.amount_min > project.amount_max:
                 raise BudgetError("Pour le budget, le montant minimum ne peut pas être supérieur au montant maximum.")
 
-    @classmethod
-    def get_as_attachement(cls, invoices, name):
-        pool = Pool()
-        ATTACH = pool.get("ir.attachment")
-
-        res = {i.id: False for i in invoices}
-        for inv in invoices:
-            if ATTACH.search([("resource", "=", inv)]):
-                res[inv.id] = True
-        return res
-
     @classmethod
     def __setup__(cls):
         super().__setup__()
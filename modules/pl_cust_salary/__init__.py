@@ -4,6 +4,8 @@
 from trytond.pool import Pool
 from .salary import *
 from .salary_report import *
+from .salary_run import *
+from .salary_year import *
 
 def register():
     Pool.register(
@@ -14,14 +16,19 @@ def register():
         SalaryContract,
         SalarySalaryLine, 
         SalarySalary,
+        SalaryRun,
+        SalaryYearStart,
+        SalaryYearResult,
         module='pl_cust_salary', type_='model')
 
     Pool.register(
         SalaryReport,
+        SalaryYearReport,
         module='pl_cust_salary', type_='report')
     
     Pool.register(
        CreateSalary,
+       SalaryYear,
        module='pl_cust_salary', type_='wizard')
 
 
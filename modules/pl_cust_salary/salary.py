@@ -4,6 +4,7 @@ from trytond.wizard import Wizard, StateView, StateTransition, StateAction, Butt
 from trytond.model import ModelSingleton, ModelSQL, DeactivableMixin, ModelView, fields, sequence_ordered
 from trytond.pyson import Eval, Bool, If, PYSONEncoder
 from datetime import datetime, timedelta
+from types import SimpleNamespace
 from trytond.pool import PoolMeta, Pool
 from trytond.report import Report
 from trytond.rpc import RPC
@@ -17,6 +18,42 @@ class UnableToDelete(ValidationError):
     pass
 
 
+# Champs de la fiche qui changent les montants des lignes et le salaire net
+SALARY_AMOUNT_FIELDS = {
+    'gross_salary', 'prim', 'prim2', 'prim3', 'prim4_without_tax',
+    'car_charge', 'alloc_charge', 'is_charge', 'lpp_charge', 'line_ids'}
+LINE_AMOUNT_FIELDS = {'salary', 'tx_employee', 'tx_boss', 'max_gross_salary'}
+
+
+def _round_005(amount):
+    return round(amount / 0.05) * 0.05
+
+
+def get_line_amounts(salary, tx_employee, tx_boss, max_gross_salary):
+    """
+    Montants employé et employeur d'une charge sociale, arrondis à 5 centimes.
+    `salary` est une fiche ou tout objet ayant ses attributs.
+    """
+    if not salary or not salary.gross_salary:
+        return 0, 0
+    tot_salary = salary.gross_salary + salary.prim + salary.prim2 + salary.prim3 + salary.car_charge
+    if max_gross_salary and tot_salary > max_gross_salary:
+        tot_salary = max_gross_salary
+    amount_employee = tx_employee and tx_employee > 0 and _round_005(tot_salary * (tx_employee/100.0)) or 0
+    amount_boss = tx_boss and tx_boss > 0 and _round_005(tot_salary * (tx_boss/100.0)) or 0
+    return amount_employee, amount_boss
+
+
+def get_is_charge_amount(salary):
+    return salary.is_charge > 0 and _round_005((salary.gross_salary + salary.prim + salary.prim2 + salary.prim3 + salary.car_charge + salary.alloc_charge) * (salary.is_charge/100.0)) or 0
+
+
+def get_net_salary(salary, tot_employee):
+    "Salaire net, `tot_employee` étant la somme des charges employé des lignes"
+    tot_charge = tot_employee + get_is_charge_amount(salary) + salary.lpp_charge
+    return salary.gross_salary + salary.prim + salary.prim2 + salary.prim3 + salary.prim4_without_tax - tot_charge
+
+
 __all__ = ['SalEmployee', 'SalaryCat',
            'SalaryConfSocialCharge', 'SocialCharges', 'CreateSalary', 'SalaryContract',
            'SalarySalaryLine', 'SalarySalary']
@@ -121,33 +158,8 @@ class CreateSalary(Wizard):
         contract_id = Transaction().context.get('active_id', '')
         contr = Contract(contract_id)
 
-        company = Transaction().context.get('company')
-
-        sal = Salary(name='FS',
-                     contract=contr,
-                     date=Date_.today(),
-                     gross_salary_contract=contr.gross_salary,
-                     gross_salary=contr.gross_salary,
-                     resp_id=contr.resp_id,
-                     car_charge=contr.car_charge,
-                     alloc_charge=contr.alloc_charge,
-                     is_charge=contr.is_charge,
-                     lpp_charge=contr.lpp_charge,
-                     car_charge_txt=contr.car_charge_txt,
-                     alloc_charge_txt=contr.alloc_charge_txt,
-                     is_charge_txt=contr.is_charge_txt,
-                     lpp_charge_txt=contr.lpp_charge_txt,
-                     prim_txt=contr.prim_txt,
-                     prim=contr.prim,
-                     prim2_txt=contr.prim2_txt,
-                     prim2=contr.prim2,
-                     prim3_txt=contr.prim3_txt,
-                     prim3=contr.prim3,
-                     prim4_txt_without_tax=contr.prim4_txt_without_tax,
-                     prim4_without_tax=contr.prim4_without_tax
-                     )
-
-        sal.save()
+        sal, = Salary.create([
+                Salary.get_contract_values(contr, Date_.today())])
 
         self.new_sal = sal
 
@@ -326,30 +338,61 @@ class SalarySalaryLine(sequence_ordered(), ModelSQL, ModelView):
     tx_employee = fields.Float('Tx Employee', readonly=True)
     max_gross_salary = fields.Integer('Max Gross Salary', readonly=True)
 
-    amount_employee = fields.Function(fields.Float(
-        'Amount Employ'), 'on_change_with_amount_employee')
-    amount_boss = fields.Function(fields.Float(
-        'Amount Boss'), 'on_change_with_amount_boss')
+    amount_employee = fields.Float('Amount Employ', readonly=True)
+    amount_boss = fields.Float('Amount Boss', readonly=True)
 
-    @fields.depends('salary', 'tx_employee')
+    @staticmethod
+    def default_amount_employee():
+        return 0.0
+
+    @staticmethod
+    def default_amount_boss():
+        return 0.0
+
+    @fields.depends('salary', '_parent_salary.gross_salary',
+        '_parent_salary.prim', '_parent_salary.prim2', '_parent_salary.prim3',
+        '_parent_salary.car_charge', 'tx_employee', 'max_gross_salary')
     def on_change_with_amount_employee(self, name=None):
-        if self.salary and self.salary.gross_salary:
-            tot_salary = self.salary.gross_salary + self.salary.prim + self.salary.prim2 + self.salary.prim3 + self.salary.car_charge
-            if self.max_gross_salary and tot_salary > self.max_gross_salary:
-                tot_salary = self.max_gross_salary
-            return self.tx_employee > 0 and round((tot_salary * (self.tx_employee/100.0))/0.05)*0.05 or 0
-        else:
-            return 0
+        return get_line_amounts(self.salary, self.tx_employee, 0,
+            self.max_gross_salary)[0]
 
-    @fields.depends('salary', 'tx_boss')
+    @fields.depends('salary', '_parent_salary.gross_salary',
+        '_parent_salary.prim', '_parent_salary.prim2', '_parent_salary.prim3',
+        '_parent_salary.car_charge', 'tx_boss', 'max_gross_salary')
     def on_change_with_amount_boss(self, name=None):
-        if self.salary and self.salary.gross_salary:
-            tot_salary = self.salary.gross_salary + self.salary.prim + self.salary.prim2 + self.salary.prim3 + self.salary.car_charge
-            if self.max_gross_salary and tot_salary > self.max_gross_salary:
-                tot_salary = self.max_gross_salary
-            return self.tx_boss > 0 and round((tot_salary * (self.tx_boss/100.0))/0.05)*0.05 or 0
-        else:
-            return 0
+        return get_line_amounts(self.salary, 0, self.tx_boss,
+            self.max_gross_salary)[1]
+
+    @classmethod
+    def create(cls, vlist):
+        lines = super().create(vlist)
+        cls._update_salarys({l.salary.id for l in lines})
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        salary_ids = set()
+        actions = iter(args)
+        for lines, values in zip(actions, actions):
+            if LINE_AMOUNT_FIELDS & values.keys():
+                salary_ids.update(l.salary.id for l in lines)
+                if values.get('salary'):
+                    salary_ids.add(values['salary'])
+        super().write(*args)
+        cls._update_salarys(salary_ids)
+
+    @classmethod
+    def delete(cls, lines):
+        salary_ids = {l.salary.id for l in lines}
+        super().delete(lines)
+        cls._update_salarys(salary_ids)
+
+    @classmethod
+    def _update_salarys(cls, salary_ids):
+        if not salary_ids or Transaction().context.get('_salary_amounts'):
+            return
+        Salary = Pool().get('pl_cust_salary.salary')
+        Salary.update_amounts(Salary.browse(list(salary_ids)))
 
 class SalarySalary(ModelSQL, ModelView):
     'SalarySalary'
@@ -383,8 +426,7 @@ class SalarySalary(ModelSQL, ModelView):
     gross_salary = fields.Float('Gross Salary',states={'readonly': Bool(
         Eval('compta')), }, depends=['compta'])
 
-    net_salary = fields.Function(fields.Float(
-        'Net Salary'), 'on_change_with_net_salary')
+    net_salary = fields.Float('Net Salary', readonly=True)
 
     prim_txt = fields.Char('Prim txt', states={'readonly': Bool(
         Eval('compta')), }, depends=['compta'])
@@ -429,6 +471,7 @@ class SalarySalary(ModelSQL, ModelView):
         Eval('compta')), }, depends=['compta'])
 
     compta = fields.Many2One('account.move', 'Move', readonly=False)
+    run = fields.Many2One('pl_cust_salary.run', 'Salary Run', readonly=True)
 
     compta_state = fields.Function(fields.Char(
         'Compta state'), 'on_change_with_compta_state')
@@ -449,123 +492,168 @@ class SalarySalary(ModelSQL, ModelView):
             ('/tree', 'visual', If((Eval('compta_state', '') == 'ok'), 'success', '')),
         ]
 
+    @classmethod
+    def __register__(cls, module_name):
+        table_h = cls.__table_handler__(module_name)
+        fill_amounts = not table_h.column_exist('net_salary')
+
+        super().__register__(module_name)
+
+        # Montants des fiches existantes, avant calculés à chaque lecture
+        if fill_amounts:
+            cls._fill_amounts()
+
+    @classmethod
+    def _fill_amounts(cls):
+        SALARYLINE = Pool().get('pl_cust_salary.salaryline')
+        table = cls.__table__()
+        line = SALARYLINE.__table__()
+        cursor = Transaction().connection.cursor()
+
+        columns = ['id', 'gross_salary', 'prim', 'prim2', 'prim3',
+            'prim4_without_tax', 'car_charge', 'alloc_charge', 'is_charge',
+            'lpp_charge']
+        cursor.execute(*table.select(*[getattr(table, c) for c in columns]))
+        salarys = {}
+        for row in cursor.fetchall():
+            salary = SimpleNamespace(**{c: v or 0 for c, v in zip(columns, row)})
+            salary.tot_employee = 0
+            salarys[salary.id] = salary
+
+        cursor.execute(*line.select(line.id, line.salary, line.tx_employee,
+                line.tx_boss, line.max_gross_salary))
+        for line_id, salary_id, tx_employee, tx_boss, max_gross_salary in (
+                cursor.fetchall()):
+            salary = salarys.get(salary_id)
+            amount_employee, amount_boss = get_line_amounts(
+                salary, tx_employee, tx_boss, max_gross_salary)
+            cursor.execute(*line.update(
+                    [line.amount_employee, line.amount_boss],
+                    [amount_employee, amount_boss],
+                    where=line.id == line_id))
+            if salary:
+                salary.tot_employee += amount_employee
+
+        for salary in salarys.values():
+            cursor.execute(*table.update(
+                    [table.net_salary],
+                    [get_net_salary(salary, salary.tot_employee)],
+                    where=table.id == salary.id))
+
+    @classmethod
+    def get_contract_values(cls, contract, date):
+        "Valeurs d'une nouvelle fiche de salaire reprises du contrat"
+        return {
+            'name': 'FS',
+            'contract': contract.id,
+            'date': date,
+            'gross_salary_contract': contract.gross_salary,
+            'gross_salary': contract.gross_salary,
+            'resp_id': contract.resp_id.id,
+            'car_charge': contract.car_charge,
+            'alloc_charge': contract.alloc_charge,
+            'is_charge': contract.is_charge,
+            'lpp_charge': contract.lpp_charge,
+            'car_charge_txt': contract.car_charge_txt,
+            'alloc_charge_txt': contract.alloc_charge_txt,
+            'is_charge_txt': contract.is_charge_txt,
+            'lpp_charge_txt': contract.lpp_charge_txt,
+            'prim_txt': contract.prim_txt,
+            'prim': contract.prim,
+            'prim2_txt': contract.prim2_txt,
+            'prim2': contract.prim2,
+            'prim3_txt': contract.prim3_txt,
+            'prim3': contract.prim3,
+            'prim4_txt_without_tax': contract.prim4_txt_without_tax,
+            'prim4_without_tax': contract.prim4_without_tax,
+            }
+
+    def _get_move_lines(self):
+        Line = Pool().get('account.move.line')
+        party = self.resp_id.party
+        contract = self.contract
+
+        lines = [
+            Line(party=party,
+                account=contract.sal_cat.account_charge,
+                debit='{:.2f}'.format(round((self.gross_salary + self.prim + self.prim2 + self.prim3 + self.prim4_without_tax), 2))),
+            ]
+
+        if self.lpp_charge > 0:
+            lines.append(Line(party=party,
+                    account=contract.lpp_charge_cat.account_cc,
+                    credit='{:.2f}'.format(round(self.lpp_charge*2, 2))))
+
+        if self.is_charge > 0:
+            lines.append(Line(party=party,
+                    account=contract.is_charge_cat.account_cc,
+                    credit='{:.2f}'.format(round(self.is_charge_amount, 2))))
+
+        lines.append(Line(party=party,
+                account=contract.sal_cat.account_cc,
+                credit='{:.2f}'.format(round(self.net_salary, 2))))
+
+        if self.lpp_charge > 0:
+            lines.append(Line(party=party,
+                    account=contract.lpp_charge_cat.account_charge,
+                    debit='{:.2f}'.format(round((self.lpp_charge), 2))))
+
+        charges = {}
+        for sl in self.line_ids:
+            if not charges.get(sl.cat):
+                charges[sl.cat] = {
+                    'deb': 0,
+                    'cred': 0,
+                    'account_deb': sl.account_charge,
+                    'account_cred': sl.account_cc}
+
+            charges[sl.cat]['deb'] += sl.amount_boss
+            charges[sl.cat]['cred'] += sl.amount_boss + sl.amount_employee
+
+        for k in charges.keys():
+            lines.append(Line(party=party,
+                    account=charges[k]['account_deb'],
+                    debit='{:.2f}'.format(round(charges[k]['deb'], 2))))
+            lines.append(Line(party=party,
+                    account=charges[k]['account_cred'],
+                    credit='{:.2f}'.format(round(charges[k]['cred'], 2))))
+        return lines
+
     @classmethod
     def valid_and_compta(cls, salarys):
+        """
+        Comptabilise les fiches: une pièce par fiche, toutes enregistrées
+        puis validées en un seul appel.
+        """
         pool = Pool()
         Journal = pool.get('account.journal')
-        Currency = pool.get('currency.currency')
         Move = pool.get('account.move')
-        Line = pool.get('account.move.line')
         Period = pool.get('account.period')
 
         company = Transaction().context.get('company')
 
-        journal = Journal.search([('code', '=', 'CHA')])[0]
-        sal_line_brut = None
-        lpp_line_cred = None
-        is_line_cred = None
-        sal_line_net = None
-        lpp_line_deb = None
+        salarys = [s for s in salarys if not s.compta]
+        if not salarys:
+            return True
 
+        journal = Journal.search([('code', '=', 'CHA')])[0]
+        periods = {}
+        moves = []
         for salary in salarys:
-            period = Period.find(company, date=salary.date)
-            sal_line_brut = Line(
-                party=salary.resp_id.party,
-                account=salary.contract.sal_cat.account_charge,
-                debit='{:.2f}'.format(round((salary.gross_salary + salary.prim + salary.prim2 + salary.prim3 + salary.prim4_without_tax), 2)))
-
-            sal_line_net = Line(
-                party=salary.resp_id.party,
-                account=salary.contract.sal_cat.account_cc,
-                credit='{:.2f}'.format(round(salary.net_salary, 2)))
-
-            if salary.lpp_charge > 0:
-                lpp_line_deb = Line(
-                    party=salary.resp_id.party,
-                    account=salary.contract.lpp_charge_cat.account_charge,
-                    debit='{:.2f}'.format(round((salary.lpp_charge), 2)))
-
-                lpp_line_cred = Line(
-                    party=salary.resp_id.party,
-                    account=salary.contract.lpp_charge_cat.account_cc,
-                    credit='{:.2f}'.format(round(salary.lpp_charge*2, 2)))
-
-            if salary.is_charge > 0:
-                is_line_cred = Line(
-                    party=salary.resp_id.party,
-                    account=salary.contract.is_charge_cat.account_cc,
-                    credit='{:.2f}'.format(round(salary.is_charge_amount, 2)))
-
-            charges = {}
-            for sl in salary.line_ids:
-                if not charges.get(sl.cat):
-                    charges[sl.cat] = {
-                        'deb': 0,
-                        'cred': 0,
-                        'account_deb': sl.account_charge,
-                        'account_cred': sl.account_cc}
-
-                charges[sl.cat]['deb'] += sl.amount_boss
-                charges[sl.cat]['cred'] += sl.amount_boss + sl.amount_employee
-
-            lines = []
-            for l in [sal_line_brut, lpp_line_cred, is_line_cred, sal_line_net, lpp_line_deb]:
-                if l:
-                    lines.append(l)
-
-            for k in charges.keys():
-                l_deb = Line(party=salary.resp_id.party,
-                             account=charges[k]['account_deb'],
-                             debit='{:.2f}'.format(round(charges[k]['deb'], 2)))
-                l_cred = Line(party=salary.resp_id.party,
-                              account=charges[k]['account_cred'],
-                              credit='{:.2f}'.format(round(charges[k]['cred'], 2)))
-                lines.append(l_deb)
-                lines.append(l_cred)
-
-            move = Move(journal=journal, state='draft', date=salary.date, period=period,
-                        # origin=cls,
-                        description=salary.name,
-                        company=company, lines=lines)
-
-            move.save()
-            Move.post([move])
-            salary.compta = move
-            salary.save()
-
-        # debit_line = Line(account=self.account)
-        # counterpart_line = Line()
-
-        # lines = [pay_line, counterpart_line]
-
-        # pay_line.debit, pay_line.credit = 0, pay_amount
-
-        #         pay_line.debit, pay_line.credit = pay_amount, 0
-
-        #     overpayment_line = Line(account=self.account)
-        #     lines.insert(1, overpayment_line)
-        #     overpayment_line.debit = (
-        #         abs(overpayment) if pay_line.debit else 0)
-        #     overpayment_line.credit = (
-        #         abs(overpayment) if pay_line.credit else 0)
-
-        # counterpart_line.debit = abs(amount) if pay_line.credit else 0
-        # counterpart_line.credit = abs(amount) if pay_line.debit else 0
-        # if counterpart_line.debit:
-        #     payment_acccount = 'debit_account'
-        # else:
-        #     payment_acccount = 'credit_account'
-        # counterpart_line.account = getattr(
-        #     payment_method, payment_acccount).current(date=date)
-
-        # period = Period.find(self.company, date=date)
-
-        # move = Move(
-        #     journal=payment_method.journal, period=period, date=date,
-        #     origin=self, description=description,
-        #     company=self.company, lines=lines)
-        # move.save()
-        # Move.post([move])
+            if salary.date not in periods:
+                periods[salary.date] = Period.find(company, date=salary.date)
+            moves.append(Move(journal=journal, state='draft', date=salary.date,
+                    period=periods[salary.date],
+                    description=salary.name,
+                    company=company, lines=salary._get_move_lines()))
+
+        Move.save(moves)
+        Move.post(moves)
+
+        to_write = []
+        for salary, move in zip(salarys, moves):
+            to_write.extend(([salary], {'compta': move.id}))
+        cls.write(*to_write)
 
         return True
 
@@ -606,17 +694,12 @@ class SalarySalary(ModelSQL, ModelView):
 
     @fields.depends('is_charge', 'gross_salary', 'prim', 'prim2', 'prim3', 'car_charge', 'alloc_charge')
     def on_change_with_is_charge_amount(self, name=None):
-        return self.is_charge > 0 and round(((self.gross_salary + self.prim + self.prim2 + self.prim3 + self.car_charge + self.alloc_charge) * (self.is_charge/100.0))/0.05)*0.05 or 0
+        return get_is_charge_amount(self)
 
-    @fields.depends('is_charge_amount', 'gross_salary', 'prim', 'prim2', 'prim3', 'prim4_without_tax', 'car_charge', 'alloc_charge', 'line_ids', 'lpp_charge')
+    @fields.depends('is_charge', 'gross_salary', 'prim', 'prim2', 'prim3', 'prim4_without_tax', 'car_charge', 'alloc_charge', 'line_ids', 'lpp_charge')
     def on_change_with_net_salary(self, name=None):
-        tot_charge = 0
-        for l in self.line_ids:
-            tot_charge += l.amount_employee
-
-        tot_charge += self.is_charge_amount
-        tot_charge += self.lpp_charge
-        return self.gross_salary + self.prim + self.prim2 + self.prim3 + self.prim4_without_tax - tot_charge
+        return get_net_salary(
+            self, sum(l.amount_employee or 0 for l in self.line_ids))
 
     @fields.depends('contract', 'resp_id', 'gross_salary', 'car_charge', 'alloc_charge', 'is_charge', 'lpp_charge')
     def on_change_contract(self):
@@ -660,19 +743,65 @@ class SalarySalary(ModelSQL, ModelView):
         res = super().create(vlist)
         SALARYLINE = pool.get('pl_cust_salary.salaryline')
 
-        for sc in res[0].contract.socialcharge_ids:
-            print(sc)
-            print(sc.cat.account_charge)
-            print(sc.charge.tx_boss)
-            tmp = SALARYLINE.create([{
-                                    'name': sc.charge.name,
-                                    'cat': sc.cat.name,
-                                    'account_charge': sc.cat.account_charge.id,
-                                    'account_cc': sc.cat.account_cc.id,
-                                    'tx_boss': sc.charge.tx_boss,
-                                    'tx_employee': sc.charge.tx_employee,
-                                    'max_gross_salary': sc.charge.max_gross_salary,
-                                    'salary': res[0].id,
-                                    }])
+        lines = []
+        for salary in res:
+            for sc in salary.contract.socialcharge_ids:
+                lines.append({
+                        'name': sc.charge.name,
+                        'cat': sc.cat.name,
+                        'account_charge': sc.cat.account_charge.id,
+                        'account_cc': sc.cat.account_cc.id,
+                        'tx_boss': sc.charge.tx_boss,
+                        'tx_employee': sc.charge.tx_employee,
+                        'max_gross_salary': sc.charge.max_gross_salary,
+                        'salary': salary.id,
+                        })
+        with Transaction().set_context(_salary_amounts=True):
+            if lines:
+                SALARYLINE.create(lines)
+        cls.update_amounts(res)
 
         return res
+
+    @classmethod
+    def write(cls, *args):
+        to_update = []
+        actions = iter(args)
+        for salarys, values in zip(actions, actions):
+            if SALARY_AMOUNT_FIELDS & values.keys():
+                to_update.extend(salarys)
+        super().write(*args)
+        if to_update and not Transaction().context.get('_salary_amounts'):
+            cls.update_amounts(cls.browse(to_update))
+
+    @classmethod
+    def update_amounts(cls, salarys):
+        """
+        Enregistre les montants des lignes et le salaire net des fiches,
+        seulement ceux qui ont changé.
+        """
+        SALARYLINE = Pool().get('pl_cust_salary.salaryline')
+
+        to_write_lines = []
+        to_write = []
+        for salary in salarys:
+            tot_employee = 0
+            for line in salary.line_ids:
+                amount_employee, amount_boss = get_line_amounts(salary,
+                    line.tx_employee, line.tx_boss, line.max_gross_salary)
+                if (line.amount_employee != amount_employee
+                        or line.amount_boss != amount_boss):
+                    to_write_lines.extend(([line], {
+                                'amount_employee': amount_employee,
+                                'amount_boss': amount_boss,
+                                }))
+                tot_employee += amount_employee
+            net_salary = get_net_salary(salary, tot_employee)
+            if salary.net_salary != net_salary:
+                to_write.extend(([salary], {'net_salary': net_salary}))
+
+        with Transaction().set_context(_salary_amounts=True):
+            if to_write_lines:
+                SALARYLINE.write(*to_write_lines)
+            if to_write:
+                cls.write(*to_write)
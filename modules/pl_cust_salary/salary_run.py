@@ -0,0 +1,148 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import logging
+import time
+from datetime import timedelta
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.model.exceptions import ValidationError
+from trytond.pool import Pool
+from trytond.pyson import Eval
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['SalaryRun']
+
+STATES = [
+    ('draft', 'Draft'),
+    ('generated', 'Generated'),
+    ('posted', 'Posted'),
+]
+
+
+class UnableToDeleteRun(ValidationError):
+    pass
+
+
+class SalaryRun(ModelSQL, ModelView):
+    'Salary Run'
+    __name__ = 'pl_cust_salary.run'
+
+    name = fields.Char('Name', required=True,
+        states={'readonly': Eval('state') != 'draft'}, depends=['state'])
+    date = fields.Date('Date', required=True,
+        help="Date des fiches: la paie est faite pour le mois de cette date",
+        states={'readonly': Eval('state') != 'draft'}, depends=['state'])
+    period = fields.Char('Period', readonly=True)
+    state = fields.Selection(STATES, 'State', readonly=True)
+    salary_ids = fields.One2Many(
+        'pl_cust_salary.salary', 'run', 'Salary', readonly=True)
+    nb_salaries = fields.Function(fields.Integer('Nb Salaries'),
+        'get_nb_salaries')
+    generate_time = fields.Float('Generate Time (s)', digits=(16, 2),
+        readonly=True)
+    post_time = fields.Float('Post Time (s)', digits=(16, 2), readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order = [
+            ('date', 'DESC'),
+        ]
+        cls._buttons.update({
+            'generate': {
+                'invisible': Eval('state') != 'draft',
+                'depends': ['state'],
+            },
+            'post': {
+                'invisible': Eval('state') != 'generated',
+                'depends': ['state'],
+            },
+        })
+
+    @staticmethod
+    def default_state():
+        return 'draft'
+
+    @staticmethod
+    def default_date():
+        Date_ = Pool().get('ir.date')
+        return Date_.today()
+
+    def get_nb_salaries(self, name):
+        return len(self.salary_ids)
+
+    @classmethod
+    def delete(cls, runs):
+        for run in runs:
+            if run.state == 'posted':
+                raise UnableToDeleteRun(
+                    "Impossible de supprimer une paie comptabilisée")
+        super().delete(runs)
+
+    @staticmethod
+    def _month(date):
+        first = date.replace(day=1)
+        last = (first + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        return first, last
+
+    def get_contracts(self):
+        """
+        Contrats actifs pendant le mois de la paie et sans fiche de salaire
+        pour ce mois.
+        """
+        pool = Pool()
+        Contract = pool.get('pl_cust_salary.contract')
+        Salary = pool.get('pl_cust_salary.salary')
+
+        first, last = self._month(self.date)
+        contracts = Contract.search([
+                ('active', '=', True),
+                ['OR', ('date_start', '=', None), ('date_start', '<=', last)],
+                ['OR', ('date_end', '=', None), ('date_end', '>=', first)],
+                ])
+        done = {s.contract.id for s in Salary.search([
+                    ('contract', 'in', [c.id for c in contracts]),
+                    ('date', '>=', first),
+                    ('date', '<=', last),
+                    ])}
+        return [c for c in contracts if c.id not in done]
+
+    @classmethod
+    @ModelView.button
+    def generate(cls, runs):
+        Salary = Pool().get('pl_cust_salary.salary')
+        for run in runs:
+            start = time.perf_counter()
+            period = run.date.strftime('%m.%Y')
+            vlist = []
+            for contract in run.get_contracts():
+                values = Salary.get_contract_values(contract, run.date)
+                values['period'] = period
+                values['run'] = run.id
+                vlist.append(values)
+            Salary.create(vlist)
+            elapsed = time.perf_counter() - start
+            logger.info("Salary run %s: %s slips generated in %.2fs",
+                run.name, len(vlist), elapsed)
+            cls.write([run], {
+                    'state': 'generated',
+                    'period': period,
+                    'generate_time': elapsed,
+                    })
+
+    @classmethod
+    @ModelView.button
+    def post(cls, runs):
+        Salary = Pool().get('pl_cust_salary.salary')
+        for run in runs:
+            start = time.perf_counter()
+            Salary.valid_and_compta(run.salary_ids)
+            elapsed = time.perf_counter() - start
+            logger.info("Salary run %s: %s slips posted in %.2fs",
+                run.name, len(run.salary_ids), elapsed)
+            cls.write([run], {
+                    'state': 'posted',
+                    'post_time': elapsed,
+                    })
+
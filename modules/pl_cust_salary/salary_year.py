@@ -0,0 +1,216 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import csv
+import datetime
+import io
+from collections import defaultdict
+
+from sql import Literal, Union
+from sql.aggregate import Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import Extract, Round
+
+from trytond.model import ModelView, fields
+from trytond.pool import Pool
+from trytond.report import Report
+from trytond.transaction import Transaction
+from trytond.wizard import Wizard, StateView, StateTransition, StateReport, \
+    Button
+
+__all__ = ['SalaryYearStart', 'SalaryYearResult', 'SalaryYear',
+           'SalaryYearReport']
+
+MONTHS = range(1, 13)
+
+# Catégories calculées sur la fiche elle-même, après celles des lignes
+BRUT = 'BRUT'
+NET = 'NET'
+LPP = 'LPP'
+IS = 'IS'
+
+
+def get_year_totals(year, employee_ids=None):
+    """
+    Charges et salaires de l'année en une requête groupée par employé,
+    catégorie et mois: {employee_id: {cat: {month: [employé, employeur]}}}.
+    Les lignes de charges (AVS, AC, ...) sont groupées par catégorie, LPP,
+    IS, brut et net sont lus sur les fiches.
+    """
+    pool = Pool()
+    Salary = pool.get('pl_cust_salary.salary')
+    SalaryLine = pool.get('pl_cust_salary.salaryline')
+    salary = Salary.__table__()
+    line = SalaryLine.__table__()
+    cursor = Transaction().connection.cursor()
+
+    where = ((salary.date >= datetime.date(year, 1, 1))
+        & (salary.date <= datetime.date(year, 12, 31)))
+    if employee_ids:
+        where &= salary.resp_id.in_(employee_ids)
+    month = Extract('MONTH', salary.date)
+
+    def col(name):
+        return Coalesce(getattr(salary, name), 0)
+
+    gross = (col('gross_salary') + col('prim') + col('prim2') + col('prim3')
+        + col('prim4_without_tax'))
+    # Arrondi à 5 centimes comme get_is_charge_amount
+    is_amount = Case((col('is_charge') > 0,
+            Round((col('gross_salary') + col('prim') + col('prim2')
+                    + col('prim3') + col('car_charge') + col('alloc_charge'))
+                * col('is_charge') / 100.0 / 0.05) * 0.05),
+        else_=0)
+
+    group_by = [salary.resp_id, month]
+    lines = line.join(salary, condition=line.salary == salary.id).select(
+        salary.resp_id, line.cat, month,
+        Sum(line.amount_employee), Sum(line.amount_boss),
+        where=where, group_by=group_by + [line.cat])
+
+    def salary_query(cat, amount_employee, amount_boss):
+        return salary.select(
+            salary.resp_id, Literal(cat), month,
+            Sum(amount_employee), Sum(amount_boss),
+            where=where, group_by=group_by)
+
+    query = Union(lines,
+        salary_query(LPP, col('lpp_charge'), col('lpp_charge')),
+        salary_query(IS, is_amount, Literal(0)),
+        salary_query(BRUT, gross, Literal(0)),
+        salary_query(NET, col('net_salary'), Literal(0)),
+        all_=True)
+    cursor.execute(*query)
+
+    res = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: [0, 0])))
+    for employee_id, cat, month, amount_employee, amount_boss in cursor:
+        amounts = res[employee_id][cat or ''][int(month)]
+        amounts[0] += amount_employee or 0
+        amounts[1] += amount_boss or 0
+    return res
+
+
+def _sorted_cats(cats):
+    "Catégories des lignes par ordre alphabétique, puis LPP, IS, brut et net"
+    fixed = [LPP, IS, BRUT, NET]
+    return sorted(c for c in cats if c not in fixed) + [
+        c for c in fixed if c in cats]
+
+
+def get_year_summary(year, employee_ids=None):
+    """
+    Totaux de l'année par employé, prêts pour le rapport et l'export:
+    liste de {'employee':, 'lines': [{'cat':, 'months':, 'employee':,
+    'boss':}]} triée par nom d'employé.
+    """
+    Employee = Pool().get('company.employee')
+    totals = get_year_totals(year, employee_ids)
+
+    summary = []
+    for employee in Employee.browse(list(totals.keys())):
+        cats = totals[employee.id]
+        lines = []
+        for cat in _sorted_cats(cats):
+            months = [round(cats[cat][m][0], 2) for m in MONTHS]
+            lines.append({
+                    'cat': cat,
+                    'months': months,
+                    'employee': round(sum(a[0] for a in cats[cat].values()), 2),
+                    'boss': round(sum(a[1] for a in cats[cat].values()), 2),
+                    })
+        summary.append({'employee': employee, 'lines': lines})
+    summary.sort(key=lambda s: s['employee'].rec_name)
+    return summary
+
+
+class SalaryYearStart(ModelView):
+    'Salary Year Summary'
+    __name__ = 'pl_cust_salary.salary_year_start'
+
+    year = fields.Integer('Year', required=True,
+        domain=[('year', '>', 2000)], depends=['year'])
+    employees = fields.Many2Many(
+        'company.employee', None, None, 'Employees',
+        help="Tous les employés si vide")
+
+    @staticmethod
+    def default_year():
+        Date_ = Pool().get('ir.date')
+        return Date_.today().year - 1
+
+
+class SalaryYearResult(ModelView):
+    'Salary Year Export'
+    __name__ = 'pl_cust_salary.salary_year_result'
+
+    name = fields.Char('File Name', readonly=True)
+    file = fields.Binary('File', filename='name', readonly=True)
+
+
+class SalaryYear(Wizard):
+    'Salary Year Summary'
+    __name__ = 'pl_cust_salary.salary_year'
+
+    start = StateView('pl_cust_salary.salary_year_start',
+        'pl_cust_salary.salary_year_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Export', 'export', 'tryton-save'),
+            Button('Print', 'print_', 'tryton-print', default=True),
+            ])
+    print_ = StateReport('pl_cust_salary.salary_year_report')
+    export = StateTransition()
+    result = StateView('pl_cust_salary.salary_year_result',
+        'pl_cust_salary.salary_year_result_view_form', [
+            Button('Close', 'end', 'tryton-close'),
+            ])
+
+    def _get_data(self):
+        return {
+            'year': self.start.year,
+            'employee_ids': [e.id for e in self.start.employees],
+            }
+
+    def do_print_(self, action):
+        return action, self._get_data()
+
+    def transition_export(self):
+        "Fichier CSV de tous les employés: une ligne par catégorie"
+        data = self._get_data()
+        summary = get_year_summary(data['year'], data['employee_ids'])
+
+        f = io.StringIO()
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(['Employé', 'No AVS', 'Catégorie']
+            + [str(m) for m in MONTHS] + ['Total employé', 'Total employeur'])
+        for s in summary:
+            employee = s['employee']
+            for line in s['lines']:
+                writer.writerow([employee.rec_name, employee.avs_num or '',
+                        line['cat']] + line['months']
+                    + [line['employee'], line['boss']])
+
+        self.result.name = 'salaires-{}.csv'.format(data['year'])
+        self.result.file = f.getvalue().encode('utf8')
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'name': self.result.name,
+            'file': self.result.file,
+            }
+
+
+class SalaryYearReport(Report):
+    __name__ = 'pl_cust_salary.salary_year_report'
+
+    @classmethod
+    def get_context(cls, records, headers, data):
+        pool = Pool()
+        Date = pool.get('ir.date')
+
+        context = super().get_context(records, headers, data)
+        context['year'] = data['year']
+        context['summary'] = get_year_summary(
+            data['year'], data.get('employee_ids'))
+        context['months'] = list(MONTHS)
+        context['mytoday_now'] = Date.today().strftime('%d.%m.%Y')
+        return context
@@ -3,9 +3,13 @@ from trytond.model import ModelView, fields
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 from datetime import datetime, date
-import codecs
-import os
+from collections import Counter
 import csv
+import io
+
+from sql import Column, Literal
+from sql.aggregate import Count, Sum
+from sql.functions import Extract
 
 from trytond.model.exceptions import ValidationError
 
@@ -16,168 +20,221 @@ class TSReportError(ValidationError):
 
 __all__ = ['WizardExport', 'WizardStart', 'WizardResult']
 
-stats = {'tel': 0,
-         'tel_spec': 0,
-         'tchat': 0,
-         'mail': 0,
-         'duree': 0,
-         'f': 0,
-         'h': 0,
-         'hf': 0,
-         'quotidien': 0,
-         'relation': 0,
-         'couple': 0,
-         'solitude': 0,
-         'sociaux': 0,
-         'famille': 0,
-         'travail': 0,
-         'violence': 0,
-         'physique': 0,
-         'psychique': 0,
-         'sexualite': 0,
-         'spiritualite': 0,
-         'dependance': 0,
-         'suicide': 0,
-         'corona': 0,
-         'guerre': 0,
-         'media': 0,
-         'mort': 0,
-         'divers': 0,
-         'vd': 0,
-         'sos': 0,
-         'lavi': 0,
-         'vih': 0,
-         'inconnu': 0,
-         'ocase': 0,
-         'connu': 0,
-         '-18': 0,
-         '19-40': 0,
-         '41-65': 0,
-         '+65': 0,
-         'age_nd': 0,
-         }
-
-
-stats_vd = {'tel': 0,
-            'tel_spec': 0,
-            'tchat': 0,
-            'duree': 0,
-            'f': 0,
-            'h': 0,
-            'hf': 0,
-            'inconnu': 0,
-            'ocase': 0,
-            'connu': 0,
-            '-18': 0,
-            '19-40': 0,
-            '41-65': 0,
-            '+65': 0,
-            'age_nd': 0,
-            'ge': 0,
-            'vd': 0,
-            'ne': 0,
-            'vs': 0,
-            'fr': 0,
-            'ju': 0,
-            'orig_autre': 0,
-            'aut': 0,
-            'vict': 0,
-            'tem': 0,
-            'pro': 0,
-            'role_autre': 0,
-            'conj': 0,
-            'exconj': 0,
-            'par': 0,
-            'vois': 0,
-            'ami': 0,
-            'rel_autre': 0,
-            'phys': 0,
-            'psy': 0,
-            'sex': 0,
-            'eco': 0,
-            'type_autre': 0,
-            }
-
-stats_sos = {'tel': 0,
-             'tel_spec': 0,
-             'tchat': 0,
-             'mail': 0,
-             'duree': 0,
-             'f': 0,
-             'h': 0,
-             'hf': 0,
-             'inconnu': 0,
-             'ocase': 0,
-             'connu': 0,
-             '-18': 0,
-             '19-40': 0,
-             '41-65': 0,
-             '+65': 0,
-             'age_nd': 0,
-             'ge': 0,
-             'vd': 0,
-             'ne': 0,
-             'vs': 0,
-             'fr': 0,
-             'ju': 0,
-             'france': 0,
-             'prov_autre': 0,
-             'nr': 0,
-             'tech': 0,
-             'rens_exl': 0,
-             'rens_dep' : 0,
-             'rens_prest' :0,
-             'aide': 0,
-             'prob_autre': 0,
-             'j': 0,
-             'p': 0,
-             'pro': 0,
-             'role_autre': 0,
-             'bourse': 0,
-             'lotel': 0,
-             'lot': 0,
-             'grat': 0,
-             'par': 0,
-             'pmu': 0,
-             'pocker': 0,
-             'mas': 0,
-             'table': 0,
-             'illeg': 0,
-             'autre': 0,
-             'call_type_terrestre': 0,
-             'call_type_internet': 0,
-             }
-
-stats_vih = {'tel': 0,
-             'tel_spec': 0,
-             'tchat': 0,
-             'mail': 0,
-             'duree': 0,
-             'f': 0,
-             'h': 0,
-             'hf': 0,
-             'inconnu': 0,
-             'ocase': 0,
-             'connu': 0,
-             '-18': 0,
-             '19-40': 0,
-             '41-65': 0,
-             '+65': 0,
-             'age_nd': 0,
-             'ge': 0,
-             'vd': 0,
-             'ne': 0,
-             'vs': 0,
-             'fr': 0,
-             'ju': 0,
-             'autre': 0,
-             'nr': 0,
-             'avt_test': 0,
-             'apr_test': 0,
-             'rens': 0,
-             'tiers': 0,
-             }
-               
+MONTHS = range(1, 13)
+
+# Lignes du fichier, dans l'ordre, pour chaque section
+GENERAL_ROWS = ['tel_spec',
+                'tel',
+                'tchat',
+                'mail',
+                'duree',
+                'f',
+                'h',
+                'hf',
+                '-18',
+                '19-40',
+                '41-65',
+                '+65',
+                'age_nd',
+                'inconnu',
+                'ocase',
+                'connu',
+                'quotidien',
+                'psychique',
+                'corona',
+                'physique',
+                'solitude',
+                'famille',
+                'relation',
+                'couple',
+                'travail',
+                'sociaux',
+                'violence',
+                'sexualite',
+                'spiritualite',
+                'dependance',
+                'suicide',
+                'mort',
+                'guerre',
+                'divers',
+                'lavi',
+                'vd',
+                'sos',
+                'vih',
+                ]
+
+VD_ROWS = ['tel_spec',
+           'tel',
+           'tchat',
+           'duree',
+           'f',
+           'h',
+           'hf',
+           '-18',
+           '19-40',
+           '41-65',
+           '+65',
+           'age_nd',
+           'inconnu',
+           'ocase',
+           'connu',
+           'ge',
+           'vd',
+           'ne',
+           'vs',
+           'fr',
+           'ju',
+           'orig_autre',
+           'aut',
+           'vict',
+           'tem',
+           'pro',
+           'role_autre',
+           'conj',
+           'exconj',
+           'par',
+           'vois',
+           'ami',
+           'rel_autre',
+           'phys',
+           'psy',
+           'sex',
+           'eco',
+           'type_autre',
+           ]
+
+SOS_ROWS = ['tel_spec',
+            'tel',
+            'tchat',
+            'duree',
+            'f',
+            'h',
+            'hf',
+            '-18',
+            '19-40',
+            '41-65',
+            '+65',
+            'age_nd',
+            'inconnu',
+            'ocase',
+            'connu',
+            'ge',
+            'vd',
+            'ne',
+            'vs',
+            'fr',
+            'ju',
+            'france',
+            'prov_autre',
+            'nr',
+            'tech',
+            'rens_exl',
+            'rens_dep',
+            'rens_prest',
+            'aide',
+            'prob_autre',
+            'j',
+            'p',
+            'pro',
+            'role_autre',
+            'bourse',
+            'lotel',
+            'lot',
+            'grat',
+            'par',
+            'pmu',
+            'pocker',
+            'mas',
+            'table',
+            'illeg',
+            'autre',
+            'call_type_terrestre',
+            'call_type_internet',
+            ]
+
+# Profil de l'appelant, compté dans toutes les sections
+PROFILE_COLUMNS = ['call_user_age', 'call_user_gender', 'call_user_type']
+CONTENU_COLUMNS = ['contenu', 'contenu_2', 'contenu_3']
+SOS_COLUMNS = ['call_origin_sos', 'call_problem_sos', 'call_role_sos',
+               'call_type_sos']
+# Colonnes VD et ligne utilisée pour la valeur 'autre'
+VD_COLUMNS = [('call_origin_vd', 'orig_autre'),
+              ('call_role_vd', 'role_autre'),
+              ('call_rel_vd', 'rel_autre'),
+              ('call_type_vd', 'type_autre')]
+
+GROUP_COLUMNS = (['call_type'] + CONTENU_COLUMNS + PROFILE_COLUMNS
+                 + SOS_COLUMNS
+                 + ['call_type_terrestre_sos', 'call_type_internet_sos']
+                 + [c for c, _ in VD_COLUMNS])
+
+
+def _call_groups(year):
+    """
+    Appels de l'année regroupés par mois et par valeur de chaque dimension:
+    une seule requête, une ligne par combinaison rencontrée avec le nombre
+    d'appels et la durée totale.
+    """
+    Calls = Pool().get('pl_cust_tel.calls')
+    calls = Calls.__table__()
+    cursor = Transaction().connection.cursor()
+
+    month = Extract('MONTH', calls.call_date)
+    columns = [Column(calls, c) for c in GROUP_COLUMNS]
+    cursor.execute(*calls.select(
+            month, *columns,
+            Count(Literal('*')), Sum(calls.call_length),
+            where=((calls.call_date >= date(year, 1, 1))
+                & (calls.call_date <= date(year, 12, 31))),
+            group_by=[month] + columns))
+    for row in cursor:
+        group = dict(zip(GROUP_COLUMNS, row[1:-2]))
+        group['month'] = int(row[0])
+        group['count'] = row[-2]
+        group['duree'] = row[-1] or 0
+        yield group
+
+
+def compute_stats(year):
+    "Compteurs par section et par mois: {section: {mois: Counter}}"
+    res = {s: {m: Counter() for m in MONTHS}
+           for s in ('tel', 'tchat', 'mail', 'sos', 'vd')}
+
+    for g in _call_groups(year):
+        month, count = g['month'], g['count']
+
+        # Entretien / Tchat / Mail: tous les types d'appels, puis le
+        # détail des appels du type de la section
+        for section in ('tel', 'tchat', 'mail'):
+            c = res[section][month]
+            c[g['call_type']] += count
+            if g['call_type'] != section:
+                continue
+            for col in PROFILE_COLUMNS + CONTENU_COLUMNS:
+                if g[col]:
+                    c[g[col]] += count
+            c['duree'] += g['duree']
+
+        if g['contenu'] == 'sos':
+            c = res['sos'][month]
+            for col in PROFILE_COLUMNS + ['call_type'] + SOS_COLUMNS:
+                c[g[col]] += count
+            c['duree'] += g['duree']
+            if g['call_type_terrestre_sos']:
+                c['call_type_terrestre'] += count
+            if g['call_type_internet_sos']:
+                c['call_type_internet'] += count
+
+        if g['contenu'] == 'vd':
+            c = res['vd'][month]
+            for col in PROFILE_COLUMNS + ['call_type']:
+                c[g[col]] += count
+            c['duree'] += g['duree']
+            for col, other in VD_COLUMNS:
+                c[other if g[col] == 'autre' else g[col]] += count
+    return res
+
+
 class WizardStart(ModelView):
     """ First window to choose the export year """
     __name__ = 'pl_cust_tel.wizard_start'
@@ -229,449 +286,45 @@ class WizardExport(Wizard):
         """ Generates a CSV file containing call statistics """
         file_name = f'export-{self.start.year_export}.csv'
         delimiter = ';'
-        file_path = f'/tmp/{file_name}'
-
-        f = codecs.open('/tmp/' + file_name,
-                        'wb',
-                        encoding='utf-8')
-
-        writer = csv.writer(f, delimiter=delimiter)       
-
-        dict_res = {1: stats.copy(),
-                    2: stats.copy(),
-                    3: stats.copy(),
-                    4: stats.copy(),
-                    5: stats.copy(),
-                    6: stats.copy(),
-                    7: stats.copy(),
-                    8: stats.copy(),
-                    9: stats.copy(),
-                    10: stats.copy(),
-                    11: stats.copy(),
-                    12: stats.copy(),
-                    }
-
-        dict_res_tchat = {1: stats.copy(),
-                          2: stats.copy(),
-                          3: stats.copy(),
-                          4: stats.copy(),
-                          5: stats.copy(),
-                          6: stats.copy(),
-                          7: stats.copy(),
-                          8: stats.copy(),
-                          9: stats.copy(),
-                          10: stats.copy(),
-                          11: stats.copy(),
-                          12: stats.copy(),
-                          }
-
-        dict_res_mail = {1: stats.copy(),
-                         2: stats.copy(),
-                         3: stats.copy(),
-                         4: stats.copy(),
-                         5: stats.copy(),
-                         6: stats.copy(),
-                         7: stats.copy(),
-                         8: stats.copy(),
-                         9: stats.copy(),
-                         10: stats.copy(),
-                         11: stats.copy(),
-                         12: stats.copy(),
-                         }
-
-        dict_res_sos = {1: stats_sos.copy(),
-                        2: stats_sos.copy(),
-                        3: stats_sos.copy(),
-                        4: stats_sos.copy(),
-                        5: stats_sos.copy(),
-                        6: stats_sos.copy(),
-                        7: stats_sos.copy(),
-                        8: stats_sos.copy(),
-                        9: stats_sos.copy(),
-                        10: stats_sos.copy(),
-                        11: stats_sos.copy(),
-                        12: stats_sos.copy(),
-                        }
-
-        dict_res_vd = {1: stats_vd.copy(),
-                       2: stats_vd.copy(),
-                       3: stats_vd.copy(),
-                       4: stats_vd.copy(),
-                       5: stats_vd.copy(),
-                       6: stats_vd.copy(),
-                       7: stats_vd.copy(),
-                       8: stats_vd.copy(),
-                       9: stats_vd.copy(),
-                       10: stats_vd.copy(),
-                       11: stats_vd.copy(),
-                       12: stats_vd.copy(),
-                       }
-
-        dict_res_vih = {1: stats_vih.copy(),
-                        2: stats_vih.copy(),
-                        3: stats_vih.copy(),
-                        4: stats_vih.copy(),
-                        5: stats_vih.copy(),
-                        6: stats_vih.copy(),
-                        7: stats_vih.copy(),
-                        8: stats_vih.copy(),
-                        9: stats_vih.copy(),
-                        10: stats_vih.copy(),
-                        11: stats_vih.copy(),
-                        12: stats_vih.copy(),
-                        }
-
-        # Fetch calls from the database
-        pool = Pool()
-        CALLS = pool.get('pl_cust_tel.calls')
-        # Get date range for the selected year
-        date_start = f"{self.start.year_export}-01-01"
-        date_end = f"{self.start.year_export}-12-31"
-        all_calls = CALLS.search([
-            ('call_date', '>=', date_start),
-            ('call_date', '<=', date_end)
-        ])
-        # Process call records
-        for call in all_calls:
-            
-
-            if call.call_date:  # Ensure call_date is not None
-                month = call.call_date.month
-                dict_res[month][call.call_type] += 1
-                dict_res_tchat[month][call.call_type] += 1
-                dict_res_mail[month][call.call_type] += 1
-            #else :
-            #    continue 
-
-            
-            
-            if call.call_type == 'tel':
-                dict_res[month][call.call_user_age] += 1
-                dict_res[month][call.call_user_gender] += 1
-                dict_res[month][call.call_user_type] += 1
-                dict_res[month][call.contenu] += 1
-                if call.contenu_2:
-                    dict_res[month][call.contenu_2] += 1
-                if call.contenu_3:
-                    dict_res[month][call.contenu_3] += 1
-                dict_res[month]['duree'] += call.call_length
-                
-            if call.call_type == 'tchat':
-                dict_res_tchat[month][call.call_user_age] += 1
-                dict_res_tchat[month][call.call_user_gender] += 1
-                dict_res_tchat[month][call.call_user_type] += 1
-                dict_res_tchat[month][call.contenu] += 1
-                if call.contenu_2:
-                    dict_res_tchat[month][call.contenu_2] += 1
-                if call.contenu_3:
-                    dict_res_tchat[month][call.contenu_3] += 1
-                dict_res_tchat[month]['duree'] += call.call_length
-            
-            if call.call_type == 'mail':
-                dict_res_mail[month][call.call_user_age] += 1
-                dict_res_mail[month][call.call_user_gender] += 1
-                dict_res_mail[month][call.call_user_type] += 1
-                dict_res_mail[month][call.contenu] += 1
-                if call.contenu_2:
-                    dict_res_mail[month][call.contenu_2] += 1
-                if call.contenu_3:
-                    dict_res_mail[month][call.contenu_3] += 1
-                dict_res_mail[month]['duree'] += call.call_length
-                
-            if call.contenu == 'sos':
-                dict_res_sos[month][call.call_user_age] += 1
-                dict_res_sos[month][call.call_user_gender] += 1
-                dict_res_sos[month][call.call_user_type] += 1
-                dict_res_sos[month][call.call_type] += 1
-                dict_res_sos[month]['duree'] += call.call_length
-                dict_res_sos[month][call.call_origin_sos] += 1
-                dict_res_sos[month][call.call_problem_sos] += 1
-                dict_res_sos[month][call.call_role_sos] += 1
-                dict_res_sos[month][call.call_type_sos] += 1
-                dict_res_sos[month]['call_type_terrestre'] += call.call_type_terrestre_sos and 1 or 0
-                dict_res_sos[month]['call_type_internet'] += call.call_type_internet_sos and 1 or 0
-
-            if call.contenu == 'vih':
-                dict_res_vih[month][call.call_user_age] += 1
-                dict_res_vih[month][call.call_user_gender] += 1
-                dict_res_vih[month][call.call_user_type] += 1
-                dict_res_vih[month][call.call_type] += 1
-                dict_res_vih[month]['duree'] += call.call_length
-                dict_res_vih[month][call.call_origin_vih] += 1
-                dict_res_vih[month][call.call_motif_vih] += 1
-                
-            if call.contenu == 'vd':
-                dict_res_vd[month][call.call_user_age] += 1
-                dict_res_vd[month][call.call_user_gender] += 1
-                dict_res_vd[month][call.call_user_type] += 1
-                dict_res_vd[month][call.call_type] += 1
-                dict_res_vd[month]['duree'] += call.call_length
-                if call.call_origin_vd == 'autre':
-                    dict_res_vd[month]['orig_autre'] += 1
-                else :
-                    dict_res_vd[month][call.call_origin_vd] += 1
-                if call.call_role_vd == 'autre':
-                    dict_res_vd[month]['role_autre'] += 1
-                else :
-                    dict_res_vd[month][call.call_role_vd] += 1
-                if call.call_rel_vd == 'autre':
-                    dict_res_vd[month]['rel_autre'] += 1
-                else :
-                    dict_res_vd[month][call.call_rel_vd] += 1
-                if call.call_type_vd == 'autre':
-                    dict_res_vd[month]['type_autre'] += 1
-                else :
-                    dict_res_vd[month][call.call_type_vd] += 1
-                                        
-        for k1 in ['tel_spec',
-                'tel',
-                'tchat',
-                'mail',
-                'duree',
-                'f',
-                'h',
-                'hf',
-                '-18',
-                '19-40',
-                '41-65',
-                '+65',
-                'age_nd',
-                'inconnu',
-                'ocase',
-                'connu',
-                'quotidien',
-                'psychique',
-                'corona',
-                'physique',
-                'solitude',
-                'famille',
-                'relation',
-                'couple',
-                'travail',
-                'sociaux',
-                'violence',
-                'sexualite',
-                'spiritualite',
-                'dependance',
-                'suicide',
-                'mort',
-                'guerre',
-                'divers',
-                'lavi',
-                'vd',
-                'sos',
-                'vih'] :
 
-            writer.writerow([k1]+[dict_res[i][k1] for i in range(1, 13)])
-        
+        res = compute_stats(self.start.year_export)
+
+        f = io.StringIO()
+        writer = csv.writer(f, delimiter=delimiter)
+
+        def write_section(section, rows):
+            for key in rows:
+                writer.writerow([key] + [res[section][i][key] for i in MONTHS])
+
+        write_section('tel', GENERAL_ROWS)
+
         writer.writerow('')
         writer.writerow(['Violences Domestiques'])
-        for k2 in ['tel_spec',
-                   'tel',
-                   'tchat',
-                   'duree',
-                   'f',
-                   'h',
-                   'hf',
-                   '-18',
-                   '19-40',
-                   '41-65',
-                   '+65',
-                   'age_nd',
-                   'inconnu',
-                   'ocase',
-                   'connu',
-                   'ge',
-                   'vd',
-                   'ne',
-                   'vs',
-                   'fr',
-                   'ju',
-                   'orig_autre',
-                   'aut',
-                   'vict',
-                   'tem',
-                   'pro',
-                   'role_autre',
-                   'conj',
-                   'exconj',
-                   'par',
-                   'vois',
-                   'ami',
-                   'rel_autre',
-                   'phys',
-                   'psy',
-                   'sex',
-                   'eco',
-                   'type_autre',
-                   ]:
-
-            writer.writerow([k2]+[dict_res_vd[i][k2] for i in range(1, 13)])
+        write_section('vd', VD_ROWS)
 
         writer.writerow('')
         writer.writerow(['SOS Jeux'])
-
-        for k3 in ['tel_spec',
-                   'tel',
-                   'tchat',
-                   'duree',
-                   'f',
-                   'h',
-                   'hf',
-                   '-18',
-                   '19-40',
-                   '41-65',
-                   '+65',
-                   'age_nd',
-                   'inconnu',
-                   'ocase',
-                   'connu',
-                   'ge',
-                   'vd',
-                   'ne',
-                   'vs',
-                   'fr',
-                   'ju',
-                   'france',
-                   'prov_autre',
-                   'nr',
-                   'tech',
-                   'rens_exl',
-                   'rens_dep',
-                   'rens_prest',
-                   'aide',
-                   'prob_autre',
-                   'j',
-                   'p',
-                   'pro',
-                   'role_autre',
-                   'bourse',
-                   'lotel',
-                   'lot',
-                   'grat',
-                   'par',
-                   'pmu',
-                   'pocker',
-                   'mas',
-                   'table',
-                   'illeg',
-                   'autre',
-                   'call_type_terrestre',
-                   'call_type_internet',
-                   ]:
-
-            writer.writerow([k3]+[dict_res_sos[i][k3] for i in range(1, 13)])
+        write_section('sos', SOS_ROWS)
 
         writer.writerow('')
         writer.writerow(['Tchat'])
+        write_section('tchat', GENERAL_ROWS)
 
-        for k1 in ['tel_spec',
-                   'tel',
-                   'tchat',
-                   'mail',
-                   'duree',
-                   'f',
-                   'h',
-                   'hf',
-                   '-18',
-                   '19-40',
-                   '41-65',
-                   '+65',
-                   'age_nd',
-                   'inconnu',
-                   'ocase',
-                   'connu',
-                   'quotidien',
-                   'psychique',
-                   'corona',
-                   'physique',
-                   'solitude',
-                   'famille',
-                   'relation',
-                   'couple',
-                   'travail',
-                   'sociaux',
-                   'violence',
-                   'sexualite',
-                   'spiritualite',
-                   'dependance',
-                   'suicide',
-                   'mort',
-                   'guerre',
-                   'divers',
-                   'lavi',
-                   'vd',
-                   'sos',
-                   'vih',
-                   ]:
-
-            writer.writerow([k1]+[dict_res_tchat[i][k1] for i in range(1, 13)])
-        
         writer.writerow('')
         writer.writerow(['Mail'])
-
-        for k1 in ['tel_spec',
-                   'tel',
-                   'tchat',
-                   'mail',
-                   'duree',
-                   'f',
-                   'h',
-                   'hf',
-                   '-18',
-                   '19-40',
-                   '41-65',
-                   '+65',
-                   'age_nd',
-                   'inconnu',
-                   'ocase',
-                   'connu',
-                   'quotidien',
-                   'psychique',
-                   'corona',
-                   'physique',
-                   'solitude',
-                   'famille',
-                   'relation',
-                   'couple',
-                   'travail',
-                   'sociaux',
-                   'violence',
-                   'sexualite',
-                   'spiritualite',
-                   'dependance',
-                   'suicide',
-                   'mort',
-                   'guerre',
-                   'divers',
-                   'lavi',
-                   'vd',
-                   'sos',
-                   'vih',
-                   ]:
-
-            writer.writerow([k1]+[dict_res_mail[i][k1] for i in range(1, 13)])
+        write_section('mail', GENERAL_ROWS)
 
         writer.writerow('')
         writer.writerow('')
-        f.close()    
+
         # Assign generated file to wizard result
         self.result.name = file_name
+        self.result.file = f.getvalue().encode('utf8')
         return 'result'
 
     def default_result(self, fields):
         """ Provides the generated file for download """
-        file_name = self.result.name
-        file_path = f"/tmp/{file_name}"
-
-        # Read the generated file
-        with codecs.open(file_path, 'rb', 'utf-8') as f:
-            data = f.read()
-
-        # Delete file after reading
-        os.unlink(file_path)
-
         return {
-            'name': file_name,
-            'file': data.encode('utf8'),
+            'name': self.result.name,
+            'file': self.result.file,
         }
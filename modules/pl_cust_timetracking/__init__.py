@@ -7,6 +7,7 @@ from .ttwizard import *
 from .ttprintreport import *
 from .add_day_wizard import *
 from .hlwizard import *
+from .ttbalance import *
 
 def register():
     Pool.register(
@@ -18,6 +19,9 @@ def register():
         TTDaysType,
         TTHours,
         TTOvertimeValidate,
+        TTBalance,
+        Employee,
+        Cron,
         TTWizardStart,
         TTPrintReportStart,
         TTAddDayWizardStart,
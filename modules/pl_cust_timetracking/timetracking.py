@@ -1,13 +1,16 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 from decimal import Decimal
-from trytond.model import DeactivableMixin, ModelView, ModelSQL, Workflow, fields
+from trytond.model import (
+    DeactivableMixin, Index, ModelView, ModelSQL, Workflow, fields)
 from trytond.transaction import Transaction
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval, If
 from trytond import backend
 from trytond.pyson import Date
+from trytond.tools import grouped_slice, reduce_ids
 from datetime import datetime, timedelta, time
+from collections import defaultdict
 import pytz
 
 from trytond.model.exceptions import ValidationError
@@ -31,6 +34,36 @@ def secTohms(nb_sec):
     return h, m, s
 
 
+def day_totals(hours):
+    """
+    Validité et total d'une journée à partir de ses pointages triés par
+    heure, [(type_hour, employ_hour), ...]: retourne (not_valid, tot_hours).
+    Les pointages doivent alterner in/out; tot_hours vaut None si une paire
+    est incomplète ou si une sortie précède son entrée.
+    """
+    not_valid = bool(len(hours) % 2)
+    t_next = 'in'
+    for type_hour, _ in hours:
+        if not_valid:
+            break
+        if type_hour != t_next:
+            not_valid = True
+        t_next = t_next == 'in' and 'out' or 'in'
+
+    if not hours or len(hours) % 2:
+        return not_valid, None
+
+    t_tot = 0
+    for (t1, h1), (t2, h2) in zip(hours[::2], hours[1::2]):
+        if t1 != 'in' or t2 != 'out':
+            return not_valid, None
+        elif not h1 or not h2 or not h2 > h1:
+            return not_valid, None
+        t_tot += ((h2.hour*60 + h2.minute) - (h1.hour*60 + h1.minute)) * 60
+    tmp_h, tmp_m, tmp_s = secTohms(t_tot)
+    return not_valid, time(tmp_h, tmp_m, tmp_s)
+
+
 __all__ = ['TTTimetables', 'TTDays', 'TTDaysType', 'TTHours',
            'TTOvertimeValidate', 'TTWeeklyDetail', 'TTWeeklyDetailHours']
 
@@ -44,6 +77,28 @@ HOUR_TYPE = [
     ('out', 'Out'),
 ]
 
+# Champs des pointages qui changent les totaux du jour
+HOUR_TOTAL_FIELDS = {'day_id', 'type_hour', 'employ_hour'}
+DAY_TOTAL_FIELDS = {'not_valid', 'tot_hours', 'tot_duration'}
+# Champs qui changent le solde d'heures supplémentaires
+DAY_BALANCE_FIELDS = {'tot_duration', 'day_type', 'date', 'employee_id'}
+TIMETABLE_BALANCE_FIELDS = {
+    'date_start', 'date_end', 'employee_id', 'weekly_duration',
+    'weekly_detail', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+    'saturday', 'sunday'}
+
+
+def invalidate_balances(changes):
+    "Supprime les soldes d'heures à partir des (employee_id, date) modifiés"
+    dates = {}
+    for employee_id, date in changes:
+        if employee_id and date and (
+                employee_id not in dates or date < dates[employee_id]):
+            dates[employee_id] = date
+    if dates:
+        TTBalance = Pool().get('pl_cust_timetracking.ttbalance')
+        TTBalance.invalidate(dates)
+
 DAYS = [('mon', 'Lundi'),
         ('tue', 'Mardi'),
         ('wed', 'Mercredi'),
@@ -63,6 +118,33 @@ class TTWeeklyDetailHours(ModelSQL, ModelView):
     weekly_detail_id = fields.Many2One(
         'pl_cust_timetracking.ttweeklydetail', 'WeeklyDetail', ondelete='CASCADE')
 
+    # Les heures font weekly_duration_auto de l'horaire
+    @staticmethod
+    def _balance_changes(hours):
+        return [(h.weekly_detail_id.timetable_id.employee_id.id,
+                h.weekly_detail_id.timetable_id.date_start)
+            for h in hours
+            if h.weekly_detail_id and h.weekly_detail_id.timetable_id]
+
+    @classmethod
+    def create(cls, vlist):
+        hours = super().create(vlist)
+        invalidate_balances(cls._balance_changes(hours))
+        return hours
+
+    @classmethod
+    def write(cls, *args):
+        hours = sum(args[::2], [])
+        changes = cls._balance_changes(hours)
+        super().write(*args)
+        invalidate_balances(changes + cls._balance_changes(cls.browse(hours)))
+
+    @classmethod
+    def delete(cls, hours):
+        changes = cls._balance_changes(hours)
+        super().delete(hours)
+        invalidate_balances(changes)
+
 
 class TTWeeklyDetail(ModelSQL, ModelView):
     'Time Tracking Weekly Detail'
@@ -102,6 +184,31 @@ class TTWeeklyDetail(ModelSQL, ModelView):
 
         return None
 
+    @staticmethod
+    def _balance_changes(details):
+        return [(d.timetable_id.employee_id.id, d.timetable_id.date_start)
+            for d in details if d.timetable_id]
+
+    @classmethod
+    def create(cls, vlist):
+        details = super().create(vlist)
+        invalidate_balances(cls._balance_changes(details))
+        return details
+
+    @classmethod
+    def write(cls, *args):
+        details = sum(args[::2], [])
+        changes = cls._balance_changes(details)
+        super().write(*args)
+        invalidate_balances(
+            changes + cls._balance_changes(cls.browse(details)))
+
+    @classmethod
+    def delete(cls, details):
+        changes = cls._balance_changes(details)
+        super().delete(details)
+        invalidate_balances(changes)
+
 
 class TTTimetables(ModelSQL, ModelView):
     'Time Traking Work Timetables'
@@ -153,6 +260,33 @@ class TTTimetables(ModelSQL, ModelView):
 
         return 0
 
+    @classmethod
+    def create(cls, vlist):
+        timetables = super().create(vlist)
+        invalidate_balances(
+            (t.employee_id.id, t.date_start) for t in timetables)
+        return timetables
+
+    @classmethod
+    def write(cls, *args):
+        changed = []
+        actions = iter(args)
+        for timetables, values in zip(actions, actions):
+            if TIMETABLE_BALANCE_FIELDS & values.keys():
+                changed.extend(timetables)
+        # avant et après: la date de début ou l'employé peuvent changer
+        changes = [(t.employee_id.id, t.date_start) for t in changed]
+        super().write(*args)
+        changes.extend((t.employee_id.id, t.date_start)
+            for t in cls.browse(changed))
+        invalidate_balances(changes)
+
+    @classmethod
+    def delete(cls, timetables):
+        changes = [(t.employee_id.id, t.date_start) for t in timetables]
+        super().delete(timetables)
+        invalidate_balances(changes)
+
 class TTDaysType(ModelSQL, ModelView):
     'Time Traking Days Type'
     __name__ = 'pl_cust_timetracking.ttdaystype'
@@ -169,10 +303,10 @@ class TTDays(ModelSQL, ModelView):
         'company.employee', 'Employee', required=True)
     hours_ids = fields.One2Many(
         'pl_cust_timetracking.tthours', 'day_id', 'Hours List', search_order=[('')])
-    not_valid = fields.Function(fields.Boolean('Day not valid'),
-                                'on_change_with_not_valid')
-    tot_hours = fields.Function(fields.Time('To hours', format='%H:%M'),
-                                'on_change_with_tot_hours')
+    not_valid = fields.Boolean('Day not valid', readonly=True)
+    tot_hours = fields.Time('To hours', format='%H:%M', readonly=True)
+    tot_duration = fields.TimeDelta('Worked Duration', readonly=True,
+        help="Total des jours valides, pour les sommes SQL")
 
     day_type = fields.Selection('get_day_type', "Type")
     day_type_string = day_type.translated('day_type')
@@ -201,6 +335,80 @@ class TTDays(ModelSQL, ModelView):
         super().__setup__()
         cls._order.insert(0, ('date', 'DESC NULLS FIRST'))
         cls.hours_ids.search_order = [('employ_hour', 'ASC')]
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.employee_id, Index.Equality()),
+                (t.date, Index.Range())))
+
+    @classmethod
+    def __register__(cls, module_name):
+        table_h = cls.__table_handler__(module_name)
+        fill_totals = not table_h.column_exist('tot_duration')
+
+        super().__register__(module_name)
+
+        # Totaux des jours existants, avant stockés en champs fonction
+        if fill_totals:
+            table = cls.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*table.select(table.id))
+            day_ids = [i for i, in cursor]
+            for sub_ids in grouped_slice(day_ids):
+                for day_id, values in cls.get_day_totals(sub_ids).items():
+                    cursor.execute(*table.update(
+                            [getattr(table, f) for f in values],
+                            list(values.values()),
+                            where=table.id == day_id))
+
+    @staticmethod
+    def default_not_valid():
+        return False
+
+    @classmethod
+    def get_day_totals(cls, day_ids):
+        """
+        Validité et totaux des jours, calculés depuis leurs pointages lus en
+        une requête: {day_id: {'not_valid':, 'tot_hours':, 'tot_duration':}}
+        """
+        TTHours = Pool().get('pl_cust_timetracking.tthours')
+        hour = TTHours.__table__()
+        cursor = Transaction().connection.cursor()
+
+        hours = defaultdict(list)
+        for sub_ids in grouped_slice(day_ids):
+            cursor.execute(*hour.select(
+                    hour.day_id, hour.type_hour, hour.employ_hour,
+                    where=reduce_ids(hour.day_id, sub_ids),
+                    order_by=[hour.day_id, hour.employ_hour.asc, hour.id]))
+            for day_id, type_hour, employ_hour in cursor:
+                hours[day_id].append((type_hour, employ_hour))
+
+        res = {}
+        for day_id in day_ids:
+            not_valid, tot_hours = day_totals(hours[day_id])
+            tot_duration = None
+            if not not_valid and tot_hours:
+                tot_duration = timedelta(
+                    hours=tot_hours.hour, minutes=tot_hours.minute)
+            res[day_id] = {
+                'not_valid': not_valid,
+                'tot_hours': tot_hours,
+                'tot_duration': tot_duration,
+                }
+        return res
+
+    @classmethod
+    def update_totals(cls, days):
+        "Enregistre validité et totaux des jours"
+        totals = cls.get_day_totals([d.id for d in days])
+        to_write = []
+        for day in days:
+            values = totals[day.id]
+            if any(getattr(day, f) != v for f, v in values.items()):
+                to_write.extend(([day], values))
+        if to_write:
+            with Transaction().set_context(_check_access=False):
+                cls.write(*to_write)
 
     @classmethod
     def view_attributes(cls):
@@ -210,43 +418,13 @@ class TTDays(ModelSQL, ModelView):
 
     @fields.depends('hours_ids')
     def on_change_with_not_valid(self, name=None):
-
-        if len(self.hours_ids) % 2:
-            return True
-        elif self.hours_ids:
-            t_next = 'in'
-            for h in self.hours_ids:
-                if not h.type_hour == t_next:
-                    return True
-
-                t_next = t_next == 'in' and 'out' or 'in'
-
-        return False
+        return day_totals(
+            [(h.type_hour, h.employ_hour) for h in self.hours_ids])[0]
 
     @fields.depends('hours_ids')
     def on_change_with_tot_hours(self, name=None):
-
-        if len(self.hours_ids) % 2:
-            return None
-        elif self.hours_ids:
-            t_tot = 0
-
-            for i in range(0, len(self.hours_ids)-1, 2):
-                h1 = self.hours_ids[i]
-                h2 = self.hours_ids[i+1]
-                if not h1 or not h2:
-                    return None
-                elif not h1.type_hour or not h2.type_hour or not h1.type_hour == 'in' or not h2.type_hour == 'out':
-                    return None
-                elif not h2.employ_hour or not h1.employ_hour or not h2.employ_hour > h1.employ_hour:
-                    return None
-
-                t_tot += ((h2.employ_hour.hour*60 + h2.employ_hour.minute) -
-                          (h1.employ_hour.hour*60 + h1.employ_hour.minute)) * 60
-            tmp_h, tmp_m, tmp_s = secTohms(t_tot)
-            return time(tmp_h, tmp_m, tmp_s)
-
-        return None
+        return day_totals(
+            [(h.type_hour, h.employ_hour) for h in self.hours_ids])[1]
 
     @classmethod
     def write(cls, *args):
@@ -264,8 +442,17 @@ class TTDays(ModelSQL, ModelView):
         EMPLOYEE = Pool().get('company.employee')
         employ = EMPLOYEE(Transaction().context.get('employee'))
         print('on passe par ici')
+        changed = []
+        actions = iter(args)
+        for tdays, values in zip(actions, actions):
+            if DAY_BALANCE_FIELDS & values.keys():
+                changed.extend(tdays)
+        balance_changes = [(d.employee_id.id, d.date) for d in changed]
         actions = iter(args)
         for tdays, values in zip(actions, actions):
+            # Totaux recalculés depuis les pointages: pas de contrôle de date
+            if values.keys() <= DAY_TOTAL_FIELDS:
+                continue
             for d in tdays :
                 if not is_admin and 'date' in values.keys():
                     if values.get('date') and values.get('date') < _date_limite(today_):
@@ -275,8 +462,23 @@ class TTDays(ModelSQL, ModelView):
                     if d.date < _date_limite(today_):
                         raise DateValidationError(
                             "Vous ne pouvez pas modifier du timesheet pour cette date (Maximum 24h)")
-                    
+
         super().write(*args)
+        balance_changes.extend(
+            (d.employee_id.id, d.date) for d in cls.browse(changed))
+        invalidate_balances(balance_changes)
+
+    @classmethod
+    def create(cls, vlist):
+        days = super().create(vlist)
+        invalidate_balances((d.employee_id.id, d.date) for d in days)
+        return days
+
+    @classmethod
+    def delete(cls, days):
+        changes = [(d.employee_id.id, d.date) for d in days]
+        super().delete(days)
+        invalidate_balances(changes)
 
 class TTHours(ModelSQL, ModelView):
     'Time Traking Hours'
@@ -318,6 +520,37 @@ class TTHours(ModelSQL, ModelView):
         super().__setup__()
         cls._order.insert(0, ('employ_hour', 'ASC'))
 
+    @classmethod
+    def create(cls, vlist):
+        hours = super().create(vlist)
+        cls._update_days({h.day_id.id for h in hours if h.day_id})
+        return hours
+
+    @classmethod
+    def write(cls, *args):
+        day_ids = set()
+        actions = iter(args)
+        for hours, values in zip(actions, actions):
+            if HOUR_TOTAL_FIELDS & values.keys():
+                day_ids.update(h.day_id.id for h in hours if h.day_id)
+                if values.get('day_id'):
+                    day_ids.add(values['day_id'])
+        super().write(*args)
+        cls._update_days(day_ids)
+
+    @classmethod
+    def delete(cls, hours):
+        day_ids = {h.day_id.id for h in hours if h.day_id}
+        super().delete(hours)
+        cls._update_days(day_ids)
+
+    @classmethod
+    def _update_days(cls, day_ids):
+        if not day_ids:
+            return
+        TTDays = Pool().get('pl_cust_timetracking.ttdays')
+        TTDays.update_totals(TTDays.browse(list(day_ids)))
+
 class TTOvertimeValidate(ModelSQL, ModelView):
     'Time Traking Overtime Validate'
     __name__ = 'pl_cust_timetracking.ttovertimevalidate'
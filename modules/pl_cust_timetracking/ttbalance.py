@@ -0,0 +1,242 @@
+# This file is part of Tryton.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from sql.aggregate import Sum
+
+from trytond.model import Index, ModelSQL, ModelView, Unique, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['TTBalance', 'Employee', 'Cron']
+
+WEEKDAY_FIELDS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+                  'saturday', 'sunday']
+
+
+def _month_end(date):
+    next_month = (date.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return next_month - timedelta(days=1)
+
+
+class _Schedule(object):
+    "Heures attendues par jour selon les horaires d'un employé"
+
+    def __init__(self, timetables):
+        self.timetables = sorted(timetables, key=lambda t: t.date_start)
+
+    @property
+    def start(self):
+        return self.timetables and self.timetables[0].date_start or None
+
+    def timetable(self, date):
+        res = None
+        for tt in self.timetables:
+            if tt.date_start <= date and (not tt.date_end or date <= tt.date_end):
+                res = tt
+        return res
+
+    def expected(self, date):
+        tt = self.timetable(date)
+        if not tt:
+            return 0
+        workdays = [f for f in WEEKDAY_FIELDS if getattr(tt, f)]
+        if not workdays or not getattr(tt, WEEKDAY_FIELDS[date.weekday()]):
+            return 0
+        return (tt.weekly_duration_auto or 0) / len(workdays)
+
+
+class TTBalance(ModelSQL, ModelView):
+    'Time Tracking Overtime Balance'
+    __name__ = 'pl_cust_timetracking.ttbalance'
+
+    employee_id = fields.Many2One(
+        'company.employee', 'Employee', required=True, readonly=True)
+    period_start = fields.Date('Period Start', required=True, readonly=True)
+    period_end = fields.Date('Period End', required=True, readonly=True)
+    worked = fields.Float('Worked Hours', digits=(16, 2), readonly=True)
+    expected = fields.Float('Expected Hours', digits=(16, 2), readonly=True)
+    balance = fields.Float('Balance', digits=(16, 2), readonly=True)
+    cumulative = fields.Float('Cumulative Balance', digits=(16, 2),
+        readonly=True, help="Solde depuis le premier horaire de l'employé")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints = [
+            ('employee_period_uniq', Unique(t, t.employee_id, t.period_start),
+                'Un seul solde par employé et par période.'),
+        ]
+        cls._sql_indexes.add(
+            Index(t, (t.employee_id, Index.Equality()),
+                (t.period_end, Index.Range())))
+        cls._order = [
+            ('employee_id', 'ASC'),
+            ('period_start', 'DESC'),
+        ]
+
+    @classmethod
+    def _schedules(cls, employee_ids):
+        TimeTables = Pool().get('pl_cust_timetracking.tttimetables')
+        timetables = defaultdict(list)
+        for tt in TimeTables.search([('employee_id', 'in', employee_ids)]):
+            timetables[tt.employee_id.id].append(tt)
+        return {e: _Schedule(timetables[e]) for e in employee_ids}
+
+    @classmethod
+    def _compute(cls, employee_id, schedule, date_from, date_to):
+        """
+        Heures travaillées (somme SQL des jours valides) et attendues de
+        l'employé sur [date_from, date_to]. Les jours d'un autre type que
+        'std' (maladie, vacances) ne sont pas attendus.
+        """
+        TTDays = Pool().get('pl_cust_timetracking.ttdays')
+        day = TTDays.__table__()
+        cursor = Transaction().connection.cursor()
+
+        where = ((day.employee_id == employee_id)
+            & (day.date >= date_from) & (day.date <= date_to))
+        cursor.execute(*day.select(Sum(day.tot_duration), where=where))
+        worked, = cursor.fetchone()
+        if isinstance(worked, timedelta):
+            worked = worked.total_seconds()
+        worked = (worked or 0) / 3600
+
+        cursor.execute(*day.select(day.date,
+                where=where & (day.day_type != 'std')))
+        excused = {d for d, in cursor}
+
+        expected = 0
+        date = date_from
+        while date <= date_to:
+            if date not in excused:
+                expected += schedule.expected(date)
+            date += timedelta(1)
+        return worked, expected
+
+    @classmethod
+    def get_balance(cls, employee, date=None):
+        """
+        Solde d'heures supplémentaires de l'employé au `date` inclus:
+        dernier solde enregistré plus les jours suivants.
+        """
+        Date_ = Pool().get('ir.date')
+        if date is None:
+            date = Date_.today()
+
+        schedule = cls._schedules([employee.id])[employee.id]
+        if not schedule.start:
+            return 0
+
+        snapshots = cls.search([
+                ('employee_id', '=', employee.id),
+                ('period_end', '<=', date),
+                ], order=[('period_end', 'DESC')], limit=1)
+        if snapshots:
+            snapshot, = snapshots
+            balance = snapshot.cumulative
+            date_from = snapshot.period_end + timedelta(1)
+        else:
+            balance = 0
+            date_from = schedule.start
+        if date_from <= date:
+            worked, expected = cls._compute(
+                employee.id, schedule, date_from, date)
+            balance += worked - expected
+        return round(balance, 2)
+
+    @classmethod
+    def invalidate(cls, changes):
+        """
+        Supprime les soldes devenus faux: {employee_id: date modifiée}.
+        Les soldes suivants en dépendent et sont supprimés aussi.
+        """
+        with Transaction().set_context(_check_access=False):
+            to_delete = []
+            for employee_id, date in changes.items():
+                to_delete.extend(cls.search([
+                            ('employee_id', '=', employee_id),
+                            ('period_end', '>=', date),
+                            ]))
+            if to_delete:
+                cls.delete(to_delete)
+
+    @classmethod
+    def update_snapshots(cls, employees=None):
+        "Appelé par le cron: enregistre les mois complets manquants"
+        pool = Pool()
+        Date_ = pool.get('ir.date')
+        TimeTables = pool.get('pl_cust_timetracking.tttimetables')
+
+        if employees is None:
+            employee_ids = list({tt.employee_id.id
+                    for tt in TimeTables.search([])})
+        else:
+            employee_ids = [e.id for e in employees]
+        # dernier mois complet
+        limit = Date_.today().replace(day=1) - timedelta(1)
+        schedules = cls._schedules(employee_ids)
+
+        to_create = []
+        for employee_id in employee_ids:
+            schedule = schedules[employee_id]
+            if not schedule.start:
+                continue
+            last = cls.search([
+                    ('employee_id', '=', employee_id),
+                    ], order=[('period_end', 'DESC')], limit=1)
+            if last:
+                cumulative = last[0].cumulative
+                date_from = last[0].period_end + timedelta(1)
+            else:
+                cumulative = 0
+                date_from = schedule.start
+            while date_from <= limit:
+                date_to = _month_end(date_from)
+                worked, expected = cls._compute(
+                    employee_id, schedule, date_from, date_to)
+                cumulative += worked - expected
+                to_create.append({
+                        'employee_id': employee_id,
+                        'period_start': date_from,
+                        'period_end': date_to,
+                        'worked': round(worked, 2),
+                        'expected': round(expected, 2),
+                        'balance': round(worked - expected, 2),
+                        'cumulative': round(cumulative, 2),
+                        })
+                date_from = date_to + timedelta(1)
+        if to_create:
+            cls.create(to_create)
+            logger.info("%s overtime snapshots created", len(to_create))
+
+
+class Employee(metaclass=PoolMeta):
+    __name__ = 'company.employee'
+
+    overtime_balance = fields.Function(fields.Float('Overtime Balance',
+            digits=(16, 2), help="Solde d'heures supplémentaires au jour du "
+            "contexte (aujourd'hui par défaut)"),
+        'get_overtime_balance')
+
+    @classmethod
+    def get_overtime_balance(cls, employees, name):
+        TTBalance = Pool().get('pl_cust_timetracking.ttbalance')
+        date = Transaction().context.get('date')
+        return {e.id: TTBalance.get_balance(e, date) for e in employees}
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ('pl_cust_timetracking.ttbalance|update_snapshots',
+                "Update Overtime Balances"))
@@ -1,7 +1,10 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 import datetime
+import zipfile
 from datetime import timedelta
+from collections import defaultdict
+from io import BytesIO
 from trytond.model import ModelView, fields
 from trytond.model.exceptions import AccessError
 from trytond.wizard import Wizard, StateTransition, StateView, StateAction, \
@@ -9,6 +12,8 @@ from trytond.wizard import Wizard, StateTransition, StateView, StateAction, \
 from trytond.report import Report
 from trytond.transaction import Transaction
 from trytond.pool import Pool
+from trytond.pyson import Bool, Eval
+from trytond.tools import slugify
 import sys
 import locale
 
@@ -22,7 +27,11 @@ class TTPrintReportStart(ModelView):
     from_date = fields.Date('From Date', required=True)
     to_date = fields.Date('To Date', required=True)
     employee_id = fields.Many2One(
-        'company.employee', 'Employee', required=True)
+        'company.employee', 'Employee',
+        states={'required': ~Bool(Eval('employees'))})
+    employees = fields.Many2Many(
+        'company.employee', None, None, 'Employees',
+        help="Un rapport par employé, regroupés dans un zip")
 
     @staticmethod
     def default_employee_id():
@@ -41,8 +50,12 @@ class TTPrintReport(Wizard):
     print_ = StateReport('pl_cust_timetracking.ttreport')
 
     def do_print_(self, action):
+        employee_ids = [e.id for e in self.start.employees]
+        if not employee_ids:
+            employee_ids = [self.start.employee_id.id]
         data = {
-            'employee_id': self.start.employee_id.id,
+            'employee_id': employee_ids[0],
+            'employee_ids': employee_ids,
             'from_date': self.start.from_date,
             'to_date': self.start.to_date,
         }
@@ -52,6 +65,39 @@ class TTPrintReport(Wizard):
 class TTReport(Report):
     __name__ = 'pl_cust_timetracking.ttreport'
 
+    @classmethod
+    def execute(cls, ids, data):
+        # Plusieurs employés: un rapport chacun, regroupés dans un zip
+        employee_ids = data.get('employee_ids') or []
+        if len(employee_ids) <= 1:
+            return super().execute(ids, data)
+
+        Employee = Pool().get('company.employee')
+        content = BytesIO()
+        title = None
+        with zipfile.ZipFile(content, 'w') as content_zip:
+            for employee in Employee.browse(employee_ids):
+                oext, rcontent, _, title = super().execute(
+                    ids, dict(data, employee_id=employee.id))
+                if isinstance(rcontent, str):
+                    rcontent = rcontent.encode('utf-8')
+                content_zip.writestr('{}-{}.{}'.format(
+                        title, slugify(employee.rec_name), oext), rcontent)
+        return 'zip', content.getvalue(), False, title
+
+    @classmethod
+    def _get_hours(cls, days):
+        "Pointages de tous les jours en une requête, triés par heure"
+        TTHours = Pool().get('pl_cust_timetracking.tthours')
+
+        hours = defaultdict(list)
+        for h in TTHours.search([
+                    ('day_id', 'in', [d.id for d in days]),
+                    ], order=[('day_id', 'ASC'), ('employ_hour', 'ASC'),
+                    ('id', 'ASC')]):
+            hours[h.day_id.id].append(h)
+        return hours
+
     @classmethod
     def _get_records(cls, ids, model, data):
 
@@ -109,21 +155,22 @@ class TTReport(Report):
         dict_record = dict(record_date_list)
         tot_period = 0
         date_check = data['from_date']
-        tt = None
-        
+
+        # Horaire et pointages chargés une fois pour toute la période,
+        # validité et total stockés sur les jours
+        tt = TimeTables.search([('employee_id', '=', employ)], limit=1)
+        workdays = None
+        if tt:
+            tt, = tt
+            workdays = {1: tt.monday, 2: tt.tuesday, 3: tt.wednesday,
+                        4: tt.thursday, 5: tt.friday, 6: tt.saturday,
+                        7: tt.sunday}
+        hours = cls._get_hours(records)
+
         while date_check <= data['to_date']:
             overday = False
-            tt_id = TimeTables.search([('employee_id', '=', employ)])
-            if tt_id:
-                tt = TimeTables.browse(tt_id)[0]
-            if tt:
-                if (date_check.isocalendar()[2] == 1 and not tt.monday) or \
-                   (date_check.isocalendar()[2] == 2 and not tt.tuesday) or \
-                   (date_check.isocalendar()[2] == 3 and not tt.wednesday) or \
-                   (date_check.isocalendar()[2] == 4 and not tt.thursday) or \
-                   (date_check.isocalendar()[2] == 5 and not tt.friday) or \
-                   (date_check.isocalendar()[2] == 6 and not tt.saturday) or \
-                   (date_check.isocalendar()[2] == 7 and not tt.sunday):
+            if workdays:
+                if not workdays[date_check.isocalendar()[2]]:
 
                     if date_check in dict_record:
                         overday = True
@@ -150,21 +197,23 @@ class TTReport(Report):
             tab_res[month][week]['day_list'].append(day)
             if date_check in dict_record:
                 d = dict_record[date_check]
+                d_hours = hours[d.id]
+                not_valid, tot_hours = d.not_valid, d.tot_hours
                 if d.day_type == 'std':
                     tab_res[month][week][day] = {'tot_hours_day': 0,
                                                 'hours_list': [],
-                                                'hours_list_txt': d.not_valid and 'Jour NON valide' or '',
+                                                'hours_list_txt': not_valid and 'Jour NON valide' or '',
                                                 'color': 3,
-                                                'not_valid': d.not_valid}
+                                                'not_valid': not_valid}
                 else: 
                     tab_res[month][week][day] = {'tot_hours_day': 0,
                                                  'hours_list': [],
                                                  'hours_list_txt': d.day_type_string + '  ',
                                                  'color': 4,
-                                                 'not_valid': d.not_valid}
+                                                 'not_valid': not_valid}
 
-                if not d.not_valid and d.tot_hours: 
-                    hours_in_minutes = d.tot_hours.hour + d.tot_hours.minute/60.0
+                if not not_valid and tot_hours: 
+                    hours_in_minutes = tot_hours.hour + tot_hours.minute/60.0
                     tab_res[month]['tot_hours_month'] += hours_in_minutes
                     tab_res[month][week]['tot_hours_week'] += hours_in_minutes
                     tab_res[month][week][day]['tot_hours_day'] += hours_in_minutes
@@ -172,8 +221,8 @@ class TTReport(Report):
                         tab_res[month][week][day]['color'] = overday and 1 or 0
                     
                     tot_period += hours_in_minutes
-                for h in d.hours_ids[:-1]:
-                    if not d.not_valid:
+                for h in d_hours[:-1]:
+                    if not not_valid:
                         if h.type_hour == 'in':
                             tab_res[month][week][day]['hours_list_txt'] += '{}'.format(
                                 h.employ_hour.isoformat(timespec='minutes'))
@@ -181,9 +230,9 @@ class TTReport(Report):
                             tab_res[month][week][day]['hours_list_txt'] += ' - {} | '.format(
                                 h.employ_hour.isoformat(timespec='minutes'))
                     tab_res[month][week][day]['hours_list'].append(h)
-                if d.hours_ids and not d.not_valid:
+                if d_hours and not not_valid:
                     tab_res[month][week][day]['hours_list_txt'] += ' - {}'.format(
-                        d.hours_ids[-1].employ_hour.isoformat(timespec='minutes'))
+                        d_hours[-1].employ_hour.isoformat(timespec='minutes'))
                 
             else:
                 tab_res[month][week][day] = {'tot_hours_day': 0,
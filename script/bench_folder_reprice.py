@@ -0,0 +1,90 @@
+"""
+Benchmark du recalcul des prix des timesheets d'un dossier.
+
+Crée un dossier synthétique avec N timesheets répartis sur les employés
+existants puis mesure:
+  - un renommage du dossier (ne doit plus toucher aux timesheets),
+  - un changement de tarif T1..T5 (un write par tarif),
+  - le bouton "update_prices".
+
+    python bench_folder_reprice.py <database> [nb_timesheets]
+
+Le dossier créé est supprimé à la fin.
+"""
+from proteus import config, Model
+import sys
+import time
+from datetime import timedelta
+
+config = config.set_trytond(database=sys.argv[1])
+nb_lines = len(sys.argv) > 2 and int(sys.argv[2]) or 3000
+
+FOLDERS = Model.get('pl_cust_plfolders.folders')
+FOLDERSHEET = Model.get('pl_cust_plfolders.foldersheet')
+TASK = Model.get('pl_cust_plfolders.sheettasks')
+EMPLOYEE = Model.get('company.employee')
+PARTY = Model.get('party.party')
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    func()
+    print('{:<30} {:8.3f}s'.format(label, time.perf_counter() - start))
+
+
+employees = EMPLOYEE.find([('employee_type', 'in', ['T1', 'T2', 'T3', 'T4', 'T5'])])
+task = TASK.find([])[0]
+party = PARTY.find([])[0]
+if not employees:
+    sys.exit("Aucun employé avec un type T1..T5")
+
+folder = FOLDERS()
+folder.party_id = party
+folder.description = 'BENCH reprice'
+folder.folder_price1 = 100
+folder.folder_price2 = 110
+folder.folder_price3 = 120
+folder.folder_price4 = 130
+folder.folder_price5 = 140
+folder.save()
+
+lines = []
+for i in range(nb_lines):
+    line = FOLDERSHEET()
+    line.folder_id = folder
+    line.task = task
+    line.activity = task.activity
+    line.resp_id = employees[i % len(employees)]
+    line.duration = timedelta(minutes=30)
+    line.hour_price = 100
+    line.pct = '100'
+    lines.append(line)
+timed('create {} timesheets'.format(nb_lines), lambda: FOLDERSHEET.save(lines))
+
+
+def rename():
+    folder.description = 'BENCH reprice (renamed)'
+    folder.save()
+
+
+def change_tariffs():
+    folder.folder_price1 = 150
+    folder.folder_price2 = 160
+    folder.folder_price3 = 170
+    folder.folder_price4 = 180
+    folder.folder_price5 = 190
+    folder.save()
+
+
+timed('rename folder', rename)
+timed('change T1..T5', change_tariffs)
+timed('update_prices button', lambda: folder.click('update_prices'))
+
+prices = {'T1': 150, 'T2': 160, 'T3': 170, 'T4': 180, 'T5': 190}
+wrong = [
+    l for l in FOLDERSHEET.find([('folder_id', '=', folder.id)])
+    if l.hour_price != prices[l.resp_id.employee_type]]
+print('Timesheets mal valorisés: {}'.format(len(wrong)))
+
+FOLDERSHEET.delete(FOLDERSHEET.find([('folder_id', '=', folder.id)]))
+folder.delete()
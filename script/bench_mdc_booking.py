@@ -0,0 +1,132 @@
+"""
+Benchmark de concurrence des réservations MDC.
+
+Envoie N réservations en parallèle sur la même demi-journée d'un serveur
+trytond local puis vérifie qu'il n'y a pas de sur-réservation:
+le nombre de places acceptées ne doit pas dépasser les places libres.
+
+Les réservations utilisent le tarif association pour ne pas appeler
+Datatrans: savepubbook n'appelle le prestataire que si le montant est non
+nul, le bench refuse donc de tourner si le prix association (price_asso de
+pl_cust_mdc.configuration) n'est pas à 0.
+
+    python bench_mdc_booking.py --url http://localhost:8000/mdc \
+        --key <clé application book> --day 42 --mad m -n 300 -c 50
+"""
+import argparse
+import json
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def asso_price(session, url):
+    r = session.get("{}/book/pub_price".format(url), timeout=30)
+    r.raise_for_status()
+    return float(r.json().get("nb_asso") or 0)
+
+
+def free_places(session, url, day, mad):
+    r = session.get("{}/book/get_pub_date".format(url), timeout=30)
+    r.raise_for_status()
+    for item in r.json():
+        if item["value"] == "{}/{}".format(day, mad):
+            return item["nb"]
+    return 0
+
+
+def book(session, url, day, mad, places, i):
+    payload = {
+        "item": {
+            "dates_id": "{}/{}".format(day, mad),
+            "tarifAdulte": 0,
+            "bonCadeau": 0,
+            "association": places,
+            "tarif02": 0,
+            "tarif34": 0,
+            "tarif56": 0,
+            "tarif78": 0,
+            "sp4": False,
+            "sp5": False,
+            "sp6": False,
+            "npa": "1200",
+            "associationNom": "bench-{}".format(i),
+            "email": "",
+        }
+    }
+    start = time.perf_counter()
+    r = session.post(
+        "{}/book/savepubbook".format(url), data=json.dumps(payload), timeout=120
+    )
+    return r.status_code, r.text, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", required=True, help="http://host:port/<database>")
+    parser.add_argument("--key", required=True, help="clé res.user.application 'book'")
+    parser.add_argument("--day", required=True, type=int, help="id du pl_cust_mdc.day_pub")
+    parser.add_argument("--mad", default="m", choices=["m", "a"])
+    parser.add_argument("--places", default=1, type=int, help="places par réservation")
+    parser.add_argument("-n", "--requests", default=300, type=int)
+    parser.add_argument("-c", "--concurrency", default=50, type=int)
+    args = parser.parse_args()
+
+    session = requests.Session()
+    session.headers["Authorization"] = "bearer {}".format(args.key)
+    session.headers["Content-Type"] = "application/json"
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=args.concurrency, pool_maxsize=args.concurrency
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    price = asso_price(session, args.url)
+    if price:
+        raise SystemExit(
+            "Prix association {} != 0: chaque réservation appellerait "
+            "Datatrans. Mettre price_asso à 0 sur la base de test.".format(price))
+
+    before = free_places(session, args.url, args.day, args.mad)
+    print("Places libres avant: {}".format(before))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(
+            executor.map(
+                lambda i: book(session, args.url, args.day, args.mad, args.places, i),
+                range(args.requests),
+            )
+        )
+    elapsed = time.perf_counter() - start
+
+    accepted = [r for r in results if r[0] == 200]
+    full = [r for r in results if r[0] == 404 and r[1] == "NbrMax"]
+    errors = [r for r in results if r not in accepted and r not in full]
+    latencies = sorted(r[2] for r in results)
+
+    after = free_places(session, args.url, args.day, args.mad)
+    booked = len(accepted) * args.places
+
+    print("Requêtes: {} en {:.2f}s ({:.1f} req/s)".format(
+        len(results), elapsed, len(results) / elapsed))
+    print("Acceptées: {}  complet: {}  erreurs: {}".format(
+        len(accepted), len(full), len(errors)))
+    print("Latence médiane {:.3f}s  p95 {:.3f}s  max {:.3f}s".format(
+        statistics.median(latencies),
+        latencies[int(len(latencies) * 0.95) - 1],
+        latencies[-1]))
+    print("Places réservées: {}  libres après: {}".format(booked, after))
+    for status, text, _ in errors[:5]:
+        print("  erreur {}: {}".format(status, text[:200]))
+
+    if booked > before:
+        print("SUR-RÉSERVATION: {} places de trop".format(booked - before))
+        raise SystemExit(1)
+    print("OK: pas de sur-réservation")
+
+
+if __name__ == "__main__":
+    main()